@@ -1,24 +1,265 @@
+import asyncio
 from asyncio import gather, get_running_loop
+from collections import Counter, defaultdict, deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from math import inf
 from app_state import state
 from aiojobs._scheduler import Scheduler
 from async_timeout import timeout
 from loguru import logger
 
+import tasks.tools
+
+
+class JobQueue(asyncio.Queue):
+    """
+    Очередь ожидающих тасков пула вместо FIFO.
+    
+    Первыми запускаются таски плана с наибольшим приоритетом (pool.priorities), 
+    среди равных по приоритету - с самым ранним дедлайном (EDF), затем в порядке spawn.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        super().__init__()
+        
+    def _init(self, maxsize):
+        self._queue = []
+        self._seq = count()
+        
+    def _put(self, job):
+        plan, deadline = self.pool._spawning
+        heappush(self._queue, (self.key(plan, deadline), next(self._seq), job, plan, deadline))
+        
+    def _get(self):
+        return heappop(self._queue)[2]
+    
+    def key(self, plan, deadline):
+        return -self.pool.priorities.get(plan, 1), inf if deadline is None else deadline
+    
+    def reorder(self):
+        """ Пересчитать порядок после изменения приоритетов. """
+        self._queue = [(self.key(plan, deadline), seq, job, plan, deadline) 
+                       for _, seq, job, plan, deadline in self._queue]
+        heapify(self._queue)
+        
+
+class RetryQueue:
+    """
+    Отложенные повторы: heap по времени пробуждения и один таймер на всю очередь.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._heap = []
+        self._seq = count()
+        self._timer = None
+        
+    def __len__(self):
+        return len(self._heap)
+        
+    async def wait(self, delay):
+        """ Дождаться своей очереди через delay секунд. """
+        waiter = self._loop.create_future()
+        heappush(self._heap, (self._loop.time() + delay, next(self._seq), waiter))
+        self._schedule()
+        await waiter
+        
+    def _schedule(self):
+        if not self._heap:
+            return
+        when = self._heap[0][0]
+        if self._timer and self._timer.when() <= when:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer = self._loop.call_at(when, self._fire)
+        
+    def _fire(self):
+        self._timer = None
+        now = self._loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            waiter = heappop(self._heap)[2]
+            if not waiter.done():
+                waiter.set_result(None)
+        self._schedule()
+        
 
 class Pool(Scheduler):
     """
     Сохраняет все таски в self.tasks, из которого таски автоматически не удаляются.
+    
+    Если keep_tasks=False, завершенные таски не сохраняются. Пул хранит только 
+    счетчики self.stats (ok/failed/error/cancelled), счетчики по планам self.plans
+    (если при spawn указан plan) и последние неудачи в self.failures.
+    Дождаться завершения всех тасков: `await pool.drain()`.
+    
+    Ожидающие таски запускаются по приоритету плана и дедлайну, см. JobQueue.
+    
+    Таск может подождать не занимая слот (например, перед повтором): 
+    `await tasks.tools.parking.get()(delay)`, см. park.
     """
-    def __init__(self, limit):
+    def __init__(self, limit, keep_tasks=True, max_failures=100):
         self.tasks = []
+        self.keep_tasks = keep_tasks
+        self.stats = Counter()
+        self.plans = defaultdict(Counter)
+        self.priorities = {}  # plan -> приоритет, по умолчанию 1
+        self.failures = deque(maxlen=max_failures)
+        self._plantags = {}
+        self._unfinished = Counter()  # plan -> кол-во незавершенных тасков
+        self._errors = {}  # plan -> первое исключение
+        self._waiters = defaultdict(list)
+        self._slot_waiter = None
+        self._slot_lookahead = 0
+        self._parked = 0  # таски, ожидающие в self.retries без слота
+        self._resuming = deque()  # таски, дождавшиеся повтора и ждущие слот
         super().__init__(loop=get_running_loop(), close_timeout=0, limit=limit, 
                          pending_limit=0, exception_handler=lambda *a: None)
+        self.retries = RetryQueue(self._loop)
+        self._pending = JobQueue(self)
+        self._spawning = (None, None)
         
-    async def spawn(self, *a, **kw):
-        job = await super().spawn(*a, **kw)
-        self.tasks.append(job._do_wait(timeout=None))
+    async def spawn(self, coro, plan=None, deadline=None):
+        """ deadline - timestamp, к которому желательно завершить таск. """
+        self._spawning = (plan, deadline)
+        job = await super().spawn(self._parkable(coro))
+        if self.keep_tasks:
+            self.tasks.append(job._do_wait(timeout=None))
+        if plan is not None:
+            self._plantags[job] = plan
+            self._unfinished[plan] += 1
+        self._unfinished[None] += 1
         return job
     
+    async def _parkable(self, coro):
+        tasks.tools.parking.set(self.park)
+        return await coro
+    
+    @property
+    def limit(self):
+        return self._limit - self._parked
+    
+    @property
+    def parked_count(self):
+        """ Кол-во тасков, ожидающих повтора без слота. """
+        return self._parked
+    
+    def set_limit(self, limit):
+        """ 
+        Изменить limit на лету. При увеличении сразу запускаются ожидающие таски,
+        при уменьшении активные таски не прерываются, новые не стартуют пока их больше limit.
+        """
+        self._limit = limit + self._parked
+        self._start_pending()
+        
+    def _start_pending(self):
+        """ Занять свободные слоты: сначала вернувшимися из park тасками, затем ожидающими. """
+        while self._resuming and self.active_count - len(self._resuming) < self._limit:
+            waiter = self._resuming.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+        while self.pending_count and self.active_count < self._limit and not self._closed:
+            job = self._pending.get_nowait()
+            if not job.closed:
+                job._start()
+        self._wake_slot()
+        
+    async def park(self, delay):
+        """
+        Подождать delay секунд в очереди повторов, отдав слот ожидающему таску.
+        По истечении delay таск ждет свободный слот раньше ожидающих тасков.
+        """
+        self._parked += 1
+        self._limit += 1
+        self._start_pending()
+        try:
+            await self.retries.wait(delay)
+        finally:
+            self._parked -= 1
+            self._limit -= 1
+        # Таск все время числится в active_count, поэтому слот свободен только если 
+        # без учета ждущих слот тасков активных меньше limit.
+        if self.active_count > self._limit:
+            waiter = self._loop.create_future()
+            self._resuming.append(waiter)
+            await waiter
+    
+    def set_priority(self, plan, priority):
+        """ Изменить приоритет плана, в т.ч. для уже ожидающих тасков. """
+        self.priorities[plan] = priority
+        self._pending.reorder()
+    
+    @property
+    def error(self):
+        """ Первое исключение, выброшенное каким-либо таском. """
+        return self._errors.get(None)
+    
+    async def wait_slot(self, lookahead=0):
+        """ Дождаться пока кол-во незавершенных тасков станет меньше limit + lookahead. """
+        while len(self._jobs) >= self._limit + lookahead and not self._closed:
+            self._slot_waiter = self._loop.create_future()
+            self._slot_lookahead = lookahead
+            await self._slot_waiter
+    
+    def _wake_slot(self):
+        waiter = self._slot_waiter
+        if waiter and not waiter.done() and len(self._jobs) < self._limit + self._slot_lookahead:
+            waiter.set_result(None)
+    
+    def progress(self):
+        stats = ', '.join(f'{v} {k}' for k, v in sorted(self.stats.items()))
+        return f'{sum(self.stats.values())} completed, {self._unfinished[None]} remaining, ' \
+               f'{self._parked} waiting for retry. ({stats})'
+    
+    async def drain(self, plan=None, heartbeat=None):
+        """
+        Дождаться завершения всех тасков, или только тасков плана plan.
+        Вернуть счетчики. Если таск выбросил исключение, оно выбрасывается здесь.
+        """
+        while self._unfinished[plan] and not self._closed and plan not in self._errors:
+            waiter = self._loop.create_future()
+            self._waiters[plan].append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), heartbeat)
+            except asyncio.TimeoutError:
+                logger.info(self.progress())
+        if plan in self._errors:
+            raise self._errors[plan]
+        return self.stats if plan is None else self.plans[plan]
+    
+    def _account(self, job):
+        """ Обновить счетчики завершенного таска. """
+        plan = self._plantags.pop(job, None)
+        error = None
+        if job._task.cancelled():
+            status = 'cancelled'
+        else:
+            error = job._task.exception()
+            if error is not None:
+                status = 'error'
+            elif job._task.result() is False:
+                status = 'failed'
+            else:
+                status = 'ok'
+        
+        self.stats[status] += 1
+        if plan is not None:
+            self.plans[plan][status] += 1
+        if status != 'ok':
+            self.failures.append(dict(plan=plan, status=status, error=repr(error)))
+        
+        for key in {plan, None}:
+            self._unfinished[key] -= 1
+            if error is not None:
+                self._errors.setdefault(key, error)
+            if not self._unfinished[key] or error is not None:
+                self._wakeup(key)
+        
+    def _wakeup(self, plan):
+        for waiter in self._waiters.pop(plan, []):
+            if not waiter.done():
+                waiter.set_result(None)
+        
     #def __del__(self):
         #print(1)
         #self._failed_task.cancel()
@@ -40,6 +281,8 @@ class Pool(Scheduler):
             self._pending.get_nowait()
         await gather(*[self.close_job(x) for x in self._jobs], return_exceptions=True)
         self._jobs.clear()
+        for plan in list(self._waiters):
+            self._wakeup(plan)
         
     async def close_job(self, job):
         job._closed = True
@@ -56,9 +299,111 @@ class Pool(Scheduler):
             pass
         
     def _done(self, job):
+        self._account(job)
         # Do not start next job if eventloop is stopping.
         # See [stoping feature] https://github.com/MagicStack/uvloop/issues/243
         if getattr(state, '_stopping', False):
             return
-        return super()._done(job)
-         
+        super()._done(job)
+        self._start_pending()
+    
+    
+class Feeder:
+    """
+    Ленивая подача тасков в пул.
+    
+    Таски берутся из итераторов планов только когда в пуле освобождается место, 
+    поэтому корутины тасков создаются по мере надобности, и в памяти их не больше 
+    чем limit пула + lookahead (плюс по одному заранее взятому таску на план).
+    
+    Итератор плана выдает корутины или пары (корутина, дедлайн). Следующий таск 
+    берется из плана с наибольшим приоритетом (pool.priorities), среди равных - 
+    с самым ранним дедлайном, а без дедлайнов - по очереди (round-robin). Ожидающие 
+    lookahead тасков пул упорядочивает так же, см. JobQueue.
+    """
+    def __init__(self, pool, lookahead=0):
+        self.pool = pool
+        self.lookahead = lookahead
+        self.generated = Counter()
+        self.total = {}
+        self._sources = []  # [plan, итератор, следующий таск, номер последней подачи]
+        self._active = Counter()  # Кол-во неисчерпанных итераторов плана.
+        self._seq = count()
+        self._fed = defaultdict(pool._loop.create_future)
+        self._wakeup = asyncio.Event()
+        
+    def add(self, plan, jobs, total=None):
+        """ 
+        Добавить итератор корутин jobs плана plan. total - ожидаемое кол-во тасков. 
+        План можно добавить повторно (перезапуск), в том числе пока подаются его 
+        прежние таски: wait_fed ждет все итераторы плана.
+        """
+        self._sources.append([plan, iter(jobs), None, -1])
+        self._active[plan] += 1
+        self.total[plan] = total
+        if self._fed[plan].done():  # План перезапущен.
+            self._fed[plan] = self.pool._loop.create_future()
+        self._wakeup.set()
+        
+    def remaining(self, plan):
+        """ Сколько тасков плана еще не сгенерировано, если известно. """
+        if self.total.get(plan) is None:
+            return None
+        return self.total[plan] - self.generated[plan]
+    
+    def progress(self):
+        return {
+            plan: {'generated': self.generated[plan], 'remaining': self.remaining(plan)} 
+            for plan in self.total
+        }
+    
+    async def wait_fed(self, plan):
+        """ Дождаться пока все таски плана будут переданы в пул. """
+        await self._fed[plan]
+        
+    def _peek(self, source):
+        """ Взять следующий таск источника. False если итератор исчерпан. """
+        plan, jobs = source[:2]
+        try:
+            job = next(jobs)
+        except StopIteration:
+            self._active[plan] -= 1
+            if not self._active[plan] and not self._fed[plan].done():
+                self._fed[plan].set_result(None)
+            return False
+        except Exception as e:
+            self._active[plan] -= 1
+            if not self._fed[plan].done():
+                self._fed[plan].set_exception(e)
+            return False
+        source[2] = job if isinstance(job, tuple) else (job, None)
+        return True
+    
+    def _order(self, source):
+        plan, _, (coro, deadline), last = source
+        return -self.pool.priorities.get(plan, 1), inf if deadline is None else deadline, last
+        
+    async def run(self, forever=False):
+        """ 
+        Подавать таски в пул пока не исчерпаны все итераторы. 
+        Если forever - ждать новых итераторов (см. add).
+        """
+        while self._sources or forever:
+            if not self._sources:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.pool.wait_slot(self.lookahead)
+            if self.pool.error:
+                raise self.pool.error
+            if self.pool._closed:
+                return
+            self._sources = [x for x in self._sources if x[2] or self._peek(x)]
+            if not self._sources:
+                continue
+            source = min(self._sources, key=self._order)
+            plan, _, (coro, deadline), _ = source
+            source[2] = None
+            source[3] = next(self._seq)
+            self.generated[plan] += 1
+            await self.pool.spawn(coro, plan=plan, deadline=deadline)
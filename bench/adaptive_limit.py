@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Симуляция: фиксированный limit пула загрузок против AdaptiveLimiter.
+
+Источник держит --capacity одновременных загрузок без потерь. При большем кол-ве 
+загрузок каждая замедляется пропорционально, и сегмент получает разрыв с 
+вероятностью (n - capacity) / n. Считаются сегменты без разрывов в секунду.
+
+    ./bench/adaptive_limit.py --capacity 100 --duration 20
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+class Source:
+    def __init__(self, capacity, latency):
+        self.capacity = capacity
+        self.latency = latency
+        self.active = 0
+        
+    async def download(self, observe):
+        self.active += 1
+        n = self.active
+        try:
+            latency = self.latency * max(1, n / self.capacity)
+            await asyncio.sleep(latency)
+        finally:
+            self.active -= 1
+        gaps = random.random() < max(0, (n - self.capacity) / n)
+        if observe:
+            observe(latency, gaps)
+        return not gaps
+    
+
+async def run(adaptive, args):
+    import aiopool
+    from limiter import AdaptiveLimiter
+    pool = aiopool.Pool(args.limit, keep_tasks=False)
+    source = Source(args.capacity, args.latency)
+    observe = None
+    if adaptive:
+        limiter = AdaptiveLimiter(pool, args.min_limit, args.limit, interval=args.interval, 
+                                  step=args.step, disk=False)
+        observe = limiter.observe
+        limits = asyncio.create_task(limiter.run())
+        
+    def jobs():
+        while True:
+            yield source.download(observe)
+    
+    feeder = aiopool.Feeder(pool)
+    feeder.add('sim', jobs())
+    try:
+        await asyncio.wait_for(feeder.run(), args.duration)
+    except asyncio.TimeoutError:
+        pass
+    stats = Counter(pool.stats)
+    await pool.close()
+    
+    total = stats['ok'] + stats['failed']
+    name = 'adaptive' if adaptive else 'fixed'
+    print(f'{name:>8}: limit {pool.limit:4}, {stats["ok"] / args.duration:6.1f} good segments/s, '
+          f'gap rate {stats["failed"] / max(total, 1):.1%}')
+    
+
+def main():
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')  # Без логов изменения limit.
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2, help='Время загрузки без перегрузки, с.')
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--min-limit', type=int, default=10)
+    parser.add_argument('--step', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('--duration', type=float, default=20)
+    args = parser.parse_args()
+    
+    for adaptive in (False, True):
+        asyncio.run(run(adaptive, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark: стоимость одного завершения в utils.CompletionStream и в прежнем
+utils.as_completed на основе asyncio.wait().
+
+    ./bench/completions.py
+    ./bench/completions.py --sizes 10000 100000 1000000 --legacy-max 10000
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import utils
+
+
+async def legacy_as_completed(tasks):
+    """ Прежняя реализация utils.as_completed. """
+    n = 0
+    pending = list(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=10, return_when=asyncio.FIRST_COMPLETED)
+        for x in done:
+            x.exception()
+        for x in done:
+            n += 1
+            yield n, x
+
+
+async def complete_gradually(futures, batch):
+    """ Завершать фьючеры пачками, уступая цикл событий между пачками. """
+    for i in range(0, len(futures), batch):
+        for fut in futures[i:i + batch]:
+            fut.set_result(True)
+        await asyncio.sleep(0)
+
+
+async def measure(size, stream, batch):
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in range(size)]
+    started = time.perf_counter()
+    feeder = asyncio.ensure_future(complete_gradually(futures, batch))
+    n = 0
+    async for n, task in stream(futures):
+        pass
+    await feeder
+    assert n == size
+    return (time.perf_counter() - started) / size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--batch', type=int, default=100,
+                        help='Сколько задач завершается за одну итерацию цикла событий.')
+    parser.add_argument('--legacy-max', type=int, default=10_000,
+                        help='Не запускать старую O(n^2) реализацию на больших размерах.')
+    args = parser.parse_args()
+    
+    print(f'{"jobs":>10} {"stream us/job":>14} {"legacy us/job":>14}')
+    for size in args.sizes:
+        new = asyncio.run(measure(size, utils.as_completed, args.batch))
+        old = '-'
+        if size <= args.legacy_max:
+            old = '%.2f' % (asyncio.run(measure(size, legacy_as_completed, args.batch)) * 1e6)
+        print(f'{size:>10} {new * 1e6:>14.2f} {old:>14}')
+    
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Benchmark: поиск разрывов в потоке PTS. Сравнивает потоковый 
+tasks.download.GapDetector с прежней реализацией check_file (списки + diffs.index)
+по времени и пиковой памяти, и проверяет что gapreport совпадает.
+
+    ./bench/gaps.py --packets 1000000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from tasks.download import GapDetector
+
+
+def synthetic_pts(packets, fps=25, gaps=20, seed=0):
+    """ PTS с разрывами разной длины (одинаковые длины давали неверный start в старом коде). """
+    rnd = random.Random(seed)
+    gapat = dict((rnd.randrange(1, packets), 2.5 + n * 1.25) for n in range(gaps))
+    pts = 0.0
+    for n in range(packets):
+        pts += gapat.get(n, 1 / fps)
+        yield round(pts, 3)
+
+
+async def aiter(iterable):
+    for x in iterable:
+        yield x
+
+
+async def legacy_check(ts_iter, localtime, duration=900, maxdiff=2):
+    """ Прежняя реализация tasks.download.check_file. """
+    ts = [x async for x in ts_iter]
+    report = {'localtime': localtime.isoformat()}
+    if not ts:
+        report['invalid_file'] = True
+        return report
+    if ts[-1] < duration:
+        report['duration_error'] = ts[-1]
+    diffs = [y - x for x, y in zip(ts[:-1], ts[1:])]
+    for diff in diffs:
+        if diff > maxdiff:
+            report.setdefault('maxdiff_errors', []).append({
+                'start': int(ts[diffs.index(diff)]), 'len': diff
+            })
+    return report
+
+
+async def streaming_check(ts_iter, localtime, duration=900, maxdiff=2):
+    detector = GapDetector(maxdiff)
+    async for pts in ts_iter:
+        detector.feed(pts)
+    return detector.report(localtime, duration)
+
+
+def measure(check, packets):
+    tracemalloc.start()
+    started = time.perf_counter()
+    report = asyncio.run(check(aiter(synthetic_pts(packets)), datetime(2018, 3, 18, 8)))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return report, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+    
+    for packets in args.packets:
+        old, old_time, old_peak = measure(legacy_check, packets)
+        new, new_time, new_peak = measure(streaming_check, packets)
+        assert old == new, f'Reports differ:\n{old}\n{new}'
+        print(f'{packets:>9} packets: legacy {old_time:.2f}s {old_peak / 2**20:.1f} MiB,'
+              f' streaming {new_time:.2f}s {new_peak / 2**20:.2f} MiB, reports identical')
+    
+    # Старый код брал start первого разрыва той же длины.
+    report = asyncio.run(streaming_check(aiter([0, 5, 6, 11]), datetime(2018, 3, 18, 8)))
+    assert [x['start'] for x in report['maxdiff_errors']] == [0, 6]
+        
+
+if __name__ == '__main__':
+    main()
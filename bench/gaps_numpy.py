@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Benchmark: разбор вывода ffprobe и поиск разрывов на чистом python 
+(tasks.parsers.scan_packets_python) и с numpy (scan_packets_numpy), 
+кусками по tasks.parsers.CHUNK_SIZE, и проверка что gapreport совпадает.
+
+    ./bench/gaps_numpy.py --packets 10000 100000 1000000
+"""
+import argparse
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from gaps import synthetic_pts
+from tasks import parsers
+from tasks.download import GapDetector
+
+
+def ffprobe_output(packets):
+    return b''.join(b'packet|pts_time=%.6f|pos=%d\n' % (pts, n * 1024) 
+                    for n, pts in enumerate(synthetic_pts(packets)))
+
+
+def chunks(data):
+    """ Куски из целых строк, как после parsers.whole_lines. """
+    start = 0
+    while start < len(data):
+        end = data.rfind(b'\n', start, start + parsers.CHUNK_SIZE) + 1 or len(data)
+        yield data[start:end]
+        start = end
+
+
+def check(scan, data):
+    started = time.perf_counter()
+    detector = GapDetector()
+    for chunk in chunks(data):
+        detector.merge(scan(chunk, detector.maxdiff))
+    report = detector.report(datetime(2018, 3, 18, 8))
+    return report, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+    
+    for packets in args.packets:
+        data = ffprobe_output(packets)
+        old, old_time = check(parsers.scan_packets_python, data)
+        new, new_time = check(parsers.scan_packets_numpy, data)
+        assert old == new, f'Reports differ:\n{old}\n{new}'
+        print(f'{packets:>9} packets: python {old_time:.3f}s, numpy {new_time:.3f}s '
+              f'({old_time / new_time:.1f}x), reports identical')
+        
+
+if __name__ == '__main__':
+    main()
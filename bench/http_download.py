@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Benchmark: скачивание сегментов с локального http-сервера через HttpEngine 
+(общая сессия, пул соединений) и с новым соединением на каждый сегмент 
+(как при скачивании внешним процессом).
+
+Сервер отдает сегмент --size байт кусками, имитируя поток видео. Печатается 
+пропускная способность и сколько соединений было открыто/переиспользовано.
+
+Затем проверяется, что ошибка соединения и ответ 503 не прерывают process_segment:
+попытка считается неудачной, а не падает пул. И что при обрыве ответа учитываются
+уже записанные байты, а если сервер игнорирует Range, докачка не засчитывается.
+
+    ./bench/http_download.py --segments 2000 --size 1000000 --concurrency 100
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def segment(request):
+    size = int(request.app['size'])
+    response = web.StreamResponse()
+    response.content_length = size
+    await response.prepare(request)
+    chunk = b'\0' * 2**16
+    for offset in range(0, size, len(chunk)):
+        await response.write(chunk[:size - offset])
+    return response
+
+
+async def cut(request):
+    """ Ответ обрывается на середине. """
+    size = int(request.app['size'])
+    response = web.StreamResponse()
+    response.content_length = size
+    await response.prepare(request)
+    await response.write(b'\0' * (size // 2))
+    request.transport.close()
+    return response
+
+
+async def unavailable(request):
+    raise web.HTTPServiceUnavailable()
+
+
+async def start_server(size, port):
+    app = web.Application()
+    app['size'] = size
+    app.router.add_get('/{camid}/{timestamp}.flv', segment)
+    app.router.add_get('/503/{camid}/{timestamp}.flv', unavailable)
+    app.router.add_get('/cut/{camid}/{timestamp}.flv', cut)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def run(mode, args, tmpdir):
+    from tasks.download import HttpEngine
+    url = f'http://127.0.0.1:{args.port}/{{camid}}/{{timestamp}}.flv'
+    limits = dict(connections_per_host=args.concurrency, host_rate=0, total_rate=0)
+    engine = HttpEngine(url, **limits)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    date = datetime(2018, 3, 18, tzinfo=timezone.utc)
+    
+    async def download(n):
+        async with semaphore:
+            timestart = date + timedelta(minutes=15 * n)
+            file = Path(tmpdir) / f'{n % args.concurrency}.flv'
+            if mode == 'engine':
+                await engine.fetch(engine.segment_url('cam', timestart), file)
+            else:
+                single = HttpEngine(url, **limits)
+                try:
+                    await single.fetch(single.segment_url('cam', timestart), file)
+                finally:
+                    engine.stats.update(single.stats)
+                    await single.close()
+                
+    started = time.perf_counter()
+    await asyncio.gather(*[download(n) for n in range(args.segments)])
+    elapsed = time.perf_counter() - started
+    await engine.close()
+    
+    stats = engine.stats
+    print(f'{mode:>12}: {args.segments / elapsed:7.1f} segments/s, '
+          f'{stats["bytes"] / elapsed / 2**20:7.1f} MiB/s, '
+          f'{stats["connections"]} connections opened, {stats["reused"]} reused')
+    
+
+async def check_errors(args, tmpdir):
+    """ Сегмент с недоступного источника: process_segment возвращает False, не падая. """
+    import tasks.download
+    timestart = datetime(2018, 3, 18, tzinfo=timezone.utc)
+    for name, url in (('503', f'http://127.0.0.1:{args.port}/503/{{camid}}/{{timestamp}}.flv'),
+                      ('refused', f'http://127.0.0.1:{args.port + 1}/{{camid}}/{{timestamp}}.flv')):
+        engine = tasks.download.setup_engine('http', url, host_rate=0, total_rate=0)
+        try:
+            ok = await tasks.download.process_segment(
+                'cam', timestart, tmp=Path(tmpdir) / f'{name}.tmp.flv', dst=Path(tmpdir) / f'{name}.flv',
+                max_retries=1)
+        finally:
+            await tasks.download.close_engine()
+        assert engine.stats['errors'] == 1, f'{name}: {dict(engine.stats)}'
+        print(f'{name:>12}: attempt failed without error (process_segment returned {ok})')
+        
+    file = Path(tmpdir) / 'partial.flv'
+    tasks.download.setup_engine('http', f'http://127.0.0.1:{args.port}/cut/{{camid}}/{{timestamp}}.flv',
+                                host_rate=0, total_rate=0)
+    written, resumed = await tasks.download.download_segment(file, 'cam', timestart)
+    await tasks.download.close_engine()
+    assert written == file.stat().st_size == args.size // 2, (written, file.stat().st_size)
+    print(f'{"cut":>12}: {written} bytes written before the connection was cut are counted')
+    
+    engine = tasks.download.setup_engine('http', f'http://127.0.0.1:{args.port}/{{camid}}/{{timestamp}}.flv',
+                                         host_rate=0, total_rate=0)
+    written, resumed = await tasks.download.download_segment(file, 'cam', timestart, offset=100)
+    await tasks.download.close_engine()
+    assert (written, resumed) == (args.size, 0) and file.stat().st_size == args.size
+    print(f'{"no range":>12}: server ignored Range, full file downloaded, 0 bytes resumed')
+    
+
+async def main(args):
+    runner = await start_server(args.size, args.port)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for mode in ('per-segment', 'engine'):
+                await run(mode, args, tmpdir)
+            await check_errors(args, tmpdir)
+    finally:
+        await runner.cleanup()
+    
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--segments', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=1_000_000, help='Размер сегмента, байт.')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--port', type=int, default=18080)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark: время импорта модулей (python -X importtime) при запуске команд taskloop и
+planner. Команды выполняются во временной директории с несколькими тасками, команды
+run/download/merge - только с --help (их тело не выполняется, измеряется импорт модулей).
+
+Для каждой команды печатается суммарное время импорта (минимум из --repeat запусков)
+и самые дорогие модули. Команда не проходит проверку, если импорт дольше --budget мс
+или если легкая команда (show, fail-running, ...) загрузила тяжелый модуль (веб-сервер,
+aiohttp, uvloop, numpy, psutil, tasks.download, ...). Код возврата 1, если хоть одна
+команда не прошла.
+
+    ./bench/importtime.py --budget 300 --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+HEAVY = ['fastapi', 'uvicorn', 'pydantic', 'starlette', 'uvloop', 'aiohttp', 'aiojobs', 'numpy',
+         'psutil', 'churoweb', 'aiopool', 'tasks.download', 'tasks.merge', 'tasks.parsers']
+
+TASKLOOP = ['taskloop.py', '--tasks-dir', 'tasks', '--downloaded-dir', 'downloaded', '--merged-dir', 'merged']
+PLANNER = ['planner.py', '--elect-date', '2024-03-17']
+
+# Команда -> можно ли ей загружать тяжелые модули.
+COMMANDS = {
+    'taskloop fail-running': (TASKLOOP + ['fail-running'], False),
+    'taskloop index build': (TASKLOOP + ['--task-index', 'index', 'build'], False),
+    'taskloop download --help': (TASKLOOP + ['download', '--help'], True),
+    'taskloop merge --help': (TASKLOOP + ['merge', '--help'], True),
+    'planner show': (PLANNER + ['show'], False),
+    'planner add': (PLANNER + ['add', '--routine', 'download', '--region', '1', '--first-uik', '1',
+                               '--last-uik', '2', '--hour-start', '7', '--hour-end', '8'], False),
+    'planner restart': (PLANNER + ['restart', '1'], False),
+    'planner run --help': (PLANNER + ['run', '--help'], True),
+}
+
+
+def importtime(args, cwd):
+    """ {модуль: (self, cumulative) мкс} и суммарное время импорта верхнего уровня. """
+    argv = [sys.executable, '-X', 'importtime', str(ROOT / args[0]), *args[1:]]
+    proc = subprocess.run(argv, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules, total = {}, 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(own), int(cumulative)
+        if not name[1:].startswith(' '):  # Модуль верхнего уровня, без отступа.
+            total += int(cumulative)
+    if proc.returncode:
+        errors = [x for x in proc.stderr.splitlines() if not x.startswith('import time:')]
+        raise SystemExit(f'{" ".join(args)} failed:\n' + '\n'.join(errors[-10:]))
+    return modules, total
+
+
+def make_tasks(directory):
+    for name in ('tasks', 'downloaded', 'merged'):
+        (Path(directory) / name).mkdir()
+    for n in range(10):
+        with open(Path(directory) / 'tasks' / f'task{n}.json', 'w') as f:
+            json.dump({'type': 'export', 'cmd': 'true', 'status': 'running'}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=300, help='Допустимое время импорта, мс.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5, help='Сколько самых дорогих модулей печатать.')
+    parser.add_argument('commands', nargs='*', default=list(COMMANDS), help='Команды (по умолчанию все).')
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as cwd:
+        make_tasks(cwd)
+        for command in args.commands:
+            argv, heavy_ok = COMMANDS[command]
+            runs = [importtime(argv, cwd) for _ in range(args.repeat)]
+            modules, total = min(runs, key=lambda x: x[1])
+            heavy = [x for x in HEAVY if x in modules]
+            ok = total / 1000 <= args.budget and (heavy_ok or not heavy)
+            print(f'{command:<26} {total / 1000:7.1f}ms {"ok" if ok else "FAIL"}'
+                  + (f', heavy modules: {", ".join(heavy)}' if heavy and not heavy_ok else ''))
+            top = sorted(modules.items(), key=lambda x: -x[1][0])[:args.top]
+            print('    ' + ', '.join(f'{name} {own / 1000:.1f}ms' for name, (own, _) in top))
+            if not ok:
+                failed.append(command)
+    if failed:
+        print(f'Over budget of {args.budget:.0f}ms or loading heavy modules: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmark: задержка event loop, пока разбирается вывод ffprobe для --files файлов
+одновременно, при разборе в event loop (--workers 0) и в ProcessPoolExecutor.
+
+Задержка - насколько позже срабатывает таймер, заведенный на каждые 10мс. 
+Проверяется что gapreport совпадает во всех режимах.
+
+    ./bench/loop_lag.py --files 50 --packets 25000 --workers 0 2 4
+"""
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def ffprobe_output(packets):
+    from gaps import synthetic_pts
+    return b''.join(b'packet|pts_time=%.6f|pos=%d\n' % (pts, n * 1024) 
+                    for n, pts in enumerate(synthetic_pts(packets)))
+
+
+async def stream(data, chunk_size=2**18):
+    """ Вывод процесса приходит кусками, как из пайпа. """
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+        await asyncio.sleep(0)
+
+
+async def check(data):
+    from tasks import parsers
+    from tasks.download import GapDetector
+    detector = GapDetector()
+    async for scan in parsers.map_chunks(parsers.scan_packets, stream(data), detector.maxdiff):
+        detector.merge(scan)
+    return detector.report(datetime(2018, 3, 18, 8))
+
+
+async def monitor(lags, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+        
+
+async def run(workers, files, data):
+    from tasks import parsers
+    parsers.setup(workers)
+    if workers:
+        await check(data)  # Запустить процессы до замера.
+    lags = []
+    ticker = asyncio.ensure_future(monitor(lags))
+    started = time.perf_counter()
+    reports = await asyncio.gather(*[check(data) for _ in range(files)])
+    elapsed = time.perf_counter() - started
+    ticker.cancel()
+    parsers.setup(0)
+    
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    print(f'workers={workers}: {elapsed:5.2f}s, loop lag p99 {p99 * 1000:6.1f}ms, '
+          f'max {max(lags or [0]) * 1000:6.1f}ms')
+    return reports[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--packets', type=int, default=25_000, help='Пакетов в файле (25 fps * 900с = 22500).')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    args = parser.parse_args()
+    
+    data = ffprobe_output(args.packets)
+    reports = [asyncio.run(run(workers, args.files, data)) for workers in args.workers]
+    assert all(x == reports[0] for x in reports), 'Reports differ'
+    print('reports identical')
+
+
+if __name__ == '__main__':
+    main()
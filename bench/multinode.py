@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Benchmark: --nodes процессов выполняют таски одного индекса, захватывая их в аренду
+(TaskStore.claim / heartbeat, StatusWriter с fencing-токенами), как taskloop --node-id.
+Таск - sleep(--duration), у каждого узла пул на --workers тасков.
+
+Печатается пропускная способность (тасков/с) для 1, 2, 4 ... узлов. Затем один узел
+падает, не освободив захваченные таски, и проверяется, что их выполняют другие узлы
+после истечения аренды, что статус опоздавшего узла отбрасывается, и что захват таска 
+другим узлом сразу после проверки токена не перезаписывается.
+
+    ./bench/multinode.py --tasks 2000 --workers 20 --duration 0.05 --nodes 1 2 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def make_tasks(tasks_dir, count):
+    for n in range(count):
+        with open(Path(tasks_dir) / f'task{n:06}.json', 'w') as f:
+            json.dump({'type': 'export', 'cmd': 'true'}, f)
+
+
+async def node_loop(tasks_dir, node, workers, duration, ttl, crash_after, start):
+    import aiopool
+    import statuswriter
+    import taskstore
+    loop = asyncio.get_running_loop()
+    store = taskstore.TaskStore(tasks_dir)
+    writer = statuswriter.StatusWriter(tasks_dir, store=store)
+    pool = aiopool.Pool(workers, keep_tasks=False)
+    leases = {}
+    claimed_total = 0
+    await loop.run_in_executor(None, start.wait)  # Все узлы запущены.
+
+    async def task(id, taskinfo):
+        writer.put(id, dict(taskinfo, status='running'))
+        await asyncio.sleep(duration)
+        writer.put(id, dict(taskinfo, status='finished'))
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            for id in [id for id, (fence, job) in leases.items() if job.closed]:
+                del leases[id]
+            await loop.run_in_executor(
+                None, store.heartbeat, node, [(id, f) for id, (f, job) in leases.items()], ttl)
+
+    heartbeats = asyncio.ensure_future(heartbeat())
+    while True:
+        # Захватывать пачками: до limit тасков сверх пула, как lookahead в aiopool.Feeder.
+        await pool.wait_slot(lookahead=workers)
+        claimed = await loop.run_in_executor(
+            None, store.claim, 'export', node, 2 * workers - len(pool._jobs), ttl)
+        for id, taskinfo, fence in claimed:
+            writer.fences[id] = fence
+            leases[id] = fence, await pool.spawn(task(id, taskinfo))
+        claimed_total += len(claimed)
+        if crash_after and claimed_total >= crash_after:
+            writer.flush()
+            os._exit(1)  # Упасть, не освободив аренду.
+        if claimed:
+            continue
+        if not pool._jobs and not store.leased('export', node):
+            break
+        await asyncio.sleep(min(0.5, ttl / 3))
+    await pool.drain()
+    heartbeats.cancel()
+    writer.close()
+    store.close()
+    return pool.stats['ok']
+
+
+def node(tasks_dir, node, workers, duration, ttl, crash_after, start):
+    asyncio.run(node_loop(tasks_dir, node, workers, duration, ttl, crash_after, start))
+
+
+def run_nodes(tasks_dir, count, args, crash_after=None):
+    ctx = multiprocessing.get_context('spawn')
+    start = ctx.Barrier(count + 1)
+    procs = [ctx.Process(target=node, args=(tasks_dir, f'node{n}', args.workers, args.duration, args.ttl,
+                                            crash_after if n == 0 else None, start))
+             for n in range(count)]
+    for proc in procs:
+        proc.start()
+    start.wait()
+    started = time.perf_counter()
+    for proc in procs:
+        proc.join()
+    return time.perf_counter() - started
+
+
+def check_finished(tasks_dir, count):
+    import statuswriter
+    import taskstore
+    store = taskstore.TaskStore(tasks_dir)
+    indexed = store.db.execute("SELECT count(*) FROM tasks WHERE status = 'finished'").fetchone()[0]
+    store.close()
+    files = sum(statuswriter.load(x)['status'] == 'finished' for x in Path(tasks_dir).glob('*.json'))
+    assert indexed == files == count, f'{indexed} indexed, {files} files finished of {count}'
+
+
+def check_fencing(tasks_dir):
+    """ Узел, аренда которого истекла и таск захвачен другим, не может записать статус. """
+    import taskstore
+    store = taskstore.TaskStore(tasks_dir)
+    make_tasks(tasks_dir, 1)
+    store.sync()
+    [(id, taskinfo, old)] = store.claim('export', 'late', 1, ttl=0)
+    [(_, _, new)] = store.claim('export', 'alive', 1, ttl=60)
+    assert store.heartbeat('late', [(id, old)], 60) == [id]
+    assert store.put_fenced([(id, dict(taskinfo, status='finished'), new)]) == [id]
+    assert store.put_fenced([(id, dict(taskinfo, status='failed'), old)]) == []
+    assert store.pending('export', exclude=()) [0][1]['status'] == 'finished'
+    store.close()
+
+
+def check_fenced_write(tasks_dir):
+    """ 
+    Таск захвачен другим узлом сразу после проверки токена: StatusWriter не должен 
+    перезаписать строку индекса нового владельца. Json и индекс принятого статуса 
+    совпадают, токен завершенного таска удаляется.
+    """
+    import statuswriter
+    import taskstore
+    store = taskstore.TaskStore(tasks_dir)
+    make_tasks(tasks_dir, 1)
+    store.sync()
+    writer = statuswriter.StatusWriter(tasks_dir, store=store, interval=3600)
+    [(id, taskinfo, fence)] = store.claim('export', 'late', 1, ttl=60)
+    put_fenced = store.put_fenced
+    
+    def claimed_after(*args, **kw):
+        accepted = put_fenced(*args, **kw)
+        store.claim('export', 'alive', 1, ttl=60, exclude=())
+        return accepted
+    
+    store.put_fenced = claimed_after
+    writer.fences[id] = fence
+    writer.put(id, dict(taskinfo, status='finished'))
+    writer.flush()
+    assert store.running('export') and store.running('export')[0][0] == id, 'New owner overwritten'
+    assert statuswriter.load(Path(tasks_dir) / f'{id}.json')['status'] == 'finished'
+    assert id not in writer.fences
+    store.put_fenced = put_fenced
+    writer.close()
+    store.close()
+
+
+def main():
+    import taskstore
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=20, help='Пул тасков одного узла.')
+    parser.add_argument('--duration', type=float, default=0.05, help='Длительность таска, с.')
+    parser.add_argument('--ttl', type=float, default=10, help='Аренда, с.')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    base = None
+    for count in args.nodes:
+        with tempfile.TemporaryDirectory() as tmp:
+            tasks_dir = Path(tmp) / 'tasks'
+            tasks_dir.mkdir()
+            make_tasks(tasks_dir, args.tasks)
+            taskstore.TaskStore(tasks_dir).sync()
+            elapsed = run_nodes(str(tasks_dir), count, args)
+            check_finished(tasks_dir, args.tasks)
+            rate = args.tasks / elapsed
+            base = base or rate / count
+            print(f'{count} nodes: {rate:7.0f} tasks/s ({rate / base / count:.0%} of linear), '
+                  f'ideal {count * args.workers / args.duration:.0f}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tasks_dir = Path(tmp) / 'tasks'
+        tasks_dir.mkdir()
+        make_tasks(tasks_dir, args.tasks)
+        taskstore.TaskStore(tasks_dir).sync()
+        elapsed = run_nodes(str(tasks_dir), 2, args, crash_after=args.workers)
+        check_finished(tasks_dir, args.tasks)
+        print(f'node crashed with {args.workers} claimed tasks: all tasks finished in {elapsed:.1f}s '
+              f'(lease {args.ttl}s)')
+
+    with tempfile.TemporaryDirectory() as tasks_dir:
+        check_fencing(tasks_dir)
+    with tempfile.TemporaryDirectory() as tasks_dir:
+        check_fenced_write(tasks_dir)
+        print('late writer rejected')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Симуляция: время от старта плана до последней склеенной камеры, если склейка
+начинается после всех загрузок (phased) и если камера склеивается сразу как
+скачаны все её сегменты (pipeline, utils.when_done).
+
+Один план из --cams камер по --segments сегментов. Как в planner: в phased сегменты 
+камер чередуются (utils.roundrobin), в pipeline камеры идут одна за другой. 
+Склейка камеры занимает --merge-duration.
+
+Проверяется, что склейка запускается и для камер, у которых нет сегментов
+(например, hour_end <= hour_start) или их меньше ожидаемого.
+
+    ./bench/pipeline.py --cams 40 --segments 48 --limit 100 --merge-workers 2
+"""
+import argparse
+import asyncio
+import sys
+from itertools import chain
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def work(duration):
+    await asyncio.sleep(duration)
+
+
+def camera_jobs(args):
+    return [(work(args.download_duration) for _ in range(args.segments)) for cam in range(args.cams)]
+
+
+async def run(mode, args):
+    import aiopool
+    import utils
+    loop = asyncio.get_running_loop()
+    downloads = aiopool.Pool(args.limit, keep_tasks=False)
+    merges = aiopool.Pool(args.merge_workers, keep_tasks=False)
+    feeder = aiopool.Feeder(downloads, lookahead=args.limit)
+    start = loop.time()
+    merged = []
+
+    def merge(cam):
+        async def job():
+            await work(args.merge_duration)
+            merged.append(loop.time() - start)
+        return job()
+
+    cams = camera_jobs(args)
+    if mode == 'pipeline':
+        cams = [utils.when_done(jobs, args.segments,
+                                lambda cam=cam: asyncio.ensure_future(merges.spawn(merge(cam))))
+                for cam, jobs in enumerate(cams)]
+        jobs = chain.from_iterable(cams)
+    else:
+        jobs = utils.roundrobin(cams)
+    feeder.add('plan', jobs, total=args.cams * args.segments)
+    await feeder.run()
+    await downloads.drain()
+    downloaded = loop.time() - start
+    if mode == 'phased':
+        for cam in range(args.cams):
+            await merges.spawn(merge(cam))
+    await merges.drain()
+
+    print(f'{mode:>8}: downloads {downloaded:5.2f}s, last merge {max(merged):5.2f}s, '
+          f'first merge {min(merged):5.2f}s')
+    return max(merged)
+
+
+async def check_empty_cameras():
+    """ Камеры без сегментов и с недостающими сегментами тоже склеиваются. """
+    import aiopool
+    import utils
+    downloads = aiopool.Pool(4, keep_tasks=False)
+    feeder = aiopool.Feeder(downloads, lookahead=4)
+    merged = []
+    segments = {0: 3, 1: 0, 2: 2, 3: 0}  # камера -> сегментов
+    expected = {0: 3, 1: 0, 2: 3, 3: 1}  # камера -> total, который ожидает when_done
+    cams = [utils.when_done((work(0.01) for _ in range(segments[cam])), expected[cam],
+                            lambda cam=cam: merged.append(cam))
+            for cam in segments]
+    feeder.add('plan', chain.from_iterable(cams), total=sum(segments.values()))
+    await feeder.run()
+    await downloads.drain()
+    assert sorted(merged) == sorted(segments), f'merged {merged}'
+    print(f'cameras without segments merged: {sorted(merged)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cams', type=int, default=40)
+    parser.add_argument('--segments', type=int, default=48)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--download-duration', type=float, default=0.1, help='Длительность загрузки сегмента, с.')
+    parser.add_argument('--merge-workers', type=int, default=2)
+    parser.add_argument('--merge-duration', type=float, default=0.1, help='Длительность склейки камеры, с.')
+    args = parser.parse_args()
+
+    download = args.cams * args.segments * args.download_duration / args.limit
+    merge = args.cams * args.merge_duration / args.merge_workers
+    print(f'expected: downloads {download:.2f}s, merges {merge:.2f}s')
+    for mode in ('phased', 'pipeline'):
+        asyncio.run(run(mode, args))
+    asyncio.run(check_empty_cameras())
+
+
+if __name__ == '__main__':
+    main()
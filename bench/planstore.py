@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark: --plans планов, --updates изменений (счетчики прогресса, завершение планов).
+Сравнивается прежнее сохранение всего состояния в shelve (как app_state autopersist)
+и журнал PlanStore: время сохранения, размер записи, время открытия при старте.
+Проверяется, что после оборванной при падении записи журнал открывается с тем же состоянием,
+и что новое хранилище и хранилище без файла журнала открываются как пустые.
+
+    ./bench/planstore.py --plans 1000 --updates 5000
+"""
+import argparse
+import json
+import pickle
+import random
+import shelve
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def make_plan(id):
+    return dict(id=id, routine='download', region=id % 90, first_uik=1, last_uik=3000,
+                hour_start=7, hour_end=20, priority=1, finished=False)
+
+
+def changes(args):
+    random.seed(0)
+    for n in range(args.updates):
+        id = random.randint(1, args.plans)
+        if n % 100 == 99:
+            yield id, {'finished': True}
+        else:
+            yield id, {'progress': {'ok': n, 'failed': n // 10, 'cancelled': 0}}
+
+
+def bench_shelve(directory, args):
+    """ Каждое сохранение - все планы целиком. """
+    plans = {id: make_plan(id) for id in range(1, args.plans + 1)}
+    path = str(Path(directory) / 'state.shelve')
+    started = time.perf_counter()
+    for id, fields in changes(args):
+        plans[id].update(fields)
+        with shelve.open(path) as db:
+            db['state'] = {'plans': plans}
+    elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    with shelve.open(path, flag='r') as db:
+        loaded = db['state']['plans']
+    opened = time.perf_counter() - started
+    assert loaded == plans
+    return elapsed, opened, plans
+
+
+def bench_journal(directory, args):
+    from planstore import PlanStore
+    store = PlanStore(Path(directory) / 'plans', compact_every=args.compact_every)
+    for id in range(1, args.plans + 1):
+        store._append({'op': 'add', 'plan': make_plan(id)}, sync=False)
+    started = time.perf_counter()
+    for id, fields in changes(args):
+        store.update(id, sync='finished' in fields, **fields)
+    elapsed = time.perf_counter() - started
+    store.close()
+    started = time.perf_counter()
+    store = PlanStore(Path(directory) / 'plans', compact_every=args.compact_every)
+    opened = time.perf_counter() - started
+    return elapsed, opened, store
+
+
+def check_torn_write(directory, plans):
+    """ Процесс упал посреди записи: состояние не меняется, следующая запись читается. """
+    from planstore import PlanStore
+    path = Path(directory) / 'plans'
+    with open(f'{path}.journal', 'ab') as f:
+        f.write(b'{"op": "update", "id": 1, "fields": {"finis')
+    store = PlanStore(path)
+    assert store.plans == plans, 'State changed by torn record'
+    store.update(1, priority=5)
+    store.close()
+    store = PlanStore(path)
+    assert store[1].priority == 5 and {k: v for k, v in store.plans.items() if k != 1} == \
+        {k: v for k, v in plans.items() if k != 1}
+    store.close()
+
+
+def check_fresh(directory):
+    """ Новое хранилище и удаленный журнал (остался только снимок) - не ошибка. """
+    from planstore import PlanStore
+    path = Path(directory) / 'fresh'
+    store = PlanStore(path)
+    store.refresh()
+    assert len(store) == 0 and store.seq == 0
+    store.add(routine='download', region=1)
+    store.compact()
+    store.journal.unlink()
+    store.refresh()
+    store.finish(1)
+    store.close()
+    store = PlanStore(path)
+    assert store[1].finished and len(store) == 1
+    store.journal.unlink()
+    store.close()
+    store = PlanStore(path)
+    assert len(store) == 1
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plans', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--compact-every', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as old, tempfile.TemporaryDirectory() as new:
+        elapsed, opened, plans = bench_shelve(old, args)
+        size = len(pickle.dumps({'plans': plans}))
+        print(f'  shelve: {args.updates / elapsed:8.0f} saves/s, {size / 1024:7.0f} KiB per save, '
+              f'open {opened * 1000:6.1f}ms')
+
+        elapsed, opened, store = bench_journal(new, args)
+        id, fields = next(changes(args))
+        size = len(json.dumps({'op': 'update', 'id': id, 'fields': fields, 'seq': store.seq})) + 1
+        print(f' journal: {args.updates / elapsed:8.0f} saves/s, {size / 1024:7.2f} KiB per save, '
+              f'open {opened * 1000:6.1f}ms ({store.records} records after snapshot)')
+        assert store.plans == plans, 'Journal state differs'
+        store.close()
+        check_torn_write(new, plans)
+        check_fresh(new)
+    print('states identical, torn write recovered, fresh store opened')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Benchmark: пиковый RSS при прогоне no-op тасков через aiopool.Pool
+с сохранением тасков (keep_tasks=True) и без (keep_tasks=False).
+
+    ./bench/pool_memory.py --jobs 500000
+"""
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def noop():
+    return True
+
+
+async def run(jobs, limit, keep_tasks):
+    import aiopool
+    pool = aiopool.Pool(limit, keep_tasks=keep_tasks)
+    for n in range(jobs):
+        await pool.spawn(noop(), plan=n % 10)
+        if n % limit == 0:
+            await asyncio.sleep(0)  # Дать пулу выполнить таски
+    if keep_tasks:
+        await asyncio.gather(*pool.tasks)
+    else:
+        await pool.drain()
+    
+
+def child(args):
+    asyncio.run(run(args.jobs, args.limit, args.keep_tasks == 'yes'))
+    # ru_maxrss в килобайтах на linux.
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=500_000)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--keep-tasks', choices=['yes', 'no'])
+    args = parser.parse_args()
+    
+    if args.keep_tasks:
+        return child(args)
+    
+    for keep_tasks in ('yes', 'no'):
+        out = subprocess.check_output([
+            sys.executable, __file__, f'--jobs={args.jobs}', f'--limit={args.limit}', 
+            f'--keep-tasks={keep_tasks}'
+        ])
+        rss = int(out.split()[-1]) / 1024
+        print(f'keep_tasks={keep_tasks}: {args.jobs} jobs, peak RSS {rss:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Симуляция повторов загрузки при сбоях источника.
+
+Источник отдает сегмент за --latency секунд, с вероятностью --failure-rate с ошибкой,
+а с --outage-start по --outage-end секунду недоступен (все запросы быстро падают).
+
+sleep - прежнее поведение: пауза base * 10**(attempt-1) внутри слота пула.
+park  - пауза с full jitter в очереди повторов без слота (Pool.park) и CircuitBreaker.
+
+Печатается время, за которое готовы 95% сегментов, загрузка слотов пула за это время
+(доля времени, когда слот качает), сколько запросов ушло в недоступный источник и 
+пиковое кол-во запросов за 100мс после восстановления источника.
+
+    ./bench/retries.py --segments 5000 --limit 200
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+class Source:
+    def __init__(self, args, start):
+        self.args = args
+        self.start = start
+        self.busy = 0  # суммарное время загрузок
+        self.requests = Counter()  # запросы по 100мс интервалам
+        self.outage_requests = 0
+        self.busy_at = []  # (время завершения сегмента, busy)
+        
+    async def download(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time() - self.start
+        self.requests[int(now * 10)] += 1
+        if self.args.outage_start <= now < self.args.outage_end:
+            self.outage_requests += 1
+            await asyncio.sleep(0.01)
+            self.busy += 0.01
+            return False
+        await asyncio.sleep(self.args.latency)
+        self.busy += self.args.latency
+        return random.random() >= self.args.failure_rate
+    
+    
+async def segment(mode, source, breaker, args):
+    from tasks.download import retry_delay
+    from tasks.tools import parking
+    for attempt in range(1, args.max_retries + 1):
+        while mode == 'park' and breaker.retry_after():
+            await parking.get()(breaker.delay())
+        ok = await source.download()
+        if ok or attempt == args.max_retries:
+            source.busy_at.append((asyncio.get_running_loop().time() - source.start, source.busy))
+        if mode == 'park':
+            breaker.record(ok)
+        if ok:
+            return True
+        if attempt < args.max_retries:
+            if mode == 'sleep':
+                await asyncio.sleep(args.base * 10**(attempt-1))
+            else:
+                await parking.get()(retry_delay(attempt, breaker, args.base))
+    return False
+        
+
+async def run(mode, args):
+    import aiopool
+    from tasks.download import CircuitBreaker
+    loop = asyncio.get_running_loop()
+    pool = aiopool.Pool(args.limit, keep_tasks=False)
+    source = Source(args, loop.time())
+    breaker = CircuitBreaker(threshold=args.limit // 4, cooldown=args.base * 10)
+    feeder = aiopool.Feeder(pool)
+    feeder.add('sim', (segment(mode, source, breaker, args) for _ in range(args.segments)))
+    await feeder.run()
+    await pool.drain()
+    elapsed = loop.time() - source.start
+    t95, busy = sorted(source.busy_at)[int(len(source.busy_at) * 0.95)]
+    after = [n for t, n in source.requests.items() if t >= args.outage_end * 10]
+    
+    print(f'{mode:>5}: 95% in {t95:4.1f}s (all in {elapsed:4.1f}s), slots busy {busy / (args.limit * t95):.0%}, '
+          f'{pool.stats["ok"]} ok / {pool.stats["failed"]} failed, '
+          f'{source.outage_requests} requests during outage, '
+          f'peak {max(after)} requests per 100ms after it')
+    
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--segments', type=int, default=5000)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--failure-rate', type=float, default=0.2)
+    parser.add_argument('--outage-start', type=float, default=0.5)
+    parser.add_argument('--outage-end', type=float, default=1.5)
+    parser.add_argument('--max-retries', type=int, default=4)
+    parser.add_argument('--base', type=float, default=0.1, help='Базовая пауза перед повтором, с.')
+    args = parser.parse_args()
+    
+    for mode in ('sleep', 'park'):
+        asyncio.run(run(mode, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Симуляция: доля сегментов, скачанных позже дедлайна, при FIFO-порядке 
+(камера за камерой, без приоритетов) и при приоритетах + EDF (aiopool.JobQueue).
+
+Два плана: большой план добавлен первым, маленький план следом. С --priority > 1 
+маленький план идет строго первым, ценой дедлайнов большого. Дедлайн сегмента k: start + (k + 1) * step, где step чуть больше 
+времени, нужного пулу на k-й сегмент всех камер.
+Проверяется также перезапуск плана, пока подаются его прежние таски.
+
+    ./bench/scheduling.py --cams 40 --small-cams 10 --segments 48 --duration 0.05
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def segment(deadline, duration):
+    await asyncio.sleep(duration)
+    return asyncio.get_running_loop().time() <= deadline  # False - дедлайн пропущен
+
+
+def camjobs(cams, segments, start, step, duration):
+    def jobs(cam):
+        for k in range(segments):
+            deadline = start + (k + 1) * step
+            yield segment(deadline, duration), deadline
+    return [jobs(cam) for cam in range(cams)]
+
+
+async def run(mode, args):
+    import aiopool
+    import utils
+    loop = asyncio.get_running_loop()
+    pool = aiopool.Pool(args.limit, keep_tasks=False)
+    if mode == 'fifo':
+        pool._pending = asyncio.Queue()
+        feeder = aiopool.Feeder(pool)
+        order = lambda cams: (coro for cam in cams for coro, deadline in cam)
+    else:
+        feeder = aiopool.Feeder(pool, lookahead=args.limit)
+        order = utils.roundrobin
+        pool.set_priority('small', args.priority)
+        
+    total_cams = args.cams + args.small_cams
+    step = args.slack * total_cams * args.duration / args.limit
+    start = loop.time()
+    for plan, cams in (('big', args.cams), ('small', args.small_cams)):
+        jobs = order(camjobs(cams, args.segments, start, step, args.duration))
+        feeder.add(plan, jobs, total=cams * args.segments)
+    await feeder.run()
+    await pool.drain()
+    elapsed = loop.time() - start
+    
+    print(f'{mode}: {elapsed:.1f}s')
+    for plan, stats in sorted(pool.plans.items()):
+        total = sum(stats.values())
+        print(f'    {plan:>5}: {stats["failed"]}/{total} missed ({stats["failed"] / total:.1%})')
+    missed = pool.stats['failed']
+    print(f'    total: {missed}/{sum(pool.stats.values())} missed ({missed / sum(pool.stats.values()):.1%})')
+    
+
+async def check_restart():
+    """ План добавлен повторно, пока подаются таски первого итератора (planner restart). """
+    import aiopool
+    pool = aiopool.Pool(2, keep_tasks=False)
+    feeder = aiopool.Feeder(pool)
+    run = asyncio.ensure_future(feeder.run(forever=True))
+    feeder.add('plan', (asyncio.sleep(0.01) for _ in range(10)))
+    await asyncio.sleep(0.02)
+    assert not feeder._fed['plan'].done(), 'Plan fed too early'
+    feeder.add('plan', (asyncio.sleep(0.01) for _ in range(5)))
+    await asyncio.wait_for(feeder.wait_fed('plan'), 5)
+    await pool.drain()
+    assert not run.done(), f'Feeder stopped: {run.exception()!r}'
+    assert feeder.generated['plan'] == 15 and sum(pool.stats.values()) == 15, dict(pool.stats)
+    feeder.add('plan', iter(()))
+    await asyncio.wait_for(feeder.wait_fed('plan'), 5)
+    run.cancel()
+    print('restart while feeding: ok')
+    
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cams', type=int, default=40)
+    parser.add_argument('--small-cams', type=int, default=10)
+    parser.add_argument('--segments', type=int, default=48)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=0.05, help='Длительность загрузки сегмента, с.')
+    parser.add_argument('--slack', type=float, default=1.2, help='Запас дедлайнов относительно пропускной способности.')
+    parser.add_argument('--priority', type=int, default=1, help='Приоритет маленького плана.')
+    args = parser.parse_args()
+    
+    for mode in ('fifo', 'edf'):
+        asyncio.run(run(mode, args))
+    asyncio.run(check_restart())
+
+
+if __name__ == '__main__':
+    main()
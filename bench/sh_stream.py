@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Benchmark: пиковый RSS и задержка до первой записи при чтении большого вывода
+через tasks.tools.sh() (буферизует весь вывод) и tasks.tools.sh_lines().
+
+    ./bench/sh_stream.py --megabytes 500
+"""
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def run(mode, cmd):
+    from tasks.tools import sh, sh_lines
+    started = time.perf_counter()
+    first = None
+    lines = 0
+    if mode == 'sh':
+        for line in (await sh(cmd)).split(b'\n'):
+            if first is None:
+                first = time.perf_counter() - started
+            lines += 1
+    else:
+        async for line in sh_lines(cmd):
+            if first is None:
+                first = time.perf_counter() - started
+            lines += 1
+    return first, time.perf_counter() - started, lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=500)
+    parser.add_argument('--mode', choices=['sh', 'sh_lines'])
+    args = parser.parse_args()
+    cmd = f"yes 'packet|pts_time=123.456' | head -c {args.megabytes * 10**6}"
+    
+    if args.mode:
+        first, total, lines = asyncio.run(run(args.mode, cmd))
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{args.mode:>8}: first record {first * 1000:8.1f} ms, total {total:6.1f}s,'
+              f' {lines} lines, peak RSS {rss:.0f} MiB')
+        return
+    
+    for mode in ('sh', 'sh_lines'):
+        subprocess.check_call([sys.executable, __file__, f'--megabytes={args.megabytes}', f'--mode={mode}'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark: синтетический stations.json из --regions регионов по --uiks УИК с --cameras
+камерами. Сравнивается прежний utils.stations() (весь json в dict) и StationsIndex:
+холодный старт (загрузка / построение индекса / открытие готового индекса), память
+и разворачивание плана в камеры (plan_cams) для --plans планов по --plan-uiks УИК.
+Проверяется, что камеры планов совпадают.
+
+    ./bench/stations.py --regions 90 --uiks 1000 --cameras 2 --plans 1000
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def make_stations(path, args):
+    random.seed(0)
+    stations = []
+    for region in range(1, args.regions + 1):
+        for uik in random.sample(range(1, args.uiks * 2), args.uiks):
+            stations.append({
+                'region_number': region,
+                'station_number': uik,
+                'timezone_offset_minutes': str(random.choice([120, 180, 240, 300, 420, 600])),
+                'camera_id': [f'{random.getrandbits(64):016x}-{region}-{uik}' for _ in range(args.cameras)],
+                'address': f'Регион {region}, УИК {uik}, ' + 'улица ' * 10,
+            })
+    with open(path, 'w') as f:
+        json.dump(stations, f)
+
+
+def load_stations(path):
+    """ Прежний utils.stations(). """
+    stations = defaultdict(dict)
+    for x in json.load(open(path)):
+        stations[x.get('region_number')][x.get('station_number')] = x
+    return stations
+
+
+def old_plan_cams(stations, region, first_uik, last_uik):
+    """ Прежний planner.plan_cams(). """
+    uiks = stations[region]
+    set(range(first_uik, last_uik + 1)) & set(uiks)
+    cams = []
+    for uik in sorted(uiks):
+        if not (first_uik <= uik <= last_uik):
+            continue
+        tz = int(uiks[uik]['timezone_offset_minutes']) / 60
+        for camnum, camid in enumerate(sorted(uiks[uik]['camera_id']), 1):
+            cams.append((uik, camnum, camid, tz))
+    return cams
+
+
+def new_plan_cams(index, region, first_uik, last_uik):
+    index.uiks(region, first_uik, last_uik)
+    return index.cams(region, first_uik, last_uik)
+
+
+def remove(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def measured(func, *args, before=None):
+    """ Время (без tracemalloc, он замедляет) и пик памяти второго вызова. """
+    for trace in (False, True):
+        if before:
+            before()
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = elapsed if trace else time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    from stationsindex import StationsIndex
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', type=int, default=90)
+    parser.add_argument('--uiks', type=int, default=1000, help='УИК в регионе.')
+    parser.add_argument('--cameras', type=int, default=2, help='Камер на УИК.')
+    parser.add_argument('--plans', type=int, default=1000)
+    parser.add_argument('--plan-uiks', type=int, default=50, help='УИК в диапазоне плана.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'stations.json'
+        make_stations(source, args)
+        print(f'stations.json: {source.stat().st_size / 2**20:.0f} MiB, {args.regions * args.uiks} uiks')
+
+        stations, elapsed, peak = measured(load_stations, source)
+        print(f'    json load: {elapsed * 1000:7.0f}ms, peak {peak / 2**20:6.1f} MiB')
+        index, elapsed, peak = measured(StationsIndex, source, before=lambda: remove(source.with_suffix('.sqlite')))
+        print(f'  index build: {elapsed * 1000:7.0f}ms, peak {peak / 2**20:6.1f} MiB')
+        index.close()
+        index, elapsed, peak = measured(StationsIndex, source)
+        print(f'   index open: {elapsed * 1000:7.0f}ms, peak {peak / 2**20:6.1f} MiB')
+
+        random.seed(1)
+        plans = []
+        for _ in range(args.plans):
+            first = random.randint(1, args.uiks * 2)
+            plans.append((random.randint(1, args.regions), first, first + args.plan_uiks - 1))
+        for name, func, data in (('dict', old_plan_cams, stations), ('index', new_plan_cams, index)):
+            started = time.perf_counter()
+            cams = [func(data, *plan) for plan in plans]
+            elapsed = time.perf_counter() - started
+            print(f'{name:>13}: {elapsed / args.plans * 1e6:7.0f}us per plan, '
+                  f'{sum(map(len, cams)) / args.plans:.0f} cameras per plan')
+            if name == 'dict':
+                expected = cams
+        assert cams == expected, 'Plan cameras differ'
+
+        source.write_text(source.read_text().replace('"600"', '"660"'))
+        started = time.perf_counter()
+        index.refresh()
+        print(f'      rebuild: {(time.perf_counter() - started) * 1000:7.0f}ms after stations.json changed')
+        assert 11.0 in {tz for region in range(1, args.regions + 1) for _, _, _, tz in index.cams(region)}
+        index.close()
+    print('plan cameras identical')
+
+
+if __name__ == '__main__':
+    main()
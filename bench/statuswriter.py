@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmark: переходов статуса в секунду при синхронной записи json из event loop
+(как раньше в taskloop.runtask) и через statuswriter.StatusWriter.
+
+    ./bench/statuswriter.py --tasks 1000 --transitions 10
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import statuswriter
+
+
+def legacy(tasks_dir, ids, transitions):
+    for n in range(transitions):
+        for id in ids:
+            file = Path(tasks_dir) / f'{id}.json'
+            json.dump({'type': 'download', 'status': f's{n}'}, open(file, 'w'), indent=2)
+            
+
+def writer(tasks_dir, ids, transitions):
+    w = statuswriter.StatusWriter(tasks_dir)
+    started = time.perf_counter()
+    for n in range(transitions):
+        for id in ids:
+            w.put(id, {'type': 'download', 'status': f's{n}'})
+    blocking = time.perf_counter() - started
+    w.close()
+    assert statuswriter.load(Path(tasks_dir) / f'{ids[0]}.json')['status'] == f's{transitions-1}'
+    return blocking, w.written
+    
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--transitions', type=int, default=10)
+    args = parser.parse_args()
+    
+    ids = [f'task{n}' for n in range(args.tasks)]
+    total = args.tasks * args.transitions
+    
+    with tempfile.TemporaryDirectory() as tasks_dir:
+        started = time.perf_counter()
+        legacy(tasks_dir, ids, args.transitions)
+        elapsed = time.perf_counter() - started
+        print(f'legacy json.dump:  {total / elapsed:>12.0f} transitions/s'
+              f' (event loop blocked {elapsed:.3f}s)')
+        
+    with tempfile.TemporaryDirectory() as tasks_dir:
+        started = time.perf_counter()
+        blocking, written = writer(tasks_dir, ids, args.transitions)
+        elapsed = time.perf_counter() - started
+        print(f'StatusWriter:      {total / elapsed:>12.0f} transitions/s'
+              f' (event loop blocked {blocking:.3f}s, {written} files written)')
+    
+
+if __name__ == '__main__':
+    main()
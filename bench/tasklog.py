@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Benchmark: --tasks тасков одновременно пишут в лог на уровне DEBUG по --records
+записей, в среднем раз в --period секунд. Сравнивается прежний sink (open/write/close на каждую запись) и
+буферизованный TaskLogSink: записей в секунду и задержка event loop.
+Проверяется что содержимое логов тасков совпадает.
+
+    ./bench/tasklog.py --tasks 1000 --records 50
+"""
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import loguru
+
+
+def open_per_record_sink(directory):
+    """ Прежний tasks.tools.tasklogsink. """
+    def sink(message):
+        taskid = message.record["extra"].get("taskid")
+        if taskid:
+            with open(Path(directory) / f'{taskid}.log', 'a') as file:
+                file.write(message)
+    return sink
+
+
+async def task(n, records, spent, period):
+    log = loguru.logger.bind(taskid=f'task{n}')
+    for i in range(records):
+        started = time.perf_counter()
+        log.debug(f'segment {n} attempt {i}: checking gaps')
+        spent.append(time.perf_counter() - started)
+        await asyncio.sleep(random.uniform(0, 2 * period))
+
+
+async def monitor(lags, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+
+
+async def run(name, tasks, records, period, finish=None):
+    """ 
+    Каждый таск пишет запись в среднем раз в period секунд. records/s - сколько 
+    записей в секунду успевает записать sink (по времени внутри вызовов логгера).
+    """
+    random.seed(0)
+    lags, spent = [], []
+    ticker = asyncio.ensure_future(monitor(lags))
+    await asyncio.sleep(0)
+
+    async def one(n):
+        await task(n, records, spent, period)
+        if finish:
+            finish(f'task{n}')
+    await asyncio.gather(*[one(n) for n in range(tasks)])
+    ticker.cancel()
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    print(f'{name:>10}: {len(spent) / sum(spent):9.0f} records/s, loop lag p99 {p99 * 1000:6.1f}ms, '
+          f'max {max(lags or [0]) * 1000:6.1f}ms')
+
+
+def main():
+    from tasks.logsink import TaskLogSink
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--records', type=int, default=50)
+    parser.add_argument('--period', type=float, default=0.2, help='Секунд между записями таска.')
+    args = parser.parse_args()
+
+    logs = []
+    with tempfile.TemporaryDirectory() as old, tempfile.TemporaryDirectory() as new:
+        loguru.logger.remove()
+        handler = loguru.logger.add(open_per_record_sink(old), format='{extra[taskid]} {message}',
+                                    level='DEBUG')
+        asyncio.run(run('per-record', args.tasks, args.records, args.period))
+        loguru.logger.remove(handler)
+
+        sink = TaskLogSink(lambda taskid: Path(new) / f'{taskid}.log')
+        handler = loguru.logger.add(sink, format='{extra[taskid]} {message}', level='DEBUG')
+        asyncio.run(run('buffered', args.tasks, args.records, args.period, finish=sink.finish))
+        started = time.perf_counter()
+        sink.close()
+        print(f'buffered: remaining records written in {time.perf_counter() - started:.3f}s on close')
+        loguru.logger.remove(handler)
+
+        for n in range(args.tasks):
+            logs.append((Path(old) / f'task{n}.log').read_text() == (Path(new) / f'task{n}.log').read_text())
+    assert all(logs), 'Logs differ'
+    print('logs identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,45 +7,55 @@ from itertools import chain
 from app_state import state
 from fastapi import FastAPI, HTTPException
 from loguru import logger
+from starlette.responses import PlainTextResponse
 #from pydantic import BaseModel
-from uvicorn import Server, Config
 
 queue = asyncio.Queue()
 
 app = FastAPI()
 
 import tasks.download
+import tasks.metrics
 import aiopool
+import limiter
 import utils
 
 
-async def process_queue(download=True, merge=True, export=True):
-    from utils import stations
-    from planner import plan_cams, spawn_download
+async def process_queue(download=True, merge=True, export=True, pipeline=False):
+    from planner import start_plan, download_jobs, merge_jobs, pipelined
+    feeders = {}
+    camjobs = {'download': download_jobs, 'merge': merge_jobs}
+    if download:
+        state._downloadpool = aiopool.Pool(state._config.num_download_workers, keep_tasks=False)
+        tasks.metrics.register_pool('download', state._downloadpool)
+        state._downloadfeeder = feeders['download'] = aiopool.Feeder(
+            state._downloadpool, lookahead=state._downloadpool.limit)
+        limiter.start_download_limiter(state._downloadpool)
+    if merge or (download and pipeline):
+        state._mergepool = aiopool.Pool(state._config.num_merge_workers, keep_tasks=False)
+        tasks.metrics.register_pool('merge', state._mergepool)
+    if merge:
+        state._mergefeeder = feeders['merge'] = aiopool.Feeder(state._mergepool)
+    if download and pipeline:
+        camjobs['download'] = pipelined(download_jobs, state._mergepool)
+    for routine, feeder in feeders.items():
+        asyncio.create_task(feed_forever(routine, feeder))
+        
     while True:
         plan = await queue.get()
-        
-        
-        if plan.routine == 'download':
-            if download:
-                state._downloadpool = aiopool.Pool(state._config.num_download_workers)
-                await plan_cams(plan, spawn_download)
-                
-                logger.info(f'Wating for {len(state._downloadpool.tasks)} tasks to complete.')
-                succeeded, failed = 0, 0
-                async for n, task in utils.as_completed(state._downloadpool.tasks):
-                    result = await task
-                    if result is False:
-                        failed += 1
-                    else:
-                        succeeded += 1
-                    if n % 1000 == 0:
-                        logger.info(f'{n} of {len(state._downloadpool.tasks)} completed.'
-                                    f' ({succeeded} ok, {failed} failed.)')
-            else:
-                print('ignoring download plan: ', plan)
+        if plan.routine in feeders:
+            start_plan(plan, camjobs[plan.routine], feeders[plan.routine])
+        else:
+            print(f'ignoring {plan.routine} plan: ', plan)
                 
 
+async def feed_forever(routine, feeder):
+    try:
+        await feeder.run(forever=True)
+    except Exception as e:
+        logger.error(f'Stopped processing {routine} plans: child raised {e!r}')
+        
+
 class Routine(str, Enum):
     download = 'download'
     merge = 'merge'
@@ -55,29 +65,77 @@ class Routine(str, Enum):
 @app.get("/plans/")
 async def read_plans():
     """ Получить список планов. """
-    return [x.as_dict(full=True) for x in state.plans.values()]
+    state._plans.refresh()  # Планы могли измениться командами planner rm, restart, ...
+    return [x.as_dict(full=True) for x in state._plans.values()]
+
+
+@app.get("/progress/")
+async def read_progress():
+    """ Прогресс выполнения: счетчики пулов и сгенерированные/оставшиеся задания планов. """
+    progress = {}
+    for routine in ('download', 'merge'):
+        pool = getattr(state, f'_{routine}pool', None)
+        feeder = getattr(state, f'_{routine}feeder', None)
+        if pool:
+            progress[routine] = {
+                'stats': dict(pool.stats),
+                'limit': pool.limit,
+                'active': pool.active_count,
+                'pending': pool.pending_count,
+                'parked': pool.parked_count,
+                'plans': feeder.progress() if feeder else {},
+            }
+    return progress
+
+
+@app.get("/limiter/")
+async def read_limiter():
+    """ Текущий limit пула загрузок и сигналы, по которым он подстраивается. """
+    downloadlimiter = getattr(state, '_downloadlimiter', None)
+    if not downloadlimiter:
+        raise HTTPException(status_code=404, detail='adaptive download workers disabled')
+    return downloadlimiter.status()
+
+
+@app.get("/metrics")
+async def read_metrics():
+    """ Метрики в текстовом формате Prometheus: задержка event loop, процессы, пулы, фазы тасков. """
+    return PlainTextResponse(tasks.metrics.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.delete("/plans/{id}")
 async def delete_plan(id: int):
     """ Удалить план. """
-    if id in state.plans:
-        del state.plans[id]
-    else:
+    try:
+        state._plans.remove(id)
+    except KeyError:
         raise HTTPException(status_code=404, detail='no such plan')
 
 
 @app.post("/plans/{id}/restart")
 async def restart_plan(id: int):
     """ Перезапустить план. """
-    plan = state.plans.get(id)
-    if plan:
-        plan.finished = False
-        plan._force_restart = True
-        queue.put_nowait(plan)
-        return plan.as_dict()
-    else:
+    try:
+        plan = state._plans.restart(id)
+    except KeyError:
         raise HTTPException(status_code=404, detail='no such plan')
+    plan._force_restart = True
+    queue.put_nowait(plan)
+    return plan.as_dict()
+
+
+@app.post("/plans/{id}/priority")
+async def set_plan_priority(id: int, priority: int):
+    """ Изменить приоритет плана (по умолчанию 1). Действует и на уже ожидающие задания. """
+    try:
+        plan = state._plans.update(id, priority=priority)
+    except KeyError:
+        raise HTTPException(status_code=404, detail='no such plan')
+    for routine in ('download', 'merge'):
+        pool = getattr(state, f'_{routine}pool', None)
+        if pool:
+            pool.set_priority(id, priority)
+    return plan.as_dict()
 
 
 @app.put("/plans/")
@@ -87,25 +145,33 @@ async def add_plan(
         first_uik: int, 
         last_uik: int, 
         hour_start: int = 1, 
-        hour_end: int = 2
+        hour_end: int = 2,
+        priority: int = 1
     ):
     """ 
     Добавить план. 
     """
-    id = max(state.plans or [0]) + 1
-    state.plans[id] = dict(
-        id = id,
+    plan = state._plans.add(
         routine = str(routine),
-        finished = False,
         region = region, 
         first_uik = first_uik, 
         last_uik = last_uik, 
         hour_start = hour_start, 
-        hour_end = hour_end
+        hour_end = hour_end,
+        priority = priority
     )
-    queue.put_nowait(state.plans[id])
-    return state.plans[id].as_dict()
+    queue.put_nowait(plan)
+    return plan.as_dict()
+
+
+server = None
 
 
-server = Server(Config(app))
-server.install_signal_handlers = lambda *a: None  # Do not catch signals
+def get_server():
+    """ uvicorn-сервер веб-api. Создается при первом обращении (planner run), а не при импорте. """
+    global server
+    if server is None:
+        from uvicorn import Server, Config
+        server = Server(Config(app))
+        server.install_signal_handlers = lambda *a: None  # Do not catch signals
+    return server
@@ -0,0 +1,136 @@
+import asyncio
+from collections import deque
+from statistics import median
+
+from app_state import state
+from loguru import logger
+
+
+class AdaptiveLimiter:
+    """
+    Подстраивает limit пула во время работы (AIMD).
+
+    Раз в interval секунд по собранным за это время сигналам:
+    - медианная длительность скачивания сегмента выросла больше чем в latency_tolerance
+      раз относительно базовой (скользящее среднее по спокойным интервалам),
+    - доля скачанных с разрывами сегментов больше max_gap_rate,
+    - диск занят больше чем max_disk_util времени (psutil, busy_time),
+    и если хоть один сработал - limit умножается на backoff, иначе увеличивается на step.
+    Limit всегда в пределах [min_limit, max_limit], начальный - min_limit.
+
+    Сигналы от тасков: `limiter.observe(latency, gaps)`.
+    """
+    def __init__(self, pool, min_limit, max_limit, interval=5, step=10, backoff=0.7,
+                 latency_tolerance=2.0, max_gap_rate=0.2, max_disk_util=0.9, disk=True):
+        self.pool = pool
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.step = step
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.max_gap_rate = max_gap_rate
+        self.max_disk_util = max_disk_util
+        self.disk = disk
+        self.baseline = None  # базовая длительность скачивания
+        self.last = {}  # сигналы последнего интервала
+        self.history = deque(maxlen=100)  # (время, limit, причина)
+        self._latencies = []
+        self._gaps = 0
+        self._disk_counters = self._read_disk()
+        pool.set_limit(min_limit)  # Начинаем с минимума и растем пока нет перегрузки.
+
+    def observe(self, latency, gaps=False):
+        """ Учесть скачанный сегмент: длительность скачивания и были ли разрывы. """
+        self._latencies.append(latency)
+        self._gaps += bool(gaps)
+
+    def _read_disk(self):
+        if not self.disk:
+            return None
+        import psutil
+        try:
+            return psutil.disk_io_counters()
+        except Exception:  # Нет /proc/diskstats, например в контейнере.
+            return None
+
+    def _disk_signals(self, elapsed):
+        """ Скорость записи на диск (байт/с) и доля времени занятости диска. """
+        prev, self._disk_counters = self._disk_counters, self._read_disk()
+        if prev is None or self._disk_counters is None:
+            return None, None
+        write = (self._disk_counters.write_bytes - prev.write_bytes) / elapsed
+        busy = getattr(self._disk_counters, 'busy_time', None)
+        util = None if busy is None else (busy - prev.busy_time) / 1000 / elapsed
+        return write, util
+
+    def update(self, elapsed):
+        """ Пересчитать limit по сигналам, собранным за последние elapsed секунд. """
+        latencies, self._latencies = self._latencies, []
+        gaps, self._gaps = self._gaps, 0
+        write, util = self._disk_signals(elapsed)
+        latency = median(latencies) if latencies else None
+        gap_rate = gaps / len(latencies) if latencies else None
+        self.last = dict(samples=len(latencies), latency=latency, gap_rate=gap_rate,
+                         disk_write=write, disk_util=util)
+
+        reasons = []
+        if latency is not None and self.baseline and latency > self.baseline * self.latency_tolerance:
+            reasons.append(f'latency {latency:.1f}s > {self.latency_tolerance} x {self.baseline:.1f}s')
+        if gap_rate is not None and gap_rate > self.max_gap_rate:
+            reasons.append(f'gap rate {gap_rate:.0%}')
+        if util is not None and util > self.max_disk_util:
+            reasons.append(f'disk busy {util:.0%}')
+
+        old = self.pool.limit
+        if reasons:
+            new = int(old * self.backoff)
+        else:
+            if latency is not None:
+                self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+            # Без сигналов (нет завершенных тасков) limit не растет.
+            new = old + self.step if latencies else old
+        new = max(self.min_limit, min(new, self.max_limit))
+
+        if new != old:
+            reason = ', '.join(reasons) or 'no congestion'
+            self.history.append((asyncio.get_running_loop().time(), new, reason))
+            logger.info(f'Download workers limit {old} -> {new}: {reason}. '
+                        f'({self.pool.active_count} active, {self.pool.pending_count} pending)')
+            self.pool.set_limit(new)
+        return new
+
+    def status(self):
+        return dict(
+            limit=self.pool.limit, min_limit=self.min_limit, max_limit=self.max_limit,
+            baseline_latency=self.baseline, last=self.last,
+            history=[dict(time=t, limit=l, reason=r) for t, l, r in self.history],
+        )
+
+    async def run(self):
+        """ Подстраивать limit пока пул не закрыт. """
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        while not self.pool._closed:
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.update(now - last)
+            last = now
+
+
+def start_download_limiter(pool):
+    """
+    Если включена опция --adaptive-download-workers, запустить AdaptiveLimiter
+    для пула pool в пределах [--min-download-workers, --num-download-workers].
+    """
+    config = state._config
+    if not config.get('adaptive_download_workers'):
+        return None
+    limiter = state._downloadlimiter = AdaptiveLimiter(
+        pool,
+        min_limit = config.min_download_workers,
+        max_limit = config.num_download_workers,
+        max_gap_rate = config.max_download_gap_rate,
+    )
+    asyncio.create_task(limiter.run())
+    return limiter
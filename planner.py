@@ -6,156 +6,233 @@ import os
 import sys
 from asyncio import gather, create_task, get_running_loop, as_completed
 from datetime import timedelta, timezone
+from itertools import chain
 from os.path import exists
 from pathlib import Path
 
-import environ
 import click
 from app_state import state
 from loguru import logger
 from click import Context, confirm, command, option, group, argument
-from psutil import Process
 
 Context.get_usage = Context.get_help  # show full help on error
 
 #from threadpool import Pool
-import aiopool
+import planstore
 import utils
-import tasks.download
-import tasks.merge
+import tasks.metrics
 import tasks.tools
+# aiopool, limiter, tasks.download, tasks.merge, tasks.parsers и веб-сервер (churoweb)
+# импортируются командами, которым они нужны: show, add, rm и т.п. их не загружают.
         
         
-async def spawn_download(uik, camnum, camid, plan, tz):
+async def logged(coro, **extra):
+    """ Выполнить coro с логгером, дополненным полями extra. """
+    tasks.tools.logger.bind(**extra)
+    return await coro
+
+
+def download_jobs(plan, uik, camnum, camid, tz):
+    """ 
+    Iterate over segment download jobs of camera. 
+    Yields (job, deadline), deadline - когда сегмент пропадет с источника.
+    """
     tmpdir = Path(state._config.tmp_download_dir) / camid
     dstdir = Path(state._config.downloaded_dir) / f'{plan["region"]}/{uik}-c{camnum}-{camid}'
     
-    if not exists(tmpdir): os.makedirs(tmpdir)
-    if not exists(dstdir): os.makedirs(dstdir)
+    with tasks.metrics.timer('blocking_seconds', op='makedirs'):
+        if not exists(tmpdir): os.makedirs(tmpdir)
+        if not exists(dstdir): os.makedirs(dstdir)
     
     date = state._config.elect_date.replace(tzinfo=timezone(timedelta(hours=tz))) 
-    
-    log = tasks.tools.logger.bind(region=plan['region'], uik=uik, camnum=camnum)
-    segments = []
+    retention = timedelta(hours=state._config.source_retention_hours)
     
     for hour in range(plan['hour_start'], plan['hour_end']):
         for minute in (0, 15, 30, 45):
-            segments.append(await state._downloadpool.spawn(tasks.download.process_segment(
+            timestart = date.replace(hour=hour, minute=minute)
+            yield logged(tasks.download.process_segment(
                 camid, 
                 dst = dstdir / f'{camid}-{hour}-{minute}-{plan["id"]}.flv',
                 tmp = tmpdir / f'{camid}-{hour}-{minute}-{plan["id"]}.flv',
-                timestart = date.replace(hour=hour, minute=minute),
+                timestart = timestart,
                 max_retries = state._config.max_download_retries,
                 #force = plan, '_force_restart', state._config.force_download)
                 force = state._config.force_download
-            )))
+            ), region=plan['region'], uik=uik, camnum=camnum), (timestart + retention).timestamp()
             
-    return segments
+download_jobs.per_camera = lambda plan: 4 * max(0, plan['hour_end'] - plan['hour_start'])
+
 
-async def spawn_merge(uik, camnum, camid, plan, tz):
-    log = tasks.tools.logger.get()
+def merge_jobs(plan, uik, camnum, camid, tz):
+    """ Iterate over merge jobs of camera. """
     srcdir = Path(state._config.downloaded_dir) / f'{plan.region}/{uik}-c{camnum}-{camid}'
     
     tmpdir = Path(state._config.tmp_merge_dir) / f'{plan.region}'
     dstdir = Path(state._config.merged_dir) / f'{plan.region}'
-    if not exists(tmpdir): os.makedirs(tmpdir)
-    if not exists(dstdir): os.makedirs(dstdir)
+    with tasks.metrics.timer('blocking_seconds', op='makedirs'):
+        if not exists(tmpdir): os.makedirs(tmpdir)
+        if not exists(dstdir): os.makedirs(dstdir)
     
-    job = await state._mergepool.spawn(tasks.merge.merge_camdir(
+    yield logged(tasks.merge.merge_camdir(
         srcdir,
         tmp = tmpdir / f'{uik}-c{camnum}-{camid}.mp4',
         dst = dstdir / f'{uik}-c{camnum}-{camid}.mp4',
-        force = getattr(plan, '_force_restart', False)
-    ))
-    return [job]
+        force = getattr(plan, '_force_restart', False),
+        concurrency = state._config.merge_hash_workers,
+        window = state._config.merge_overlap_window,
+        incremental = state._config.merge_incremental,
+    ), region=plan.region, uik=uik, camnum=camnum)
+    
+merge_jobs.per_camera = lambda plan: 1
+
 
+def pipelined(camjobs, mergepool):
+    """
+    Задания камер camjobs, по завершении всех заданий камеры её склейка (merge_jobs)
+    сразу ставится в mergepool, не дожидаясь остальных камер и планов.
+    Допустимы ли разрывы для склейки, проверяет merge_camdir.
+    """
+    def jobs(plan, uik, camnum, camid, tz):
+        def merge():
+            if mergepool._closed or getattr(state, '_stopping', False):
+                return
+            logger.debug(f'Plan {plan.id}: camera {camid} downloaded, merging.')
+            for job in merge_jobs(plan, uik, camnum, camid, tz):
+                create_task(mergepool.spawn(job, plan=plan.id))
+        return utils.when_done(camjobs(plan, uik, camnum, camid, tz), camjobs.per_camera(plan), merge)
+    jobs.per_camera = camjobs.per_camera
+    # Камеры по очереди, а не вперемешку, чтобы склейки начинались как можно раньше.
+    jobs.order = chain.from_iterable
+    return jobs
 
 
+def plan_cams(plan):
+    """ Камеры плана: [(uik, camnum, camid, tz), ...] или None если регион неизвестен. """
+    stations = utils.stations_index()
+    if plan.region not in stations:
+        logger.warning(f'Plan#{plan.id} has unknown region {plan.region}.')
+        return None
+    
+    if not stations.uiks(plan.region, plan.first_uik, plan.last_uik):
+        logger.warning(f'Plan {plan.id}: No such uiks {plan.first_uik}-{plan.last_uik} in region {plan.region}.')
+        
+    return stations.cams(plan.region, plan.first_uik, plan.last_uik)
     
-async def plan_cams(plan, camroutine):
+    
+def start_plan(plan, camjobs, feeder):
+    """ Передать задания плана в feeder. Задания генерируются по мере освобождения пула. """
     plan._active = True
     logger.info(f'Processing new {plan.routine} plan: {plan}')
     
-    if plan.region not in utils.stations():
-        logger.warning(f'Plan#{plan.id} has unknown region {plan.region}.')
+    cams = plan_cams(plan)
+    if cams is None:
         return
-    uiks = utils.stations()[plan.region]
-    num_cams = 0
-    jobs = []
+    num_jobs = len(cams) * camjobs.per_camera(plan)
+    logger.info(f'Plan {plan.id}: {len(cams)} cameras to process. ({num_jobs} jobs)')
     
-    if not set(range(plan.first_uik, plan.last_uik + 1)) & set(uiks):
-        logger.warning(f'Plan {plan.id}: No such uiks {plan.first_uik}-{plan.last_uik} in region {plan.region}.')
-        
-    for uik in sorted(uiks):
-        if not (plan.first_uik <= uik <= plan.last_uik):
-            continue
-        tz = int(uiks[uik]['timezone_offset_minutes']) / 60
-        for camnum, camid in enumerate(sorted(uiks[uik]['camera_id']), 1):
-            num_cams += 1
-            jobs += (await camroutine(uik, camnum, camid, plan, tz))
-        
-    logger.info(f'Plan {plan.id}: {num_cams} cameras to process. ({len(jobs)} jobs)')
-    #asyncio.gather(*[x.wait() for x in jobs])
-    create_task(planwatch(plan, jobs))
+    # Камеры чередуются, чтобы ранние сегменты всех камер шли раньше поздних
+    # (если camjobs не задает свой порядок, см. pipelined).
+    order = getattr(camjobs, 'order', utils.roundrobin)
+    jobs = order(camjobs(plan, *cam) for cam in cams)
+    feeder.pool.set_priority(plan.id, plan.get('priority', 1))
+    feeder.add(plan.id, jobs, total=num_jobs)
+    create_task(planwatch(plan, feeder))
     
 
-async def planwatch(plan, jobs):
+async def planwatch(plan, feeder):
     try:
-        await asyncio.gather(*[x._do_wait(timeout=None) for x in jobs])
+        await feeder.wait_fed(plan.id)
+        stats = await feeder.pool.drain(plan.id)
     except Exception as e:
         plan._active = False
         logger.error(f'Plan {plan.id} failed: child raised {e!r}')
         return
     
     plan._active = False
-    plan.finished = True
-    logger.info(f'Plan finished {plan}')
+    state._plans.progress(plan.id, **stats)
+    state._plans.finish(plan.id)
+    logger.info(f'Plan finished {plan}: {dict(stats)}')
+
+
+async def journal_progress(interval=60):
+    """ Сохранять в журнал планов счетчики выполняемых планов раз в interval секунд. """
+    while True:
+        await asyncio.sleep(interval)
+        for routine in ('download', 'merge'):
+            pool = getattr(state, f'_{routine}pool', None)
+            for plan in list(state._plans.values()) if pool else []:
+                if getattr(plan, '_active', False) and pool.plans.get(plan.id):
+                    state._plans.progress(plan.id, **pool.plans[plan.id])
     
 
     
-async def plans_run(download, merge, export):
+async def plans_run(download, merge, export, pipeline=False):
+    import aiopool
     import churoweb
+    import limiter
+    import tasks.download
+    import tasks.merge
+    import tasks.parsers
     #asyncio.set_child_watcher(asyncio.FastChildWatcher())
     
     state._num_terminated = 0
     
     churoweb.queue = asyncio.Queue()
-    server = create_task((churoweb.server.serve()))
+    server = create_task((churoweb.get_server().serve()))
     
-    finished = [x for x in state.plans.values() if x.finished]
+    finished = [x for x in state._plans.values() if x.finished]
     print(f'Ignoring {len(finished)} finished plans.')
     
-    unfinished = [x for x in state.plans.values() if not x.finished]
+    unfinished = [x for x in state._plans.values() if not x.finished]
     print(f'{len(unfinished)} plans to process.')
     
+    tasks.parsers.setup(state._config.parser_workers)
+    tasks.metrics.start()  # Метрики отдаются веб-сервером по /metrics.
+    create_task(journal_progress())
+    if download:
+        tasks.download.setup_engine(
+            state._config.download_engine, 
+            state._config.download_url,
+            connections_per_host = state._config.download_connections_per_host,
+            host_rate = state._config.download_host_rate,
+            total_rate = state._config.download_total_rate,
+        )
+    
     try:
+        if download and pipeline:
+            # Склейки камер идут в своем пуле одновременно с загрузками.
+            mergepool = state._mergepool = aiopool.Pool(
+                state._config.num_merge_workers, keep_tasks=False)
+            tasks.metrics.register_pool('merge', mergepool)
         if download:
-            state._downloadpool = aiopool.Pool(state._config.num_download_workers)
-            #state._downloadpool = aiopool.Pool(1000)
-            plans = [x for x in unfinished if x.routine == 'download']
-            await gather(*[
-                create_task(plan_cams(plan, spawn_download)) for plan in plans
-            ])
-            succeeded, failed = 0, 0
-            logger.info(f'Wating for {len(state._downloadpool.tasks)} tasks to complete.')
-            async for n, task in utils.as_completed(state._downloadpool.tasks):
-                result = await task
-                if result is False:
-                    failed += 1
-                else:
-                    succeeded += 1
-                if n % 1000 == 0:
-                    logger.info(f'{n} of {len(state._downloadpool.tasks)} completed.'
-                                f' ({succeeded} ok, {failed} failed.)')
-            logger.info('All download plans finished.')
+            pool = state._downloadpool = aiopool.Pool(
+                state._config.num_download_workers, keep_tasks=False)
+            tasks.metrics.register_pool('download', pool)
+            feeder = state._downloadfeeder = aiopool.Feeder(pool, lookahead=pool.limit)
+            limiter.start_download_limiter(pool)
+            camjobs = pipelined(download_jobs, mergepool) if pipeline else download_jobs
+            for plan in unfinished:
+                if plan.routine == 'download':
+                    start_plan(plan, camjobs, feeder)
+            await feeder.run()
+            logger.info(f'Wating for {pool.progress()}')
+            await pool.drain(heartbeat=10)
+            logger.info(f'All download plans finished. {pool.progress()}')
+            if pipeline:
+                logger.info(f'Wating for merges: {mergepool.progress()}')
+                await mergepool.drain(heartbeat=10)
+                logger.info(f'All cameras merged. {mergepool.progress()}')
             
         if merge:
-            state._mergepool = aiopool.Pool(state._config.num_merge_workers)
-            plans = [x for x in unfinished if x.routine == 'merge']
-            await gather(*[
-                create_task(plan_cams(plan, spawn_merge)) for plan in plans
-            ])
-            await gather(*state._mergepool.tasks)
+            pool = state._mergepool = aiopool.Pool(
+                state._config.num_merge_workers, keep_tasks=False)
+            tasks.metrics.register_pool('merge', pool)
+            feeder = state._mergefeeder = aiopool.Feeder(pool)
+            for plan in unfinished:
+                if plan.routine == 'merge':
+                    start_plan(plan, merge_jobs, feeder)
+            await feeder.run()
+            await pool.drain(heartbeat=10)
             
         #if export:
             #plans = [x for x in unfinished if x.routine == 'export']
@@ -164,17 +241,22 @@ async def plans_run(download, merge, export):
             #])
     except:
         logger.warning('Error was raised by child. Cancelling all tasks.')
-        await state._downloadpool.close()  # Отменить все таски.
+        for routine in ('download', 'merge'):
+            if getattr(state, f'_{routine}pool', None):
+                await getattr(state, f'_{routine}pool').close()  # Отменить все таски.
         logger.warning(f'{state._num_terminated} subprocesses terminated.')
+        from psutil import Process
         logger.warning(f'{len(Process().children(recursive=True))} child processes still running.')
+        await tasks.download.close_engine()
+        tasks.parsers.setup(0)
         logger.warning('Stopping web server.')
-        churoweb.server.should_exit = True
+        churoweb.get_server().should_exit = True
         await server
         logger.warning('Exit.')
         raise
     
     logger.info('All plans finished. Press ctrl-c to quit webserver.')
-    create_task(churoweb.process_queue(download, merge, export))
+    create_task(churoweb.process_queue(download, merge, export, pipeline))
     await server
 
  
@@ -187,20 +269,39 @@ def cli(loglevel, **kwargs):
     """ Manage plans. """
     tasks.tools.setup_logging(loglevel)
     state._config = kwargs
-    state.autopersist('state.shelve', timeout=1)
-    state.setdefault('plans', {})
+    state._plans = planstore.open_planstore()
     
 
 @cli.command('run', context_settings={'auto_envvar_prefix': 'CHURO'})
 @option('--download', is_flag=True, default=True)
 @option('--merge', is_flag=True, default=False)
 @option('--export', is_flag=True, default=False)
+@option('--pipeline', is_flag=True, default=False,
+        help='Склеивать камеру сразу как скачаны все её сегменты, одновременно с загрузками.')
+@option('--parser-workers', type=int, default=2,
+        help='Кол-во процессов для разбора вывода ffprobe/ffmpeg. 0 - разбирать в основном процессе.')
 # Download options
 @option('--tmp-download-dir', type=click.Path(), required=True)
 @option('--downloaded-dir', type=click.Path(), required=True)
 @option('--num-download-workers', type=int, default=1000)
+@option('--adaptive-download-workers', is_flag=True, default=False,
+        help='Подстраивать кол-во одновременных загрузок по задержкам, разрывам и загрузке диска.')
+@option('--min-download-workers', type=int, default=50,
+        help='Минимум одновременных загрузок для --adaptive-download-workers. Максимум - --num-download-workers.')
+@option('--max-download-gap-rate', type=float, default=0.2,
+        help='Доля сегментов с разрывами, при которой --adaptive-download-workers снижает кол-во загрузок.')
 @option('--max-download-retries', type=int, default=2)
 @option('--force-download/--no-force-download', '-fd', default=False, help='Обнулить счетчик попыток')
+@option('--download-engine', type=click.Choice(['http', 'shell']), default='http',
+        help='Скачивать по http через общий пул соединений или shell-командой.')
+@option('--download-url', help='Шаблон url сегмента: {camid}, {timestart}, {timestamp}, {duration}.')
+@option('--download-connections-per-host', type=int, default=8)
+@option('--download-host-rate', type=float, default=10,
+        help='Запросов в секунду на хост, 0 - без ограничений.')
+@option('--download-total-rate', type=float, default=200,
+        help='Запросов в секунду всего, 0 - без ограничений.')
+@option('--source-retention-hours', type=float, default=24,
+        help='Сколько часов сегмент хранится на источнике. Задает дедлайны загрузки.')
 # Merge options
 @option('--tmp-merge-dir', type=click.Path(), required=True)
 @option('--merged-dir', type=click.Path(), required=True)
@@ -211,32 +312,37 @@ def cli(loglevel, **kwargs):
         help='Суммарное кол-во отсутствующих секунд допустимое для склеивания.')
 @option('--merge-tolerate-incomplete-downloads', is_flag=True, default=False,
         help='Допускать склеивание недокачанных сегментов с разрывами.')
-def cli_plans_run(download, merge, export, **kw):
+@option('--merge-hash-workers', type=int, default=4,
+        help='Кол-во одновременных ffmpeg при поиске перекрытий сегментов.')
+@option('--merge-overlap-window', type=int, default=30,
+        help='Сколько секунд в конце сегмента хэшировать при поиске перекрытия.')
+@option('--merge-incremental', is_flag=True, default=False,
+        help='Дописывать новые сегменты в склеенный файл вместо полной пересборки.')
+def cli_plans_run(download, merge, export, pipeline, **kw):
     """ Process all unfinished plans. """
     state._config.update(kw)
-    asyncio.run(plans_run(download, merge, export))
+    utils.run(plans_run(download, merge, export, pipeline))
     
     
 @cli.command('rm')
 @argument('id', type=int)
 def plans_rm(id):
     """ Delete plan. """
-    del state.plans[id]
+    state._plans.remove(id)
     
     
 @cli.command('restart')
 @argument('id', type=int)
 def plans_restart(id):
     """ Set plan "finished" = false. """
-    state.plans[id].finished = False
+    state._plans.restart(id)
     print(f'Plan {id} successfully changed "finished" to "false"')
-    #print(json.dumps(state.plans[id], indent=2))
     
     
 @cli.command('show')
 def plans_show(**kw):
     """ Print current plans. """
-    print(json.dumps([x.as_dict(full=True) for x in state.plans.values()], indent=2))
+    print(json.dumps([x.as_dict(full=True) for x in state._plans.values()], indent=2))
     
     
 @cli.command('add', context_settings={'auto_envvar_prefix': 'CHURO_PLANS_ADD'})
@@ -248,9 +354,49 @@ def plans_show(**kw):
 @option('--hour-end', type=int, default=8, prompt=True)
 def plans_add(**kw):
     """ Add plan. """
-    id = max(state.plans or [0]) + 1
-    state.plans[id] = dict(kw, id=id, finished=False)
-    print(json.dumps(state.plans[id], indent=2))
+    plan = state._plans.add(**kw)
+    print(json.dumps(plan, indent=2))
+    
+    
+@cli.command('priority')
+@argument('id', type=int)
+@argument('priority', type=int)
+def plans_priority(id, priority):
+    """ Set plan priority (default 1). Higher priority plans are processed first. """
+    state._plans.update(id, priority=priority)
+    print(f'Plan {id} priority set to {priority}')
+    
+    
+@cli.command('mergeable', context_settings={'auto_envvar_prefix': 'CHURO'})
+@option('--region', type=int, required=True)
+@option('--downloaded-dir', type=click.Path(), required=True)
+@option('--merge-08-20-tolerate-gaps-duration', type=int, default=120,
+        help='Суммарное кол-во отсутствующих секунд допустимое для склеивания.')
+@option('--merge-tolerate-incomplete-downloads', is_flag=True, default=False,
+        help='Допускать склеивание недокачанных сегментов с разрывами.')
+@option('--all', 'show_all', is_flag=True, default=False, help='Показать и несклеиваемые камеры.')
+def plans_mergeable(region, downloaded_dir, show_all, **kw):
+    """ List cameras of region which can be merged, by their gap summaries. """
+    import tasks.merge
+    cameras = tasks.merge.mergeable_cameras(
+        Path(downloaded_dir) / f'{region}', 
+        kw['merge_08_20_tolerate_gaps_duration'], 
+        kw['merge_tolerate_incomplete_downloads']
+    )
+    for camdir, ok, gaplength in cameras:
+        if ok or show_all:
+            print(f'{camdir.name}\t{"ok" if ok else "no"}\t{gaplength}')
+    
+    
+@cli.command('gapstats', context_settings={'auto_envvar_prefix': 'CHURO'})
+@option('--region', type=int, required=True)
+@option('--downloaded-dir', type=click.Path(), required=True)
+def plans_gapstats(region, downloaded_dir):
+    """ Print gap statistics of each camera of region for the day (requires numpy). """
+    for camdir in sorted((Path(downloaded_dir) / f'{region}').iterdir()):
+        if camdir.is_dir():
+            stats = tasks.tools.camera_day_stats(tasks.tools.load_gapreports(camdir))
+            print(json.dumps(dict(camera=camdir.name, **stats)))
     
     
 @cli.group('uiks')
@@ -289,11 +435,9 @@ def uiks_merge(*args):
     
     
 if __name__ == '__main__':
+    import environ
     env = environ.Env()
     env.read_env('env-local')
-    
-    import uvloop
-    uvloop.install()
 
     from signal import SIGINT, signal
     signal(SIGINT, utils.sigint_handler)    
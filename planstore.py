@@ -0,0 +1,251 @@
+import fcntl
+import json
+import os
+import shelve
+from contextlib import contextmanager
+from pathlib import Path
+
+from loguru import logger
+
+import tasks.tools
+
+
+class Plan(dict):
+    """
+    План: dict, поля которого доступны и как атрибуты (plan.region).
+    Атрибуты с _ (plan._active) - состояние выполнения, не сохраняются.
+    Поля меняются только через PlanStore, чтобы изменение попало в журнал.
+    """
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            raise AttributeError(f'Plan field "{name}" must be changed through PlanStore')
+        super().__setattr__(name, value)
+
+    def as_dict(self, full=False):
+        return dict(self)
+
+
+class PlanStore:
+    """
+    Планы {id: Plan} в журнале изменений {path}.journal и снимке {path}.snapshot.json.
+
+    Каждое изменение (план добавлен, удален, перезапущен, завершен, изменены поля,
+    счетчики прогресса) дописывается в журнал одной json-строкой, весь набор планов
+    не перезаписывается. Когда в журнале накопилось compact_every записей, планы
+    сохраняются в снимок, а журнал начинается заново (compact). При открытии
+    читается снимок и записи журнала после него. Недописанная при падении последняя
+    строка журнала пропускается.
+
+    Журнал могут дописывать несколько процессов (planner run и команды planner rm,
+    restart, ...): запись и сжатие идут под flock, а перед записью процесс
+    дочитывает чужие записи. refresh() - дочитать без записи.
+
+    Не Mapping: app_state заменил бы его на DictNode при присваивании state._plans.
+    """
+    def __init__(self, path='plans', compact_every=1000):
+        self.path = Path(path)
+        self.journal = Path(f'{path}.journal')
+        self.snapshot = Path(f'{path}.snapshot.json')
+        self.compact_every = compact_every
+        self.plans = {}
+        self.seq = 0  # номер последней примененной записи
+        self.records = 0  # записей в журнале после снимка
+        self._journal = None
+        self._offset = 0
+        self._lockfile = open(f'{path}.lock', 'a')
+        with self._locked():
+            self._load()
+
+    # Чтение.
+
+    def __getitem__(self, id):
+        return self.plans[id]
+
+    def __iter__(self):
+        return iter(self.plans)
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __contains__(self, id):
+        return id in self.plans
+
+    def get(self, id, default=None):
+        return self.plans.get(id, default)
+
+    def values(self):
+        return self.plans.values()
+
+    def refresh(self):
+        """ Применить записи, добавленные в журнал другими процессами. """
+        with self._locked():
+            self._catch_up()
+
+    # Изменения.
+
+    def add(self, **fields):
+        """ Добавить план, вернуть его. id - следующий по порядку. """
+        with self._locked():
+            self._catch_up()
+            id = max(self.plans or [0]) + 1
+            self._append({'op': 'add', 'plan': dict(fields, id=id, finished=False)}, sync=True)
+            return self.plans[id]
+
+    def remove(self, id):
+        with self._locked():
+            self._catch_up()
+            if id not in self.plans:
+                raise KeyError(id)
+            self._append({'op': 'remove', 'id': id}, sync=True)
+
+    def update(self, id, sync=True, **fields):
+        """ Изменить поля плана. """
+        with self._locked():
+            self._catch_up()
+            if id not in self.plans:
+                raise KeyError(id)
+            self._append({'op': 'update', 'id': id, 'fields': fields}, sync=sync)
+            return self.plans[id]
+
+    def restart(self, id):
+        return self.update(id, finished=False)
+
+    def finish(self, id):
+        return self.update(id, finished=True)
+
+    def progress(self, id, **counters):
+        """ Сохранить счетчики прогресса плана (plan.progress). Без fsync. """
+        if id in self.plans:
+            self.update(id, sync=False, progress=counters)
+
+    # Журнал.
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'add':
+            plan = Plan(record['plan'])
+            self.plans[plan['id']] = plan
+        elif op == 'remove':
+            self.plans.pop(record['id'], None)
+        elif op == 'update':
+            plan = self.plans.get(record['id'])
+            if plan is not None:
+                dict.update(plan, record['fields'])
+        self.seq = record['seq']
+
+    def _load(self):
+        """ Прочитать снимок и журнал заново. """
+        old = self.plans
+        self.plans, self.seq, self.records = {}, 0, 0
+        try:
+            with open(self.snapshot) as f:
+                snapshot = json.load(f)
+            self.plans = {plan['id']: Plan(plan) for plan in snapshot['plans']}
+            self.seq = snapshot['seq']
+        except FileNotFoundError:
+            pass
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self.journal, 'a+b')
+        self._offset = 0
+        self._catch_up()
+        # Объекты планов сохраняются, чтобы не терялись атрибуты выполнения (plan._active).
+        for id, plan in self.plans.items():
+            if id in old:
+                dict.clear(old[id])
+                dict.update(old[id], plan)
+                self.plans[id] = old[id]
+
+    def _catch_up(self):
+        try:
+            ino = os.stat(self.journal).st_ino
+        except FileNotFoundError:
+            ino = None  # Журнал удален: считать пустым, _load создаст новый.
+        if ino != os.fstat(self._journal.fileno()).st_ino:
+            return self._load()  # Журнал сжат другим процессом.
+        self._journal.seek(self._offset)
+        for line in self._journal:
+            if not line.endswith(b'\n'):
+                break  # Недописанная запись.
+            self._offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.error(f'Malformed record in {self.journal}: {line!r}')
+                continue
+            if record['seq'] > self.seq:
+                self._apply(record)
+                self.records += 1
+
+    def _append(self, record, sync=True):
+        record = dict(record, seq=self.seq + 1)
+        line = (json.dumps(record) + '\n').encode()
+        self._journal.seek(0, os.SEEK_END)
+        if self._journal.tell() != self._offset:
+            # Обрывок записи упавшего процесса: новая запись начинается с новой строки.
+            line = b'\n' + line
+        self._journal.write(line)
+        self._journal.flush()
+        if sync:
+            os.fsync(self._journal.fileno())
+        self._offset = self._journal.tell()
+        self._apply(record)
+        self.records += 1
+        if self.records >= self.compact_every:
+            self._compact()
+
+    def compact(self):
+        """ Сохранить планы в снимок и начать журнал заново. """
+        with self._locked():
+            self._catch_up()
+            self._compact()
+
+    def _compact(self):
+        tasks.tools.dump_json({'seq': self.seq, 'plans': list(self.plans.values())}, self.snapshot)
+        tmp = self.journal.with_name(f'.{self.journal.name}.tmp')
+        open(tmp, 'wb').close()
+        os.replace(tmp, self.journal)
+        self._load()
+        logger.debug(f'Plan journal compacted: {len(self.plans)} plans, seq {self.seq}.')
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        self._lockfile.close()
+
+
+def open_planstore(path='plans', shelve_file='state.shelve'):
+    """
+    Открыть журнал планов. Если его еще нет, а есть прежнее хранилище state.shelve
+    (app_state autopersist), перенести планы из него.
+    """
+    store = PlanStore(path)
+    if not store and not store.seq:
+        try:
+            with shelve.open(str(shelve_file), flag='r') as db:
+                plans = dict(db.get('state', {}).get('plans', {}))
+        except Exception:  # Нет файла (или dbm не может его открыть).
+            plans = {}
+        for id, plan in sorted(plans.items()):
+            with store._locked():
+                store._append({'op': 'add', 'plan': dict(plan, id=id)})
+        if plans:
+            logger.info(f'{len(plans)} plans imported from {shelve_file}.')
+    return store
@@ -0,0 +1,116 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+from loguru import logger
+
+
+class StationsIndex:
+    """
+    Индекс stations.json в SQLite: для каждого региона УИК по порядку, их часовой пояс
+    и камеры.
+
+    Индекс строится из json один раз и перестраивается, если у json изменились mtime
+    или размер (проверяется при открытии и в refresh). Выборка камер диапазона УИК
+    идет по первичному ключу (region, uik), без загрузки всех участков в память.
+    """
+    def __init__(self, source, path=None):
+        self.source = Path(source)
+        self.path = Path(path or self.source.with_suffix('.sqlite'))
+        self.db = None
+        self.refresh()
+
+    def refresh(self):
+        """ Перестроить индекс, если json изменился. """
+        stat = os.stat(self.source)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if self.db and self.version == version:
+            return
+        if self.db:
+            self.db.close()
+            self.db = None
+        if not self._open(version):
+            self._build(stat)
+            self._open(version)
+        self.version = version
+
+    def _open(self, version):
+        """ Открыть индекс, если он построен по текущей версии json. """
+        try:
+            db = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        except sqlite3.Error:
+            return False
+        try:
+            built = db.execute('SELECT mtime_ns, size FROM source').fetchone()
+        except sqlite3.Error:
+            built = None
+        if built != version:
+            db.close()
+            return False
+        self.db = db
+        return True
+
+    def _build(self, stat):
+        logger.info(f'Building stations index {self.path} from {self.source}.')
+        with open(self.source) as f:
+            stations = json.load(f)
+        # Другой процесс может читать прежний индекс: строим рядом и подменяем.
+        tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        db = sqlite3.connect(str(tmp))
+        try:
+            db.executescript('''
+                CREATE TABLE stations (
+                    region INTEGER,
+                    uik INTEGER,
+                    tz REAL,
+                    cameras TEXT NOT NULL,
+                    PRIMARY KEY (region, uik)
+                ) WITHOUT ROWID;
+                CREATE TABLE source (mtime_ns INTEGER, size INTEGER);
+            ''')
+            db.executemany('INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?)', (
+                (x.get('region_number'), x.get('station_number'),
+                 int(x['timezone_offset_minutes']) / 60, json.dumps(sorted(x['camera_id'])))
+                for x in stations
+            ))
+            db.execute('INSERT INTO source VALUES (?, ?)', (stat.st_mtime_ns, stat.st_size))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.db.close()
+
+    def __contains__(self, region):
+        return self.db.execute('SELECT 1 FROM stations WHERE region = ? LIMIT 1', (region,)).fetchone() is not None
+
+    def regions(self):
+        return [x for x, in self.db.execute('SELECT DISTINCT region FROM stations ORDER BY region')]
+
+    def uiks(self, region, first=None, last=None):
+        """ Номера УИК региона по порядку, в диапазоне first-last включительно. """
+        return [x for x, in self._range('uik', region, first, last)]
+
+    def timezone(self, region, uik):
+        """ Смещение часового пояса УИК в часах или None. """
+        row = self.db.execute('SELECT tz FROM stations WHERE region = ? AND uik = ?', (region, uik)).fetchone()
+        return row and row[0]
+
+    def cameras(self, region, uik):
+        row = self.db.execute('SELECT cameras FROM stations WHERE region = ? AND uik = ?', (region, uik)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def cams(self, region, first=None, last=None):
+        """ Камеры диапазона УИК: [(uik, camnum, camid, tz), ...] по порядку УИК. """
+        cams = []
+        for uik, tz, cameras in self._range('uik, tz, cameras', region, first, last):
+            for camnum, camid in enumerate(json.loads(cameras), 1):
+                cams.append((uik, camnum, camid, tz))
+        return cams
+
+    def _range(self, columns, region, first, last):
+        return self.db.execute(
+            f'SELECT {columns} FROM stations WHERE region = ? AND uik BETWEEN ? AND ? ORDER BY uik',
+            (region, -2**63 if first is None else first, 2**63 - 1 if last is None else last))
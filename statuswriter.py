@@ -0,0 +1,137 @@
+import atexit
+import json
+import os
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+import tasks.tools
+
+
+def load(file):
+    """ Прочитать json-файл таска. """
+    with open(file) as f:
+        return json.load(f)
+
+
+class StatusWriter:
+    """
+    Фоновая запись статусов тасков в {tasks_dir}/{id}.json.
+    
+    Обновления одного таска схлопываются - на диск попадает только последнее.
+    Фоновый поток записывает накопленные обновления пачкой раз в interval секунд,
+    или сразу как накопилось batch_size тасков. Каждый файл пишется атомарно.
+    Если передан store (taskstore.TaskStore), записанные статусы попадают и в индекс.
+    Статусы захваченных тасков (fences[id] - fencing-токен захвата, см. TaskStore.claim) 
+    пишутся только если токен еще действителен, иначе отбрасываются. Их json и строка 
+    индекса записываются в одной транзакции с проверкой токена (TaskStore.put_fenced),
+    токен завершенного таска удаляется.
+    """
+    def __init__(self, tasks_dir, interval=0.5, batch_size=1000, store=None):
+        self.tasks_dir = Path(tasks_dir)
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.rejected = 0
+        self.fences = {}  # id -> fencing-токен
+        self._pending = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._io = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='statuswriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        
+    def put(self, id, taskinfo):
+        """ Поставить статус таска в очередь на запись. Не блокирует event loop. """
+        with self._cond:
+            self._pending[id] = dict(taskinfo)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+                
+    def get(self, id):
+        """ Последний статус таска с учетом еще не записанных обновлений. """
+        with self._cond:
+            if id in self._pending:
+                return dict(self._pending[id])
+        return load(self.tasks_dir / f'{id}.json')
+    
+    def flush(self):
+        """ Записать все накопленные обновления. """
+        with self._io:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            fenced = [(id, taskinfo, self.fences[id]) for id, taskinfo in batch.items() 
+                      if id in self.fences]
+            if fenced:
+                self._put_fenced(fenced)
+                for id, _, _ in fenced:
+                    del batch[id]
+            written = []
+            for id, taskinfo in batch.items():
+                file = self.tasks_dir / f'{id}.json'
+                tasks.tools.dump_json(taskinfo, file)
+                written.append((id, taskinfo, os.stat(file)))
+            # Сохранить сами переименования.
+            fd = os.open(self.tasks_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.written += len(written)
+            if self.store and written:
+                self.store.put_many(written)
+                
+    def _put_fenced(self, fenced):
+        """ 
+        Записать статусы захваченных тасков [(id, taskinfo, fence), ...]. Json пишутся 
+        во временные файлы заранее, а в транзакции put_fenced только переименовываются.
+        """
+        tmps = {}
+        
+        def write(id):
+            file = self.tasks_dir / f'{id}.json'
+            os.replace(tmps.pop(id), file)
+            return os.stat(file)
+        
+        try:
+            for id, taskinfo, fence in fenced:
+                tmps[id] = tasks.tools.dump_json_tmp(taskinfo, self.tasks_dir / f'{id}.json')
+            accepted = set(self.store.put_fenced(fenced, write))
+        finally:
+            for tmp in tmps.values():
+                os.unlink(tmp)
+        for id, taskinfo, fence in fenced:
+            if id not in accepted:
+                logger.warning(f'Task {id} was claimed by another node, '
+                               f'status "{taskinfo.get("status")}" discarded.')
+                self.rejected += 1
+            elif taskinfo.get('status') != 'running' and self.fences.get(id) == fence:
+                del self.fences[id]  # Аренда освобождена (см. put_fenced).
+        self.written += len(accepted)
+            
+    def close(self):
+        """ Записать все и остановить фоновый поток. """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.batch_size,
+                    timeout=self.interval
+                )
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f'Failed to write task statuses: {e!r}')
@@ -3,32 +3,32 @@ import asyncio
 import json
 import logging
 import os
+import time
 from datetime import datetime
 from pathlib import Path
 from os.path import exists
 
-from aiojobs import create_scheduler
 from app_state import state
 from asyncio import gather, create_task, get_running_loop, as_completed
 from click import Context, confirm, command, option, group, argument, progressbar
 from loguru import logger
 
-import environ
 import click
 
 Context.get_usage = Context.get_help  # show full help on error
 
-import aiopool
+import statuswriter
+import taskstore
 import utils
-import tasks.download
-import tasks.merge
+import tasks.metrics
 import tasks.tools
+# aiopool, limiter, tasks.download, tasks.merge, tasks.parsers (aiohttp, aiojobs,
+# ffmpeg-обвязка) импортируются в process_tasks: командам fail-running, index они не нужны.
 
         
 async def runtask(id, taskinfo, routine):
     """ Запустить таск, записать статус running/finished/failed в json. """
-    file = Path(state._config.tasks_dir) / f'{id}.json'
-    json.dump(dict(taskinfo, status='running'), open(file, 'w'), indent=2)
+    state._statuswriter.put(id, dict(taskinfo, status='running'))
     
     tasks.tools.logger.bind(taskid=id)
     
@@ -44,12 +44,13 @@ async def runtask(id, taskinfo, routine):
             logger.info(f'Task {id} entered status "failed".')
         else:
             logger.debug(f'Task {id} entered status "finished".')
-        json.dump(taskinfo, open(file, 'w'), indent=2)
+        state._statuswriter.put(id, taskinfo)
+        tasks.tools.finish_tasklog(id)
 
 
 async def spawn_export(pool, taskinfo, id):
     logger.debug(f'New export task "{taskinfo["cmd"]}"')
-    await pool.spawn(runtask(id, taskinfo, tasks.tools.sh(
+    return await pool.spawn(runtask(id, taskinfo, tasks.tools.sh(
         taskinfo['cmd'], log_stdout=True, raise_error=False
     )))
         
@@ -59,17 +60,21 @@ async def spawn_merge(pool, taskinfo, id):
     
     tmpdir = Path(state._config.tmp_merge_dir) / camid
     dstdir = Path(state._config.merged_dir) / camid
-    if not exists(tmpdir): os.makedirs(tmpdir)
-    if not exists(dstdir): os.makedirs(dstdir)
+    with tasks.metrics.timer('blocking_seconds', op='makedirs'):
+        if not exists(tmpdir): os.makedirs(tmpdir)
+        if not exists(dstdir): os.makedirs(dstdir)
     
     tasks.tools.logger.bind(camid=camid)
     
     logger.debug(f'New merge task {camid}')
-    await pool.spawn(runtask(id, taskinfo, tasks.merge.merge_camdir(
+    return await pool.spawn(runtask(id, taskinfo, tasks.merge.merge_camdir(
         srcdir = Path(state._config.downloaded_dir) / camid,
         tmp = tmpdir / f'{camid}.mp4',
         dst = dstdir / f'{camid}.mp4',
         force = state._config.force,
+        concurrency = state._config.merge_hash_workers,
+        window = state._config.merge_overlap_window,
+        incremental = state._config.merge_incremental,
     )))
     
     
@@ -78,13 +83,14 @@ async def spawn_download(pool, taskinfo, id):
     
     tmpdir = Path(state._config.tmp_download_dir) / camid
     dstdir = Path(state._config.downloaded_dir) / camid
-    if not exists(tmpdir): os.makedirs(tmpdir)
-    if not exists(dstdir): os.makedirs(dstdir)
+    with tasks.metrics.timer('blocking_seconds', op='makedirs'):
+        if not exists(tmpdir): os.makedirs(tmpdir)
+        if not exists(dstdir): os.makedirs(dstdir)
     
     timestart = datetime.fromisoformat(taskinfo['args'].get('timestart'))
     
     logger.debug(f'New download task {camid} {timestart}')
-    await pool.spawn(runtask(id, taskinfo, tasks.download.process_segment(
+    return await pool.spawn(runtask(id, taskinfo, tasks.download.process_segment(
         camid,
         timestart,
         tmp = tmpdir / f'{camid}-{int(timestart.timestamp())}.flv',
@@ -105,11 +111,125 @@ async def spawn_download(pool, taskinfo, id):
     #)))
     
     
+def open_taskstore():
+    """ Открыть индекс тасков и синхронизировать его с json-файлами. """
+    store = taskstore.TaskStore(state._config.tasks_dir)
+    logger.debug(f'Syncing task index {store.path} ...')
+    store.sync()
+    return store
+
+
+def scan_tasks(type, **kw):
+    """ Перебрать json-файлы и вернуть таски заданного типа, которые нужно запустить. """
+    for file in Path(state._config.tasks_dir).glob('*.json'):
+        taskinfo = statuswriter.load(file)
+        if not taskinfo['type'] == type:
+            continue
+        if taskinfo.get('status') == 'running':
+            raise Exception(f'Task {file.stem} is running. Run `taskloop fail-running` first')
+        if taskinfo.get('status') == 'finished' and not kw['restart_finished']:
+            logger.debug(f'Skip finished task {file.stem}')
+            continue
+        if taskinfo.get('status') == 'failed' and not kw['restart_failed']:
+            logger.debug(f'Skip failed task {file.stem}')
+            continue
+        yield file.stem, taskinfo
+        
+        
+def query_tasks(store, type, **kw):
+    """ То же что scan_tasks, но по индексу тасков. """
+    for id, taskinfo in store.running(type):
+        raise Exception(f'Task {id} is running. Run `taskloop fail-running` first')
+    return store.pending(type, ['running', *excluded_statuses(**kw)])
+    
+    
+def excluded_statuses(**kw):
+    exclude = []
+    if not kw['restart_finished']:
+        exclude.append('finished')
+    if not kw['restart_failed']:
+        exclude.append('failed')
+    return exclude
+
+
+async def claim_tasks(store, pool, type, spawn_task, **kw):
+    """
+    Выполнять таски индекса вместе с другими узлами: захватывать таски в аренду 
+    на --lease-ttl секунд по мере освобождения пула и продлевать аренду, пока таски 
+    выполняются (см. TaskStore.claim). Завершиться, когда не осталось тасков, 
+    которые можно захватить, и тасков в аренде других узлов (их аренда может 
+    истечь, если узел упал).
+    """
+    node, ttl = state._config.node_id, state._config.lease_ttl
+    loop = get_running_loop()
+    exclude = excluded_statuses(**kw)
+    since = time.time()
+    leases = {}  # id -> (fence, job)
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            for id in [id for id, (fence, job) in leases.items() if job.closed]:
+                del leases[id]
+            held = [(id, fence) for id, (fence, job) in leases.items()]
+            lost = await loop.run_in_executor(None, store.heartbeat, node, held, ttl)
+            for id in lost:
+                logger.warning(f'Lease of task {id} expired and was claimed by another node. Cancelling.')
+                create_task(leases.pop(id)[1].close())
+            
+    logger.info(f'{type}: Claiming tasks as node "{node}", lease {ttl}s.')
+    heartbeats = create_task(heartbeat())
+    try:
+        while True:
+            await pool.wait_slot()
+            if pool.error:
+                raise pool.error
+            free = pool._limit - len(pool._jobs)
+            claimed = await loop.run_in_executor(
+                None, store.claim, type, node, free, ttl, exclude, since)
+            for id, taskinfo, fence in claimed:
+                state._statuswriter.fences[id] = fence
+                leases[id] = fence, await spawn_task(pool, taskinfo, id=id)
+            if claimed:
+                continue
+            if not pool._jobs and not await loop.run_in_executor(None, store.leased, type, node):
+                break
+            # Ждать освобождения слотов или истечения чужой аренды.
+            await asyncio.sleep(min(5, ttl / 3))
+        await pool.drain()
+        logger.info(f'{type}: No more tasks to claim. {pool.progress()}')
+    finally:
+        heartbeats.cancel()
+    
+    
 async def process_tasks(type, spawn_task, numworkers, **kw):
     """ Запустить все незаконченые таски заданного типа. """
-    pool = aiopool.Pool(numworkers)
+    import aiopool
+    import limiter
+    import tasks.download
+    import tasks.merge
+    import tasks.parsers
+    
+    multinode = bool(state._config.node_id)
+    if multinode and not state._config.task_index:
+        raise click.UsageError('--node-id requires --task-index')
+    pool = aiopool.Pool(numworkers, keep_tasks=not multinode)
+    tasks.metrics.register_pool(type, pool)
+    monitors = tasks.metrics.start(state._config.metrics_file, state._config.metrics_interval)
+    if type == 'download':
+        limiter.start_download_limiter(pool)
+        tasks.download.setup_engine(
+            state._config.download_engine, 
+            state._config.download_url,
+            connections_per_host = state._config.download_connections_per_host,
+            host_rate = state._config.download_host_rate,
+            total_rate = state._config.download_total_rate,
+        )
     
     tasks_dir = state._config.tasks_dir
+    store = open_taskstore() if state._config.task_index else None
+    tasks.parsers.setup(state._config.parser_workers)
+    state._statuswriter = statuswriter.StatusWriter(tasks_dir, store=store)
     
     if not kw['restart_finished']:
         logger.info(f'{type}: Ignoring finished tasks. (use --restart-finished to override)')
@@ -118,27 +238,30 @@ async def process_tasks(type, spawn_task, numworkers, **kw):
     logger.debug(f'{type}: Scanning {tasks_dir} ...')
     
     try:
-        for file in Path(tasks_dir).glob('*.json'):
-            taskinfo = json.load(open(file))
-            if not taskinfo['type'] == type:
-                continue
-            if taskinfo.get('status') == 'running':
-                raise Exception(f'Task {file.stem} is running. Run `taskloop fail-running` first')
-            if taskinfo.get('status') == 'finished' and not kw['restart_finished']:
-                logger.debug(f'Skip finished task {file.stem}')
-                continue
-            if taskinfo.get('status') == 'failed' and not kw['restart_failed']:
-                logger.debug(f'Skip failed task {file.stem}')
-                continue
-            await spawn_task(pool, taskinfo, id=file.stem)
+        if multinode:
+            return await claim_tasks(store, pool, type, spawn_task, **kw)
+        todo = query_tasks(store, type, **kw) if store else scan_tasks(type, **kw)
+        for id, taskinfo in todo:
+            await spawn_task(pool, taskinfo, id=id)
 
         logger.info(f'Waiting for {len(pool.tasks)} {type} tasks to complete.')
-        for n, task in enumerate(as_completed(pool.tasks)):
-            result = await task
-            logger.info(f'{n+1}/{len(pool.tasks)} tasks completed.')
+        completed = utils.CompletionStream(pool.tasks)
+        async for n, task in completed:
+            await task  # Re-raise exception of failed child.
+            logger.info(f'{n}/{completed.total} tasks completed.')
     except:
         await pool.close()  # Отменить все таски.
         raise
+    finally:
+        state._statuswriter.close()
+        if store:
+            store.close()
+        await tasks.download.close_engine()
+        tasks.parsers.setup(0)
+        for monitor in monitors:
+            monitor.cancel()
+        if state._config.metrics_file:
+            tasks.metrics.dump(state._config.metrics_file)
 
     
 @group('tasks')
@@ -151,6 +274,19 @@ async def process_tasks(type, spawn_task, numworkers, **kw):
         help='Директория куда помещаются все скачанные сегменты.')
 @option('--merged-dir', type=click.Path(), required=True,
         help='Директория куда помещаются все склееные видео.')
+@option('--task-index/--no-task-index', default=False,
+        help='Искать таски по индексу в SQLite рядом с директорией тасков.')
+@option('--parser-workers', type=int, default=2,
+        help='Кол-во процессов для разбора вывода ffprobe/ffmpeg. 0 - разбирать в основном процессе.')
+@option('--node-id',
+        help='Выполнять таски индекса (--task-index) вместе с другими узлами, захватывая их '
+             'в аренду. Таски упавшего узла захватываются другими после истечения аренды.')
+@option('--lease-ttl', type=float, default=60,
+        help='На сколько секунд захватывается таск с --node-id. Аренда продлевается пока таск выполняется.')
+@option('--metrics-file', type=click.Path(dir_okay=False),
+        help='Записывать метрики (формат Prometheus) в файл, например для node_exporter.')
+@option('--metrics-interval', type=float, default=10,
+        help='Раз в сколько секунд записывать --metrics-file.')
 def cli(**kw):
     """ Manage tasks. """
     state._config = kw
@@ -159,8 +295,22 @@ def cli(**kw):
     
 @cli.command('download', context_settings={'auto_envvar_prefix': 'CHURO'})
 @option('--num-download-workers', type=int, default=1000)
+@option('--adaptive-download-workers', is_flag=True, default=False,
+            help='Подстраивать кол-во одновременных загрузок по задержкам, разрывам и загрузке диска.')
+@option('--min-download-workers', type=int, default=50,
+            help='Минимум одновременных загрузок для --adaptive-download-workers. Максимум - --num-download-workers.')
+@option('--max-download-gap-rate', type=float, default=0.2,
+            help='Доля сегментов с разрывами, при которой --adaptive-download-workers снижает кол-во загрузок.')
 @option('--tmp-download-dir', type=click.Path(), required=True)
 @option('--force/--no-force', '-f', default=False, help='Обнулить счетчик попыток и качать заново.')
+@option('--download-engine', type=click.Choice(['http', 'shell']), default='http',
+            help='Скачивать по http через общий пул соединений или shell-командой.')
+@option('--download-url', help='Шаблон url сегмента: {camid}, {timestart}, {timestamp}, {duration}.')
+@option('--download-connections-per-host', type=int, default=8)
+@option('--download-host-rate', type=float, default=10,
+            help='Запросов в секунду на хост, 0 - без ограничений.')
+@option('--download-total-rate', type=float, default=200,
+            help='Запросов в секунду всего, 0 - без ограничений.')
 @option('--restart-finished', is_flag=True, default=False, 
             help='Перезапускать успешно завершенные ранее таски.')
 @option('--restart-failed', is_flag=True, default=False, 
@@ -168,7 +318,7 @@ def cli(**kw):
 def tasks_download(**kw):
     """ Process download tasks from tasks dir. """
     state._config.update(kw)
-    asyncio.run(process_tasks(
+    utils.run(process_tasks(
         'download', spawn_download, numworkers=kw['num_download_workers'], **kw
     ))
     
@@ -182,6 +332,12 @@ def tasks_download(**kw):
             help='Суммарное кол-во отсутствующих секунд с 8ч до 20ч допустимое для склеивания.')
 @option('--merge-tolerate-incomplete-downloads', is_flag=True, default=False,
             help='Допускать склеивание недокачанных сегментов с разрывами.')
+@option('--merge-hash-workers', type=int, default=4,
+            help='Кол-во одновременных ffmpeg при поиске перекрытий сегментов.')
+@option('--merge-overlap-window', type=int, default=30,
+            help='Сколько секунд в конце сегмента хэшировать при поиске перекрытия.')
+@option('--merge-incremental', is_flag=True, default=False,
+            help='Дописывать новые сегменты в склеенный файл вместо полной пересборки.')
 @option('--force/--no-force', '-f', default=False, help='Перезаписать файл если существует.')
 @option('--restart-finished', is_flag=True, default=False, 
             help='Перезапускать успешно завершенные ранее таски.')
@@ -190,7 +346,7 @@ def tasks_download(**kw):
 def tasks_merge(**kw):
     """ Process merge tasks from tasks dir. """
     state._config.update(kw)
-    asyncio.run(process_tasks(
+    utils.run(process_tasks(
         'merge', spawn_merge, numworkers=kw['num_merge_workers'], **kw
     ))
     
@@ -204,7 +360,7 @@ def tasks_merge(**kw):
 def tasks_export(**kw):
     """ Process export tasks from tasks dir. """
     state._config.update(kw)
-    asyncio.run(process_tasks(
+    utils.run(process_tasks(
         'export', spawn_export, numworkers=kw['num_export_workers'], **kw
     ))
     
@@ -216,20 +372,54 @@ def tasks_failrunning(**kw):
     
     logger.debug(f'Scanning {tasks_dir} ...')
     
-    for file in Path(tasks_dir).glob('*.json'):
-        task = json.load(open(file))
+    if state._config.task_index:
+        store = open_taskstore()
+        running = store.running()
+    else:
+        store = None
+        running = ((file.stem, statuswriter.load(file)) for file in Path(tasks_dir).glob('*.json'))
+    
+    invalidated = []
+    for id, task in running:
         if task.get('status') == 'running':
-            logger.debug(f'Task {file.stem} invalidated')
-            json.dump(dict(task, status='failed'), open(file, 'w'), indent=2)
+            logger.debug(f'Task {id} invalidated')
+            task = dict(task, status='failed')
+            file = Path(tasks_dir) / f'{id}.json'
+            tasks.tools.dump_json(task, file)
+            invalidated.append((id, task, os.stat(file)))
+    if store:
+        store.put_many(invalidated)
+        store.close()
+        
+        
+@cli.group('index')
+def cli_index():
+    """ Manage SQLite index of task files. """
+    
+    
+@cli_index.command('build')
+def index_build():
+    """ Build or update task index from json files. """
+    store = taskstore.TaskStore(state._config.tasks_dir)
+    changed, removed = store.sync()
+    print(f'{store.path}: {changed} tasks updated, {removed} removed.')
+    store.close()
+    
+    
+@cli_index.command('export')
+@argument('dir', type=click.Path(exists=True, file_okay=False))
+def index_export(dir):
+    """ Export all indexed tasks to json files in DIR. """
+    store = taskstore.TaskStore(state._config.tasks_dir)
+    print(f'{store.export(dir)} tasks exported to {dir}.')
+    store.close()
         
         
 if __name__ == '__main__':
+    import environ
     env = environ.Env()
     env.read_env('env-local')
     
-    import uvloop
-    uvloop.install()
-    
     from signal import SIGINT, signal
     signal(SIGINT, utils.sigint_handler)
 
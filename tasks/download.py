@@ -3,72 +3,367 @@ import os
 import sys
 
 import asyncio
+import contextvars
 import json
 import logging
+import random
 import re
 import shutil
+import time
 from datetime import datetime, timezone, timedelta
 from os.path import exists, isdir, join, dirname, abspath
 from pathlib import Path
 
 from asyncio import create_task, gather, get_event_loop
+from collections import Counter
 
+import aiohttp
 import aiojobs
 import click
+import yarl
 from app_state import state
 from click import Context, confirm, command, option, group, argument
 try:
-    from tools import sh, logger, setup_logging, sum_gaplength
+    import metrics
+    import parsers
+    from tools import sh, sh_lines, logger, parking, setup_logging, sum_gaplength, dump_json, update_gapsummary
 except ImportError:
-    from .tools import sh, logger, setup_logging, sum_gaplength
+    from . import metrics, parsers
+    from .tools import sh, sh_lines, logger, parking, setup_logging, sum_gaplength, dump_json, update_gapsummary
 
 
 Context.get_usage = Context.get_help  # show full help on error
 
     
-async def download_segment(file, camid, timestart):
+class TokenBucket:
+    """ Не больше rate запросов в секунду в среднем, до burst подряд. rate=0 - без ограничений. """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = None
+        
+    async def acquire(self):
+        if not self.rate:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            
+            
+class CircuitBreaker:
+    """
+    После threshold неудачных запросов подряд источник считается недоступным на cooldown
+    секунд: запросы к нему откладываются (см. delay). Неудача после паузы снова 
+    закрывает доступ, удваивая паузу (до max_cooldown). Успех все сбрасывает.
+    """
+    def __init__(self, threshold=5, cooldown=10, max_cooldown=300):
+        self.threshold = threshold
+        self.initial_cooldown = self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0
+        
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+            self.cooldown = self.initial_cooldown
+            return
+        self.failures += 1
+        now = time.monotonic()
+        if self.failures >= self.threshold and now >= self.open_until:
+            self.open_until = now + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            
+    def retry_after(self):
+        """ Через сколько секунд источник снова доступен. """
+        return max(0, self.open_until - time.monotonic())
+    
+    def delay(self):
+        """ 
+        Сколько ждать перед запросом: retry_after плюс случайно до retry_after, 
+        чтобы отложенные запросы не пошли все разом после паузы.
+        """
+        retry_after = self.retry_after()
+        return retry_after + random.uniform(0, retry_after)
+    
+    
+def retry_delay(attempt, breaker=None, base=1):
+    """
+    Пауза перед повтором после попытки attempt: full jitter, случайно от 0 до 
+    base * 10**(attempt-1) секунд, чтобы повторы разных сегментов не шли разом.
+    Плюс время, пока breaker не пропускает запросы к источнику.
+    """
+    delay = random.uniform(0, base * 10**(attempt-1))
+    if breaker:
+        delay += breaker.delay()
+    return delay
+    
+    
+class HttpEngine:
+    """
+    Скачивание сегментов по http через общую aiohttp.ClientSession.
+    
+    Соединения переиспользуются между сегментами и попытками, на один хост открыто 
+    не больше connections_per_host соединений. Запросы ограничены token bucket'ами:
+    host_rate в секунду на хост и total_rate всего. Ответ пишется в файл по мере получения,
+    блоками по write_size байт в потоках executor'а, чтобы не блокировать event loop.
+    
+    url - шаблон с полями {camid}, {timestart} (UTC, ISO 8601), {timestamp} (unix) и {duration}.
+    """
+    def __init__(self, url, connections_per_host=8, host_rate=10, total_rate=200, 
+                 chunk_size=2**16, write_size=2**20, timeout=600):
+        self.url = url
+        self.connections_per_host = connections_per_host
+        self.host_rate = host_rate
+        self.total_rate = total_rate
+        self.chunk_size = chunk_size
+        self.write_size = write_size
+        self.timeout = timeout
+        self.stats = Counter()  # requests, errors, bytes, connections, reused
+        self._total_bucket = TokenBucket(total_rate)
+        self._host_buckets = {}
+        self._breakers = {}
+        self._session = None
+        
+    def session(self):
+        if self._session is None:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._count('connections'))
+            trace.on_connection_reuseconn.append(self._count('reused'))
+            self._session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.connections_per_host),
+                timeout = aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs = [trace],
+            )
+        return self._session
+    
+    def _count(self, key):
+        async def callback(session, ctx, params):
+            self.stats[key] += 1
+        return callback
+    
+    def segment_url(self, camid, timestart, duration=900):
+        utctime = timestart.astimezone(timezone.utc)
+        return self.url.format(camid=camid, timestart=utctime.isoformat(), 
+                               timestamp=int(utctime.timestamp()), duration=duration)
+    
+    def breaker(self, url):
+        """ CircuitBreaker хоста url. """
+        host = yarl.URL(url).host
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker()
+        return self._breakers[host]
+    
+    async def fetch(self, url, file, offset=0, progress=None):
+        """ 
+        Скачать url в file. Вернуть кол-во записанных байт. 
+        Если offset - запросить Range с этого байта и дописать в file с этой позиции. 
+        Если сервер не поддерживает Range, файл скачивается целиком.
+        progress (Counter) обновляется по ходу скачивания: 'bytes' - записано байт,
+        'resumed' - с какого байта реально дописывается файл (0, если сервер вернул 200).
+        Так записанное до обрыва учитывается, даже если fetch завершился исключением.
+        """
+        if progress is None:
+            progress = Counter()
+        host = yarl.URL(url).host
+        if host not in self._host_buckets:
+            self._host_buckets[host] = TokenBucket(self.host_rate)
+        await self._total_bucket.acquire()
+        await self._host_buckets[host].acquire()
+        
+        self.stats['requests'] += 1
+        written = 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        
+        async def flush():
+            nonlocal written
+            await loop.run_in_executor(None, f.write, buffer)
+            written += len(buffer)
+            progress['bytes'] += len(buffer)
+            self.stats['bytes'] += len(buffer)
+            buffer.clear()
+        
+        # Файл открывается до запроса: при ошибке соединения или статуса file все равно 
+        # существует (пустой или с прежним началом) и проверяется как неудачная попытка.
+        f = await loop.run_in_executor(None, open, file, 'r+b' if offset else 'wb')
+        try:
+            async with self.session().get(url, headers=headers) as response:
+                response.raise_for_status()
+                if response.status != 206:
+                    offset = 0
+                progress['resumed'] = offset
+                await loop.run_in_executor(None, f.truncate, offset)
+                f.seek(offset)
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    buffer += chunk
+                    if len(buffer) >= self.write_size:
+                        await flush()
+        finally:
+            # Полученное до обрыва тоже записывается.
+            if buffer:
+                await flush()
+            await loop.run_in_executor(None, f.close)
+        return written
+        
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            
+            
+engine = None  # HttpEngine, если настроен (см. setup_engine). Иначе скачивание через shell.
+
+
+def setup_engine(kind, url, **kw):
+    """ 
+    Выбрать способ скачивания сегментов: 'http' (HttpEngine) или 'shell'. 
+    Без шаблона url http недоступен и используется shell.
     """
-    TODO
-    Запустить внешний процесс скачивания сегмента.
+    global engine
+    engine = None
+    if kind == 'http':
+        if url:
+            engine = HttpEngine(url, **kw)
+        else:
+            logger.get().warning('No --download-url given, falling back to shell download.')
+    return engine
+
+
+async def close_engine():
+    if engine:
+        await engine.close()
+        
+
+async def download_segment(file, camid, timestart, offset=0):
     """
+    Скачать сегмент через HttpEngine, если он настроен, иначе внешним процессом.
+    offset - докачать файл начиная с этого байта (только HttpEngine).
+    Ошибки http не прерывают таск: файл остается недокачанным и проверяется на разрывы.
+    Вернуть (кол-во скачанных байт, включая записанные до обрыва; с какого байта файл 
+    реально докачан - 0, если сервер не поддержал Range или запрос не удался).
+    """
+    if engine:
+        url = engine.segment_url(camid, timestart)
+        progress = Counter()
+        try:
+            await engine.fetch(url, file, offset, progress)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            engine.stats['errors'] += 1
+            engine.breaker(url).record(False)
+            logger.get().warning(f'Download {url} failed: {e!r}')
+        else:
+            engine.breaker(url).record(True)
+        return progress['bytes'], progress['resumed']
+    
     utctime = timestart.astimezone(timezone.utc).isoformat()
     cmd = f'touch {file}; sleep 15;'  # TODO
     await sh(cmd)
+    return os.path.getsize(file), 0
 
     
-async def timestamps(file):
-    """ Iterate over Presentation Timestamps of packets. """
+def packets_cmd(file, start=None):
+    """ 
+    Команда ffprobe, выводящая Presentation Timestamp и байтовую позицию пакетов.
+    start - начать чтение с этого PTS (ffprobe перематывает файл, а не читает с начала).
+    """
+    interval = f' -read_intervals {start}%' if start else ''
     cmd = 'ffprobe -loglevel error -hide_banner -of compact' \
-          ' -select_streams v:0 -show_entries packet=pts_time ' + str(file)
+          ' -select_streams v:0 -show_entries packet=pts_time,pos' + interval + ' ' + str(file)
       
-    cmd = 'echo "packet|pts_time=123.456\npacket|pts_time=78.456"'  # TODO: stub
+    cmd = 'echo "packet|pts_time=123.456|pos=0\npacket|pts_time=78.456|pos=1024"'  # TODO: stub
+    return cmd
+
+
+class GapDetector:
+    """
+    Потоковый поиск разрывов между соседними PTS.
+    Хранит только два последних PTS с байтовыми позициями и найденные разрывы, 
+    поэтому проверку файла можно продолжить после его докачки (см. rewind).
+    """
+    def __init__(self, maxdiff=2):
+        self.maxdiff = maxdiff
+        self.last = None
+        self.pos = None  # байтовая позиция последнего пакета
+        self.prev = (None, None)  # (pts, pos) предпоследнего пакета
+        self.gaps = []
+        
+    def feed(self, pts, pos=None):
+        if self.last is not None:
+            diff = pts - self.last
+            if diff > self.maxdiff:
+                self.gaps.append({'start': int(self.last), 'len': diff})
+        self.prev = (self.last, self.pos)
+        self.last = pts
+        self.pos = pos
+        
+    def merge(self, scan):
+        """ Учесть результат parsers.scan_packets для следующего куска вывода ffprobe. """
+        if not scan['count']:
+            return
+        self.feed(*scan['first'])
+        self.gaps.extend(scan['gaps'])
+        if scan['count'] > 1:
+            self.prev = scan['prev']
+            self.last, self.pos = scan['last']
+        
+    def resumable(self, duration=900):
+        """ Файл без разрывов, только обрезан в конце, и известно с какого байта докачивать. """
+        return self.last is not None and self.last < duration and not self.gaps and self.pos is not None
     
-    stdout = await sh(cmd)
-    for line in stdout.split():
-        if line.strip():
-            yield float(re.search(b'packet\|pts_time=(\d+.\d+)', line).group(1))
+    def rewind(self):
+        """
+        Забыть последний пакет: он мог быть записан не полностью.
+        Вернуть его байтовую позицию, с которой нужно докачивать файл.
+        """
+        offset = self.pos
+        self.last, self.pos = self.prev
+        self.prev = (None, None)
+        return offset
+        
+    def report(self, localtime, duration=900):
+        """ Вернуть gapreport. """
+        report = {'localtime': localtime.isoformat()}
+        if self.last is None:
+            report['invalid_file'] = True
+            return report
+        if self.last < duration:
+            report['duration_error'] = self.last
+        if self.gaps:
+            report['maxdiff_errors'] = self.gaps
+        return report
        
        
-async def check_file(file, localtime, duration=900, maxdiff=2):
-    """ Проверить файл и вернуть gapreport """
-    #return {'localtime': localtime.isoformat()}
-    ts = [x async for x in timestamps(file)]
-    
-    report = {'localtime': localtime.isoformat()}
-    if not ts:
-        report['invalid_file'] = True
-        return report
+async def check_file(file, localtime, duration=900, maxdiff=2, detector=None):
+    """ 
+    Проверить файл и вернуть gapreport.
+    Если передан detector уже проверенного начала файла, проверяется только остаток 
+    после detector.last.
+    Вывод ffprobe разбирается кусками, в процессах parsers.executor если он настроен.
+    """
+    if detector is None:
+        detector = GapDetector(maxdiff)
+    start = detector.last
+    # Нечитаемый или недокачанный файл - не ошибка таска, а invalid_file в gapreport.
+    output = sh_lines(packets_cmd(file, start), chunk_size=parsers.CHUNK_SIZE, raise_error=False)
+    async for scan in parsers.map_chunks(parsers.scan_packets, output, detector.maxdiff, start):
+        detector.merge(scan)
+    return detector.report(localtime, duration)
     
-    if ts[-1] < duration:
-        report['duration_error'] = ts[-1]
-        
-    diffs = [y - x for x, y in zip(ts[:-1], ts[1:])]
-    for diff in diffs:
-        if diff > maxdiff:
-            report.setdefault('maxdiff_errors', []).append({
-                'start': int(ts[diffs.index(diff)]), 'len': diff
-            })
-    return report
+    
+def save_report(report, gapfile, dst, max_retries):
+    """ Записать gapreport сегмента и обновить сводку разрывов камеры. Выполняется в executor. """
+    dump_json(report, gapfile)
+    update_gapsummary(dst, report, max_retries)
     
     
 #@log_exception
@@ -78,15 +373,21 @@ async def process_segment(camid, timestart, tmp, dst, max_retries, force=False):
     временную папку, проверить на разрывы. 
     Если разрывов меньше чем в существующем файле, перезаписать его.
     Если есть разрывы - повторять скачивание max-download-retries раз.
+    Перед повтором таск ждет случайное время (см. retry_delay), не занимая слот пула.
     Сохранить отчет о разрывах в {segmentvideofile}.flv.gapreport.json
     Если force == False то продолжаем считать кол-во попыток с прошлого запуска.
     Если force == True то кол-во попыток с прошлого запуска обнуляется.
+    Если файл обрезан в конце, повторная попытка докачивает его с места обрыва (Range),
+    и проверяется только докачанная часть.
+    В gapreport пишется bytes_transferred - сколько всего байт скачано по сети 
+    за все попытки, и bytes_resumed - сколько байт не пришлось качать повторно.
     Возвращает True если сегмент скачан без разрывов.
     """
     #raise Exception('lol')
     log = logger.bind(segment_time=timestart, camid=camid)
     dst_gaplength = None
     prevattempts = 0
+    transferred = resumed = 0
     gapfile = str(dst) + '.gapreport.json'  # отчет о разрывах
     if exists(gapfile):
         try:
@@ -98,6 +399,8 @@ async def process_segment(camid, timestart, tmp, dst, max_retries, force=False):
                 report['attempts'] = 0
             else:
                 prevattempts = report['attempts']
+                transferred = report.get('bytes_transferred', 0)
+                resumed = report.get('bytes_resumed', 0)
                 
             dst_gaplength = sum_gaplength(report)
             if dst_gaplength == 0:
@@ -108,11 +411,34 @@ async def process_segment(camid, timestart, tmp, dst, max_retries, force=False):
                 return False
             log.debug(f'Сегмент был скачан ранее c разрывами, осталось {max_retries - prevattempts} попыток.')
     
+    limiter = getattr(state, '_downloadlimiter', None)
+    breaker = engine.breaker(engine.segment_url(camid, timestart)) if engine else None
+    detector = None  # Состояние проверки tmp после прошлой попытки.
     for attempt in range(prevattempts + 1, max_retries + 1):
-        log.debug(f'Starting download, attempt {attempt}.')
-        await download_segment(tmp, camid, timestart)
-        report = await check_file(tmp, timestart)
+        while breaker and breaker.retry_after():
+            log.debug(f'Source is unavailable, waiting {breaker.retry_after():.1f} seconds.')
+            await parking.get()(breaker.delay())
+        offset = 0
+        if engine and detector and detector.resumable() and exists(tmp):
+            offset = detector.rewind()
+            log.debug(f'Resuming download from byte {offset}, attempt {attempt}.')
+        else:
+            detector = GapDetector()
+            log.debug(f'Starting download, attempt {attempt}.')
+        started = time.monotonic()
+        with metrics.timer('segment_phase_seconds', phase='download'):
+            written, used_offset = await download_segment(tmp, camid, timestart, offset)
+        transferred += written
+        resumed += used_offset
+        if offset and not used_offset:
+            # Сервер вернул файл целиком (или запрос не удался): проверять с начала.
+            detector = GapDetector()
+        latency = time.monotonic() - started
+        with metrics.timer('segment_phase_seconds', phase='check'):
+            report = await check_file(tmp, timestart, detector=detector)
         tmp_gaplength = sum_gaplength(report)
+        if limiter:
+            limiter.observe(latency, gaps=tmp_gaplength > 0)
         
         better = (dst_gaplength is None) or (tmp_gaplength < dst_gaplength)
         
@@ -120,23 +446,34 @@ async def process_segment(camid, timestart, tmp, dst, max_retries, force=False):
             # Перезаписать старый файл и gapreport.
             if dst_gaplength:
                 log.info(f'New file is better and will replace current.')
-            shutil.move(tmp, dst)
+            with metrics.timer('segment_phase_seconds', phase='move'):
+                if tmp_gaplength and detector.resumable():
+                    shutil.copyfile(tmp, dst)  # tmp остается для докачки.
+                else:
+                    shutil.move(tmp, dst)
             dst_gaplength = tmp_gaplength
         else:
             # Оставить старый файл и gapreport.
             report = json.load(open(gapfile))
             
         report['attempts'] = attempt
-        json.dump(report, open(gapfile, 'w+'), indent=2)
+        report['bytes_transferred'] = transferred
+        report['bytes_resumed'] = resumed
+        with metrics.timer('segment_phase_seconds', phase='report'):
+            # В контексте таска, чтобы ошибки попали в его лог (logger.get()).
+            await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, save_report, report, gapfile, dst, max_retries)
             
         if tmp_gaplength == 0:
             # Нет разрывов
+            log.debug(f'Downloaded in {attempt} attempts, {transferred} bytes transferred, '
+                      f'{resumed} bytes resumed.')
             return True
         
         if attempt < max_retries:
-            wait = 1 * 10**(attempt-1)
-            log.debug(f'Gap length {tmp_gaplength}. Retrying in {wait} seconds.')
-            await asyncio.sleep(wait)
+            wait = retry_delay(attempt, breaker)
+            log.debug(f'Gap length {tmp_gaplength}. Retrying in {wait:.1f} seconds.')
+            await parking.get()(wait)  # Слот пула свободен на время ожидания.
     else:
         log.debug(f'Last attempt failed, file has gaps.')
         return False
@@ -153,6 +490,8 @@ async def process_segment(camid, timestart, tmp, dst, max_retries, force=False):
         type=click.Choice(list(logging._nameToLevel), case_sensitive=False))
 @option('--max-download-retries', type=int, default=2)
 @option('--force/--no-force', '-f', default=False, help='Обнулить счетчик попыток и качать заново.')
+@option('--download-engine', type=click.Choice(['http', 'shell']), default='http')
+@option('--download-url', help='Шаблон url сегмента: {camid}, {timestart}, {timestamp}, {duration}.')
 def cli_download_segment(camid, timestart, dst_download_dir, tmp_download_dir, 
                          logfile, loglevel, **kw):
     """
@@ -172,14 +511,21 @@ def cli_download_segment(camid, timestart, dst_download_dir, tmp_download_dir,
     if not exists(tmpdir): os.makedirs(tmpdir)
     if not exists(dstdir): os.makedirs(dstdir)
     
-    result = asyncio.run(process_segment(
-        camid,
-        timestart,
-        tmp = tmpdir / f'{camid}-{int(timestart.timestamp())}.flv',
-        dst = dstdir / f'{camid}-{int(timestart.timestamp())}.flv',
-        max_retries = kw['max_download_retries'],
-        force = kw['force'],
-    ))
+    async def main():
+        setup_engine(kw['download_engine'], kw['download_url'])
+        try:
+            return await process_segment(
+                camid,
+                timestart,
+                tmp = tmpdir / f'{camid}-{int(timestart.timestamp())}.flv',
+                dst = dstdir / f'{camid}-{int(timestart.timestamp())}.flv',
+                max_retries = kw['max_download_retries'],
+                force = kw['force'],
+            )
+        finally:
+            await close_engine()
+        
+    result = asyncio.run(main())
     if result is False:
         sys.exit(1)  # Fail
     sys.exit(0)  # Success
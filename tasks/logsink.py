@@ -0,0 +1,102 @@
+import atexit
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+
+
+class TaskLogSink:
+    """
+    Loguru sink, который пишет лог каждого таска в свой файл path(taskid).
+
+    Записи не пишутся на диск сразу, а копятся в буфере таска. Фоновый поток
+    дописывает буферы в файлы раз в interval секунд, сразу как буфер таска превысил
+    buffer_size байт, или как таск завершился (finish). Открытые файлы переиспользуются,
+    одновременно открыто не больше max_files (давно не писавшиеся закрываются).
+    При выходе из процесса (в т.ч. по ctrl-c) все буферы записываются (close).
+    """
+    def __init__(self, path, interval=1, buffer_size=2**16, max_files=256):
+        self.path = path
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.max_files = max_files
+        self.written = 0  # записей
+        self._buffers = defaultdict(list)  # taskid -> [message, ...]
+        self._sizes = defaultdict(int)
+        self._full = False
+        self._finished = set()
+        self._files = OrderedDict()  # taskid -> открытый файл, LRU
+        self._closed = False
+        self._cond = threading.Condition()
+        self._io = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='tasklogsink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __call__(self, message):
+        taskid = message.record["extra"].get("taskid")
+        if not taskid:
+            return
+        with self._cond:
+            self._buffers[taskid].append(message)
+            self._sizes[taskid] += len(message)
+            if self._sizes[taskid] >= self.buffer_size:
+                self._full = True
+                self._cond.notify()
+
+    def finish(self, taskid):
+        """ Таск завершен: записать его буфер и закрыть файл, не дожидаясь interval. """
+        with self._cond:
+            self._finished.add(taskid)
+            self._full = True
+            self._cond.notify()
+
+    def flush(self):
+        """ Записать все буферы. """
+        with self._io:
+            with self._cond:
+                buffers, self._buffers = self._buffers, defaultdict(list)
+                finished, self._finished = self._finished, set()
+                self._sizes.clear()
+                self._full = False
+            for taskid, messages in buffers.items():
+                file = self._open(taskid)
+                file.write(''.join(messages))
+                file.flush()
+                self.written += len(messages)
+            for taskid in finished:
+                file = self._files.pop(taskid, None)
+                if file:
+                    file.close()
+
+    def _open(self, taskid):
+        file = self._files.get(taskid)
+        if file:
+            self._files.move_to_end(taskid)
+            return file
+        while len(self._files) >= self.max_files:
+            self._files.popitem(last=False)[1].close()
+        file = self._files[taskid] = open(self.path(taskid), 'a')
+        return file
+
+    def close(self):
+        """ Записать все, закрыть файлы и остановить фоновый поток. """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        with self._io:
+            while self._files:
+                self._files.popitem()[1].close()
+
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._full, timeout=self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # Логгер здесь не используем: запись в лог снова попадет в этот sink.
+                print(f'Failed to write task logs: {e!r}', file=sys.stderr)
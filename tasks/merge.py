@@ -3,16 +3,28 @@ import asyncio
 import json
 import os
 import shutil
-from collections import defaultdict, namedtuple
+import struct
+import time
+from asyncio import gather
+from collections import defaultdict
 from datetime import datetime
+from math import inf
 from os.path import exists, isdir, join, dirname
+from pathlib import Path
 
 from app_state import state
     
 try:
-    from tools import sh, logger, setup_logging, sum_gaplength
+    import metrics
+    import parsers
+    from parsers import Frame
+    from tools import sh, sh_lines, logger, setup_logging, sum_gaplength, dump_json, \
+        load_gapsummary, build_gapsummary
 except ImportError:
-    from .tools import sh, logger, setup_logging, sum_gaplength
+    from . import metrics, parsers
+    from .parsers import Frame
+    from .tools import sh, sh_lines, logger, setup_logging, sum_gaplength, dump_json, \
+        load_gapsummary, build_gapsummary
 
 
 dummy = '''
@@ -21,89 +33,364 @@ dummy = '''
 0, 200, 200, 0, 1375, 58b545ce8693abf8ebcaae74cca19a93
 '''
 
-Frame = namedtuple('Frame', 'stream, dts, pts, duration, size, hash')
+dummy_probe = '''
+#tb 0: 1/1000
+#tb 1: 1/1000
+0, 0, 0, 0, 39041, 23cbd52b74fd35b11d238537770fe5cc
+1, 0, 0, 0, 39041, 23cbd52b74fd35b11d238537770fe5cc
+1, 200, 200, 0, 1375, 58b545ce8693abf8ebcaae74cca19a93
+'''
 
-async def merge_files(files, dst):
-    """ Склеить файлы, отрезая перекрывающиеся куски. """
-    log = logger.get()
-    input = []
-    findhash = None
-    outpoint = 0
+async def framemd5(cmd):
+    """ 
+    Iterate over (timebase, Frame) in ffmpeg framemd5 output. timebase is (num, den). 
+    Вывод разбирается кусками, в процессах parsers.executor если он настроен.
+    """
+    timebases = {}
+    output = sh_lines(cmd, chunk_size=parsers.CHUNK_SIZE)
+    async for chunk_timebases, frames in parsers.map_chunks(parsers.parse_framemd5, output):
+        for stream, timebase in chunk_timebases.items():
+            timebases.setdefault(stream, timebase)
+        for frame in frames:
+            yield timebases.get(frame.stream), frame
+            
+            
+async def probe_file(file, window):
+    """
+    Хэши кадров начала и конца файла: timebase, первый кадр и кадры 
+    последних window секунд. Декодируется только начало и конец файла, 
+    за один вызов ffmpeg: поток 0 - первый кадр, поток 1 - конец файла.
+    """
+    cmd = f'ffmpeg -i {file} -sseof -{window} -copyts -i {file} -map 0:v:0 -map 1:v:0' \
+           ' -an -c copy -frames:v:0 1 -f framemd5 -'
+    cmd = f'echo "{dummy_probe}"'  # TODO: stub
+    timebase, head, tail = None, None, []
+    async for tb, frame in framemd5(cmd):
+        if frame.stream == '0':
+            head = head or [int(frame.pts), frame.hash]
+        else:
+            timebase = tb
+            tail.append([int(frame.pts), frame.hash])
+    return {'timebase': timebase, 'head': head, 'tail': tail}
     
-    log.debug(f'Merging {dst}.')
     
-    # Находим перекрывающиеся куски по одинаковым хэшам кадров.
-    # TODO: do not reverse, calculate inpoint instead of outpoint.
-    for file in reversed(files):
-        cmd = 'ffmpeg -i %s -an -f framemd5 -c copy -' % file
-        
-        cmd = f'echo "{dummy}"'  # TODO: stub
-        data = (await sh(cmd)).split(b'\n')
-        
-        timebase = [x for x in data if x.startswith(b'#tb')][0]
-        tb_num, tb_den = timebase.split()[-1].split(b'/')
+class ProbeCache:
+    """
+    Кэш результатов probe_file в json-файле рядом с сегментами.
+    Запись действительна пока не изменились размер и mtime сегмента.
+    Хранится не более max_entries записей, давно не использованные удаляются.
+    """
+    def __init__(self, file, max_entries=1000):
+        self.file = Path(file)
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if self.file.exists():
+            try:
+                with open(self.file) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logger.get().error(f'Malformed frame hash cache {self.file}')
+                
+    async def probe(self, file, window):
+        stat = os.stat(file)
+        key = [stat.st_size, stat.st_mtime_ns, window]
+        entry = self.entries.get(str(file))
+        if entry and entry['key'] == key:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = self.entries[str(file)] = {'key': key, 'probe': await probe_file(file, window)}
+        entry['used'] = time.time()
+        return entry['probe']
+    
+    async def scan(self, file, findhash):
+        """ Закэшированный scan_file. Вызывается после probe() для того же файла. """
+        scans = self.entries[str(file)].setdefault('scans', {})
+        if findhash not in scans:
+            self.misses += 1
+            scans[findhash] = await scan_file(file, findhash)
+        return scans[findhash]
+    
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            oldest = sorted(self.entries, key=lambda x: self.entries[x]['used'])
+            for key in oldest[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+        dump_json(self.entries, self.file)
         
-        frames = [x.replace(b',', b'').split() for x in data if x and not x.startswith(b'#')]
         
-        for line in reversed(frames[1:]):
-            frame = Frame(*line)
-            if frame.hash == findhash:
-                outpoint = float(frame.pts) * int(tb_num) / int(tb_den)
-                break
-            
+async def scan_file(file, findhash):
+    """ PTS последнего кадра файла (кроме первого) с хэшем findhash. Декодирует весь файл. """
+    cmd = 'ffmpeg -i %s -an -f framemd5 -c copy -' % file
+    cmd = f'echo "{dummy}"'  # TODO: stub
+    matchpts = None
+    first = True
+    async for _, frame in framemd5(cmd):
+        if not first and frame.hash == findhash:
+            matchpts = int(frame.pts)
+        first = False
+    return matchpts
+    
+    
+async def find_outpoint(file, probe, findhash, scan=scan_file):
+    """
+    PTS последнего кадра файла (кроме первого) с хэшем findhash, в секундах.
+    Сначала ищется в конце файла, если не найден - во всем файле.
+    """
+    if findhash is None or probe['head'] is None:
+        return 0
+    headpts = probe['head'][0]
+    for pts, hash in reversed(probe['tail']):
+        if hash == findhash and pts != headpts:
+            matchpts = pts
+            break
+    else:
+        logger.get().debug(f'Overlap not found in tail of {file}, scanning whole file.')
+        matchpts = await scan(file, findhash)
+    if matchpts is None or probe['timebase'] is None:
+        return 0
+    num, den = probe['timebase']
+    return matchpts * num / den
+    
+
+async def find_inpoint(file, findhash, window):
+    """
+    PTS (в секундах) кадра, следующего за кадром с хэшем findhash в первых window 
+    секундах файла. Если кадр не найден - None.
+    """
+    cmd = 'ffmpeg -t %s -i %s -an -f framemd5 -c copy -' % (window, file)
+    cmd = f'echo "{dummy}"'  # TODO: stub
+    found = False
+    async for (num, den), frame in framemd5(cmd):
+        if found:
+            return int(frame.pts) * num / den
+        found = frame.hash == findhash
+    return None
+
+
+async def merge_files(files, dst, concurrency=4, window=30, cache=None, 
+                      inpoint=None, offset=0, movflags='+faststart'):
+    """
+    Склеить файлы, отрезая перекрывающиеся куски. Вернуть outpoint каждого файла.
+    Начало и конец файлов хэшируются параллельно, не более concurrency ffmpeg 
+    одновременно. Перекрытие ищется в последних window секундах файла.
+    Если передан cache (ProbeCache), хэшируются только новые и измененные файлы.
+    inpoint - откуда начинать первый файл, offset - сдвиг времени результата.
+    """
+    log = logger.get()
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+    
+    log.debug(f'Merging {dst}.')
+    
+    # Находим перекрывающиеся куски по одинаковым хэшам кадров: конец каждого файла
+    # обрезается по кадру, совпадающему с первым кадром следующего файла.
+    probe = cache.probe if cache else probe_file
+    probes = await gather(*[limited(probe(file, window)) for file in files])
+    heads = [probe['head'] and probe['head'][1] for probe in probes[1:]] + [None]
+    outpoints = await gather(*[
+        limited(find_outpoint(file, probe, findhash, cache.scan if cache else scan_file)) 
+        for file, probe, findhash in zip(files, probes, heads)
+    ])
+    
+    input = []
+    for n, (file, outpoint) in enumerate(zip(files, outpoints)):
+        input.append('file %s' % file)
+        if n == 0 and inpoint:
+            input.append('inpoint %s' % inpoint)
         if outpoint:
-            input.append('file %s\noutpoint %s' % (file, outpoint))
-        else:
-            input.append('file %s' % file)
-        findhash = Frame(*frames[0]).hash
+            input.append('outpoint %s' % outpoint)
     
     # Склеиваем
     cmd = 'ffmpeg -nostats -hide_banner -avoid_negative_ts make_zero -fflags +genpts -f concat -safe 0' \
-        ' -protocol_whitelist file,pipe -i - -c copy -flags +global_header -movflags +faststart -y '
+        ' -protocol_whitelist file,pipe -i - -c copy -flags +global_header -movflags %s -y ' % movflags
+    if offset:
+        cmd += '-output_ts_offset %s ' % offset
     log.debug(cmd + str(dst))
-    await sh(cmd + str(dst), '\n'.join(reversed(input)).encode('utf8'))
+    await sh(cmd + str(dst), '\n'.join(input).encode('utf8'))
+    return outpoints
+
+
+# Фрагментированный mp4, к которому можно дописывать новые фрагменты.
+INCREMENTAL_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof+skip_trailer'
 
 
-async def merge_camdir(srcdir, tmp, dst, force=False):
+def append_fragments(src, dst):
+    """
+    Дописать в конец фрагментированного mp4 dst фрагменты (moof/mdat) из src.
+    Заголовок src (ftyp/moov) пропускается. Вернуть кол-во записанных байт.
+    """
+    written = 0
+    with open(src, 'rb') as input, open(dst, 'ab') as output:
+        while True:
+            header = input.read(8)
+            if len(header) < 8:
+                break
+            size, type = struct.unpack('>I4s', header)
+            if size == 1:
+                header += input.read(8)
+                size = struct.unpack('>Q', header[8:])[0]
+            elif size == 0:  # Бокс до конца файла.
+                size = os.fstat(input.fileno()).st_size - input.tell() + len(header)
+            remaining = size - len(header)
+            if type not in (b'moof', b'mdat'):
+                input.seek(remaining, os.SEEK_CUR)
+                continue
+            output.write(header)
+            written += len(header)
+            while remaining:
+                chunk = input.read(min(remaining, 2**20))
+                if not chunk:
+                    raise EOFError(f'Truncated {type} box in {src}')
+                output.write(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+        output.flush()
+        os.fsync(output.fileno())
+    return written
+
+
+async def media_duration(file):
+    """ Длительность медиафайла в секундах. """
+    cmd = 'ffprobe -v error -show_entries format=duration -of csv=p=0 %s' % file
+    return float(await sh(cmd))
+
+
+async def merge_incremental(files, tmp, dst, concurrency=4, window=30, cache=None, force=False):
+    """
+    Склеить файлы во фрагментированный mp4. Состав склеенного файла записывается
+    в {dst}.manifest.json. Если с прошлой склейки в конце добавились новые сегменты,
+    а прежние не изменились - склеиваются только новые и дописываются в dst.
+    Иначе, или если force, dst пересобирается целиком. Вернуть кол-во записанных в dst байт.
+    
+    В манифесте хранится и размер dst: фрагменты оборвавшегося дописывания (манифест 
+    записывается после них) отрезаются, а если dst короче манифеста - он пересобирается.
+    """
+    log = logger.get()
+    manifestfile = Path(f'{dst}.manifest.json')
+    manifest = None
+    if dst.exists() and manifestfile.exists() and not force:
+        try:
+            with open(manifestfile) as f:
+                manifest = json.load(f)
+        except ValueError:
+            log.error(f'Malformed merge manifest {manifestfile}')
+    
+    if manifest:
+        size = os.stat(dst).st_size
+        if manifest.get('size') is None or size < manifest['size']:
+            log.warning(f'{dst} does not match merge manifest, rebuilding.')
+            manifest = None
+        elif size > manifest['size']:
+            log.warning(f'Truncating {size - manifest["size"]} bytes of interrupted append to {dst}.')
+            os.truncate(dst, manifest['size'])
+    
+    segments = []
+    for file in files:
+        stat = os.stat(file)
+        segments.append({'file': file.name, 'key': [stat.st_size, stat.st_mtime_ns]})
+    keys = [(x['file'], x['key']) for x in segments]
+    old = [(x['file'], x['key']) for x in manifest['segments']] if manifest else []
+    
+    if manifest and keys == old:
+        log.debug(f'Сегменты не изменились с прошлой склейки {dst}.')
+        return 0
+    
+    if manifest and old and keys[:len(old)] == old:
+        # Дописываем новые сегменты. Перекрытие с последним склеенным сегментом 
+        # отрезаем в начале первого нового сегмента.
+        new = files[len(old):]
+        log.info(f'Appending {len(new)} new segments to {dst}.')
+        probe = await (cache.probe if cache else probe_file)(files[len(old) - 1], window)
+        inpoint = None
+        if probe['tail']:
+            inpoint = await find_inpoint(new[0], probe['tail'][-1][1], window)
+        outpoints = await merge_files(new, tmp, concurrency, window, cache, inpoint=inpoint,
+                                      offset=manifest['duration'], movflags=INCREMENTAL_MOVFLAGS)
+        duration = manifest['duration'] + await media_duration(tmp)
+        written = append_fragments(tmp, dst)
+        os.unlink(tmp)
+        segments = manifest['segments'] + segments[len(old):]
+        segments[len(old)]['inpoint'] = inpoint
+    else:
+        log.info(f'Rebuilding {dst} from {len(files)} segments.')
+        outpoints = await merge_files(files, tmp, concurrency, window, cache,
+                                      movflags=INCREMENTAL_MOVFLAGS)
+        duration = await media_duration(tmp)
+        written = os.stat(tmp).st_size
+        shutil.move(tmp, dst)
+    
+    for segment, outpoint in zip(segments[len(segments) - len(outpoints):], outpoints):
+        segment['outpoint'] = outpoint
+    dump_json({'segments': segments, 'duration': duration, 'bytes_written': written,
+               'size': os.stat(dst).st_size}, manifestfile)
+    return written
+
+
+# Интервал с 8ч до 20ч, в котором считаются отсутствующие секунды.
+SLOTS_08_20 = ['%02d:%02d' % (h, m) for h in range(8, 20) for m in (0, 15, 30, 45)]
+
+
+def check_gapsummary(summary):
+    """
+    Проверить сводку разрывов камеры. Вернуть кол-во отсутствующих секунд с 8ч
+    до 20ч, отсутствующие сегменты и недокачанные сегменты с разрывами.
+    """
+    interval = set(SLOTS_08_20)
+    gaplength_08_20 = 0
+    unfinished_segments = []
+    for name, segment in sorted(summary.items()):
+        if segment['incomplete']:
+            unfinished_segments.append(segment['slot'])
+        if segment['slot'] in interval:
+            gaplength_08_20 += segment['gaps']
+            interval.discard(segment['slot'])
+    missing = sorted(interval)
+    return gaplength_08_20 + 900 * len(missing), missing, unfinished_segments
+
+
+def mergeable_cameras(regiondir, tolerate_gaps, tolerate_incomplete=False):
+    """
+    Проверить все камеры региона по их сводкам разрывов, не читая gapreport-файлы.
+    Iterate over (camdir, mergeable, gaplength_08_20). Камеры без сводки пропускаются.
+    """
+    for camdir in sorted(Path(regiondir).iterdir()):
+        summary = load_gapsummary(camdir) if camdir.is_dir() else None
+        if summary is None:
+            continue
+        gaplength, missing, unfinished = check_gapsummary(summary)
+        ok = gaplength <= tolerate_gaps and (tolerate_incomplete or not unfinished)
+        yield camdir, ok, gaplength
+        
+
+async def merge_camdir(srcdir, tmp, dst, force=False, concurrency=4, window=30, 
+                       incremental=False):
     """
     Проверить отчет о разрывах и склеить все файлы в папке в один временный файл.
     По окончании перенести временный файл в конечный.
+    Если incremental - дописывать в конечный файл новые сегменты (см. merge_incremental).
     Вернуть True если файл успешно склеен.
     """
     log = logger.get()
     
-    if dst.exists() and not force:
+    if dst.exists() and not force and not incremental:
         log.debug('Склееный файл уже существует (требуется --force)')
         return
     
     # Проверим суммарное кол-во отсутствующих секунд с 8ч до 20ч допустимое для склеивания.
-    interval = set('08:00 08:15 08:30 08:45 09:00 09:15 09:30 09:45 10:00 10:15 10:30 '
-        '10:45 11:00 11:15 11:30 11:45 12:00 12:15 12:30 12:45 13:00 13:15 13:30 13:45 '
-        '14:00 14:15 14:30 14:45 15:00 15:15 15:30 15:45 16:00 16:15 16:30 16:45 17:00 '
-        '17:15 17:30 17:45 18:00 18:15 18:30 18:45 19:00 19:15 19:30 19:45'.split())
-    gaplength_08_20 = 0  # Кол-во разрывов с 8ч до 20ч
-    #gaplength_other = 0  # Кол-во разрывов в другое время
-    unfinished_segments = {}   # Недокачанные сегменты с разрывами.
-    for gapfile in sorted(srcdir.glob('*.gapreport.json')):
-        try:
-            report = json.load(open(gapfile))
-        except:
-            log.error(f'Malformed gapreport file {gapfile}')
-            continue
-        log.debug(f'Checking {gapfile}.')
-        timestart = datetime.fromisoformat(report['localtime'])
-        h, m = timestart.hour, timestart.minute
-        if sum_gaplength(report) and report['attempts'] < state._config.max_download_retries:
-            unfinished_segments[(h,m)] = gapfile
-        if f'{h:02}:{m:02}' in interval:
-            gaplength_08_20 += sum_gaplength(report)
-            interval.discard(f'{h:02}:{m:02}')
-        #else:
-            #gaplength_other += sum_gaplength(report)
+    with metrics.timer('merge_phase_seconds', phase='summary'):
+        summary = load_gapsummary(srcdir)
+        if summary is None:
+            summary = build_gapsummary(srcdir, state._config.max_download_retries)
+    gaplength_08_20, missing, unfinished_segments = check_gapsummary(summary)
         
-    for time in sorted(interval):
+    for time in missing:
         log.error(f'Missing segment {time} in {srcdir}.')
-        gaplength_08_20 += 900
             
     if gaplength_08_20 > state._config.merge_08_20_tolerate_gaps_duration:
         log.warning(f'{gaplength_08_20} отсутствующих секунд с 8ч до 20ч превышает допустимое для склеивания.')
@@ -112,11 +399,27 @@ async def merge_camdir(srcdir, tmp, dst, force=False):
     for time in unfinished_segments:
         log.warning(f'Сегмент {time} недокачан и содержит разрывы. {srcdir}')
         
-    if unfinished_segments and not state._config.churo_merge_tolerate_incomplete_downloads:
+    if unfinished_segments and not state._config.merge_tolerate_incomplete_downloads:
         return False
     
-    await merge_files(list(srcdir.glob('*.flv')), tmp)
-    shutil.move(tmp, dst)
+    segment_times = {name: datetime.fromisoformat(x['localtime']).timestamp() 
+                     for name, x in summary.items()}
+    files = sorted(srcdir.glob('*.flv'), key=lambda x: (segment_times.get(x.name, inf), x.name))
+    cache = ProbeCache(srcdir / 'framehashes.json')
+    if incremental:
+        with metrics.timer('merge_phase_seconds', phase='merge'):
+            written = await merge_incremental(files, tmp, dst, concurrency, window, cache, force)
+    else:
+        with metrics.timer('merge_phase_seconds', phase='merge'):
+            await merge_files(files, tmp, concurrency, window, cache)
+        written = os.stat(tmp).st_size
+        with metrics.timer('merge_phase_seconds', phase='move'):
+            shutil.move(tmp, dst)
+    with metrics.timer('merge_phase_seconds', phase='cache'):
+        cache.save()
+    log.debug(f'Frame hash cache: {cache.hits} hits, {cache.misses} misses.')
+    metrics.inc('merge_bytes_written_total', written, mode='incremental' if incremental else 'full')
+    log.info(f'Merged {dst}: {written} bytes rewritten.')
     return True
         
         
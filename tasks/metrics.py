@@ -0,0 +1,212 @@
+"""
+Метрики процесса в текстовом формате Prometheus.
+
+Счетчики и гистограммы хранятся в памяти процесса, гейджи вычисляются функциями
+в момент чтения (render). Отдаются по /metrics веб-сервера планировщика и могут
+периодически записываться в файл (dump_forever), например для node_exporter
+textfile collector.
+
+    with metrics.timer('segment_phase_seconds', phase='download'):
+        ...
+    metrics.inc('segments_total', status='ok')
+    metrics.gauge('pool_active', lambda: pool.active_count, pool='download')
+"""
+import asyncio
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from math import inf
+from pathlib import Path
+
+
+PREFIX = 'churo_'
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, inf)
+
+HELP = {
+    'event_loop_lag_seconds': 'Задержка срабатывания таймера event loop.',
+    'event_loop_lag_max_seconds': 'Максимальная задержка event loop с запуска (за интервал - по гистограмме).',
+    'subprocess_seconds': 'Время жизни процессов sh() / sh_lines() по имени команды.',
+    'subprocesses_running': 'Кол-во запущенных в данный момент процессов.',
+    'blocking_seconds': 'Синхронные операции в event loop: создание директорий.',
+    'segment_phase_seconds': 'Фазы process_segment: download, check, move, report.',
+    'merge_phase_seconds': 'Фазы merge_camdir: summary, merge, move, cache.',
+    'merge_bytes_written_total': 'Байт записано в склеенные файлы (incremental - только дописанные).',
+    'pool_active': 'Кол-во активных тасков пула.',
+    'pool_pending': 'Кол-во ожидающих слот тасков пула.',
+    'pool_parked': 'Кол-во тасков пула, ожидающих повтора без слота.',
+    'pool_limit': 'Текущий limit пула.',
+    'pool_tasks_total': 'Завершенные таски пула по статусу.',
+}
+
+_counters = defaultdict(float)  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [counts по BUCKETS, sum, count]
+_gauges = {}  # (name, labels) -> func
+_levels = defaultdict(float)  # (name, labels) -> value, см. level
+_lagmax = 0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """ Увеличить счетчик. """
+    _counters[_key(name, labels)] += value
+
+
+def level(name, value, **labels):
+    """ Изменить на value гейдж, который ведется вручную (например, кол-во процессов). """
+    _levels[_key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+    """ Добавить значение в гистограмму. """
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+    histogram[0][bisect_left(BUCKETS, value)] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """ Добавить длительность блока в гистограмму name. Блок может содержать await. """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def gauge(name, func, kind='gauge', **labels):
+    """ 
+    Зарегистрировать гейдж, значение которого func() вычисляется при чтении метрик.
+    kind='counter' - если значение только растет (например, счетчик, который ведет пул).
+    """
+    _gauges[_key(name, labels)] = func, kind
+
+
+def register_pool(name, pool):
+    """ Гейджи и счетчики тасков aiopool.Pool. """
+    gauge('pool_active', lambda: pool.active_count, pool=name)
+    gauge('pool_pending', lambda: pool.pending_count, pool=name)
+    gauge('pool_parked', lambda: pool.parked_count, pool=name)
+    gauge('pool_limit', lambda: pool.limit, pool=name)
+    for status in ('ok', 'failed', 'error', 'cancelled'):
+        gauge('pool_tasks_total', lambda status=status: pool.stats[status], 'counter', 
+              pool=name, status=status)
+
+
+def reset():
+    global _lagmax
+    _counters.clear()
+    _histograms.clear()
+    _gauges.clear()
+    _levels.clear()
+    _lagmax = 0
+
+
+def _labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _escape(value):
+    """ Значение метки по формату Prometheus: экранировать \\, " и перевод строки. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """ Все метрики в текстовом формате Prometheus. Чтение не меняет метрики. """
+    gauges = dict(_gauges)
+    gauges.update({key: (lambda value=value: value, 'gauge') for key, value in _levels.items()})
+    gauges[('event_loop_lag_max_seconds', ())] = lambda: _lagmax, 'gauge'
+    metrics = defaultdict(list)  # name -> [(type, labels, value)]
+    for (name, labels), value in _counters.items():
+        metrics[name].append(('counter', labels, value))
+    for (name, labels), (func, kind) in gauges.items():
+        try:
+            metrics[name].append((kind, labels, func()))
+        except Exception:  # Например, пул закрыт.
+            continue
+    for (name, labels), value in _histograms.items():
+        metrics[name].append(('histogram', labels, value))
+
+    lines = []
+    for name in sorted(metrics):
+        kind = metrics[name][0][0]
+        if name in HELP:
+            lines.append(f'# HELP {PREFIX}{name} {HELP[name]}')
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        for _, labels, value in sorted(metrics[name], key=lambda x: x[1]):
+            if kind != 'histogram':
+                lines.append(f'{PREFIX}{name}{_labels(labels)} {_number(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append(f'{PREFIX}{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{PREFIX}{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+async def monitor_loop_lag(interval=0.1):
+    """
+    Измерять задержку event loop: насколько позже запланированного просыпается
+    sleep(interval). Большая задержка - синхронный код блокирует loop.
+    """
+    global _lagmax
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0, loop.time() - started - interval)
+        observe('event_loop_lag_seconds', lag)
+        _lagmax = max(_lagmax, lag)
+
+
+def dump(file, text=None):
+    """ Атомарно записать метрики (или готовый render() text) в file. """
+    file = Path(file)
+    text = render() if text is None else text
+    fd, tmp = tempfile.mkstemp(dir=file.parent, prefix=f'.{file.name}.', suffix='.tmp')
+    try:
+        with open(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, file)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+async def dump_forever(file, interval=10):
+    """ Записывать метрики в file раз в interval секунд. """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        # Собрать метрики в loop, записать файл в потоке.
+        await loop.run_in_executor(None, dump, file, render())
+
+
+def start(file=None, interval=10):
+    """ Запустить измерение задержки event loop и, если задан file, запись метрик в него. """
+    jobs = [asyncio.ensure_future(monitor_loop_lag())]
+    if file:
+        jobs.append(asyncio.ensure_future(dump_forever(file, interval)))
+    return jobs
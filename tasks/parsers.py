@@ -0,0 +1,183 @@
+"""
+Разбор вывода ffprobe и ffmpeg.
+
+Функции разбора работают с кусками вывода из целых строк и не зависят от event loop,
+поэтому могут выполняться в отдельных процессах (см. setup), не задерживая загрузки
+и веб-сервер, которые работают в том же потоке.
+"""
+import asyncio
+import multiprocessing
+import re
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:  # Без numpy вывод разбирается на чистом python.
+    numpy = None
+
+
+CHUNK_SIZE = 2**18
+
+executor = None  # ProcessPoolExecutor, если настроен. Иначе разбор в event loop.
+
+
+def setup(workers):
+    """ Разбирать вывод в workers процессах. 0 - в event loop. """
+    global executor
+    if executor:
+        executor.shutdown(wait=False)
+    executor = None
+    if workers:
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return executor
+
+
+async def run(func, *args):
+    """ Выполнить func(*args) в executor, если он настроен. """
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def whole_lines(chunks):
+    """ Перенарезать поток байтовых кусков так, чтобы каждый кусок заканчивался целой строкой. """
+    rest = b''
+    async for chunk in chunks:
+        end = chunk.rfind(b'\n') + 1
+        if not end:
+            rest += chunk
+            continue
+        yield rest + chunk[:end]
+        rest = chunk[end:]
+    if rest:
+        yield rest
+
+
+async def map_chunks(func, chunks, *args, prefetch=4):
+    """
+    Yield func(chunk, *args) для каждого куска из целых строк, в исходном порядке.
+    До prefetch кусков разбираются одновременно.
+    """
+    pending = deque()
+    try:
+        async for chunk in whole_lines(chunks):
+            pending.append(asyncio.ensure_future(run(func, chunk, *args)))
+            if len(pending) >= prefetch:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+PACKET_RE = re.compile(rb'packet\|pts_time=(\d+.\d+)(?:\|pos=(\d+))?')
+PTS_RE = re.compile(rb'packet\|pts_time=(\d+.\d+)')
+
+
+def scan_packets_python(chunk, maxdiff, start=None):
+    """
+    Разобрать кусок вывода ffprobe -show_entries packet=pts_time,pos и найти разрывы
+    больше maxdiff между соседними пакетами куска. Пакеты с PTS <= start пропускаются.
+    Вернуть кол-во пакетов, (pts, pos) первого, предпоследнего и последнего пакета и разрывы.
+    """
+    first = prev = last = (None, None)
+    lastpts = None
+    gaps = []
+    count = 0
+    for match in PACKET_RE.finditer(chunk):
+        pts = float(match.group(1))
+        if start is not None and pts <= start:
+            continue
+        pos = match.group(2)
+        if lastpts is None:
+            first = (pts, pos and int(pos))
+        elif pts - lastpts > maxdiff:
+            gaps.append({'start': int(lastpts), 'len': pts - lastpts})
+        prev = last
+        last = (pts, pos and int(pos))
+        lastpts = pts
+        count += 1
+    return {'count': count, 'first': first, 'prev': prev, 'last': last, 'gaps': gaps}
+
+
+def scan_packets_numpy(chunk, maxdiff, start=None):
+    """ 
+    scan_packets_python, но PTS всего куска разбираются в массив float64, а разрывы 
+    ищутся numpy. Байтовые позиции разбираются только у крайних пакетов.
+    """
+    pts = numpy.array(PTS_RE.findall(chunk), dtype=numpy.float64)
+    index = numpy.arange(len(pts))
+    if start is not None:
+        index = numpy.flatnonzero(pts > start)
+        pts = pts[index]
+    if not len(pts):
+        return scan_packets_python(b'', maxdiff)
+    diffs = numpy.diff(pts)
+    gaps = [{'start': int(pts[i]), 'len': float(diffs[i])} 
+            for i in numpy.flatnonzero(diffs > maxdiff)]
+    
+    count = len(pts)
+    total = len(index) if start is None else len(PTS_RE.findall(chunk))
+    first = _packets(chunk, [index[0]], total)[0]
+    prev, last = _packets(chunk, [index[-2] if count > 1 else None, index[-1]], total)
+    return {'count': count, 'first': first, 'prev': prev, 'last': last, 'gaps': gaps}
+
+
+def _packets(chunk, numbers, total):
+    """ (pts, pos) пакетов куска с порядковыми номерами numbers (None - (None, None)). """
+    wanted = [x for x in numbers if x is not None]
+    if all(x < 2 for x in wanted):
+        matches = _edge_matches(chunk, 2)
+    elif all(x >= total - 2 for x in wanted):
+        matches = dict((total - 1 - n, m) for n, m in _edge_matches(chunk, 2, reverse=True).items())
+    else:
+        matches = {n: m for n, m in enumerate(PACKET_RE.finditer(chunk)) if n in wanted}
+    result = []
+    for n in numbers:
+        if n is None:
+            result.append((None, None))
+        else:
+            pos = matches[n].group(2)
+            result.append((float(matches[n].group(1)), int(pos) if pos else None))
+    return result
+
+
+def _edge_matches(chunk, count, reverse=False):
+    """ Первые (или последние) count пакетов куска: {номер с начала (с конца): match}. """
+    matches = {}
+    begin, end = 0, len(chunk)
+    while len(matches) < count and begin < end:
+        if reverse:
+            linestart = chunk.rfind(b'\n', begin, end) + 1
+            match = PACKET_RE.search(chunk, linestart, end)
+            end = linestart - 1
+        else:
+            lineend = chunk.find(b'\n', begin, end)
+            lineend = end if lineend < 0 else lineend
+            match = PACKET_RE.search(chunk, begin, lineend)
+            begin = lineend + 1
+        if match:
+            matches[len(matches)] = match
+    return matches
+
+
+scan_packets = scan_packets_numpy if numpy else scan_packets_python
+
+
+Frame = namedtuple('Frame', 'stream, dts, pts, duration, size, hash')
+
+
+def parse_framemd5(chunk):
+    """ Разобрать кусок вывода ffmpeg -f framemd5: ({stream: (num, den)}, [Frame, ...]). """
+    timebases = {}
+    frames = []
+    for line in chunk.split(b'\n'):
+        if line.startswith(b'#tb'):
+            stream, timebase = line.decode().split()[1:]
+            num, den = timebase.split('/')
+            timebases.setdefault(stream.rstrip(':'), (int(num), int(den)))
+        elif line.strip() and not line.startswith(b'#'):
+            frames.append(Frame(*line.decode().replace(',', '').split()))
+    return timebases, frames
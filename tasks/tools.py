@@ -1,19 +1,33 @@
+import os
 import sys
 import contextvars
+import fcntl
+import json
 import logging
-from asyncio import create_subprocess_shell, CancelledError
-from asyncio.subprocess import PIPE
+import tempfile
+from asyncio import create_subprocess_shell, create_task, sleep, CancelledError
+from asyncio.subprocess import DEVNULL, PIPE
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
 from subprocess import CalledProcessError
 from _io import TextIOWrapper
 
 from app_state import state
 import loguru
-import psutil
+try:
+    import metrics
+    from logsink import TaskLogSink
+except ImportError:
+    from . import metrics
+    from .logsink import TaskLogSink
 
 
 varlogger = contextvars.ContextVar('logger', default=loguru.logger)
 
+# Ожидание перед повтором. В тасках aiopool.Pool это Pool.park, освобождающий слот пула.
+parking = contextvars.ContextVar('parking', default=sleep)
+
 class logger:
     """ Convenient wrapper around varlogger. """
     @staticmethod
@@ -27,13 +41,17 @@ class logger:
         return varlogger.get()
 
 
-def tasklogsink(message):
-    """ Loguru sink which writes each task log to its own file. """
-    taskid = message.record["extra"].get("taskid")
-    if taskid:
-        logfile = Path(state._config.tasks_dir) / f'{taskid}.log'
-        with open(logfile, 'a') as file:
-            file.write(message)
+tasklogsink = None  # TaskLogSink, если логи тасков пишутся в отдельные файлы.
+
+
+def tasklog_path(taskid):
+    return Path(state._config.tasks_dir) / f'{taskid}.log'
+
+
+def finish_tasklog(taskid):
+    """ Таск завершен: записать его лог на диск, не дожидаясь фонового потока. """
+    if tasklogsink:
+        tasklogsink.finish(taskid)
             
             
 class LoguruHandler(logging.Handler):
@@ -74,6 +92,7 @@ def formatter(record):
     #return wrapper
     
 def setup_logging(loglevel, filename=None):
+    global tasklogsink
     # Stdlib logging to /dev/null.
     logging.basicConfig(stream=open('/dev/null', 'w'), level=loglevel.upper())
     # Handler wich will route stdlib logging to loguru.
@@ -93,22 +112,30 @@ def setup_logging(loglevel, filename=None):
         loguru.logger.add(filename, format=formatter, level=loglevel.upper())
     else:
         # Task logger which writes each task log to its own file.
+        tasklogsink = TaskLogSink(tasklog_path)
         loguru.logger.add(tasklogsink, format=formatter, level=loglevel.upper())
 
 
+def command_name(cmd):
+    """ Имя программы shell-команды для метрик: "ffprobe -i x" -> "ffprobe". """
+    words = cmd.split(maxsplit=1)
+    return Path(words[0]).name if words else 'sh'
+
+
 async def sh(cmd, stdin=None, log_stdout=False, raise_error=True):
     """ Call shell command, return stdout. """
     log = logger.get().opt(depth=1)
-    proc = await create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE)
-    try:
-        stdout, stderr = await proc.communicate(stdin)
-    except CancelledError:
-        #if psutil.pid_exists(proc.pid):
-            ## If Cancel was due to ctrl-c, normally child receives SIGINT before this
-            ## parent code, and subprocess already dead at this point.
-            #state._num_terminated = getattr(state, '_num_terminated', 0) + 1
-            #proc.terminate()
-        raise
+    with _timed_subprocess(cmd):
+        proc = await create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE)
+        try:
+            stdout, stderr = await proc.communicate(stdin)
+        except CancelledError:
+            #if psutil.pid_exists(proc.pid):
+                ## If Cancel was due to ctrl-c, normally child receives SIGINT before this
+                ## parent code, and subprocess already dead at this point.
+                #state._num_terminated = getattr(state, '_num_terminated', 0) + 1
+                #proc.terminate()
+            raise
     if proc.returncode == 0:
         if stdout and log_stdout:
             log.debug(stdout)
@@ -127,6 +154,99 @@ async def sh(cmd, stdin=None, log_stdout=False, raise_error=True):
             return False
 
 
+async def sh_lines(cmd, stdin=None, chunk_size=None, limit=2**20, raise_error=True):
+    """
+    Call shell command, yield stdout lines (or chunks of chunk_size bytes).
+    
+    Stdout читается по мере итерации: если потребитель не успевает, пайп 
+    заполняется и процесс приостанавливается. Строка длиннее limit байт вызывает
+    ValueError. Ненулевой код возврата обрабатывается как в sh(). Если итерация
+    прервана или отменена, процесс убивается вместе со всеми дочерними.
+    """
+    log = logger.get().opt(depth=1)
+    with _timed_subprocess(cmd):
+        proc = await create_subprocess_shell(
+            cmd, stdout=PIPE, stderr=PIPE, stdin=DEVNULL if stdin is None else PIPE, limit=limit)
+        stderr = create_task(_read_tail(proc.stderr, limit))
+        if stdin is not None:
+            create_task(_write_stdin(proc.stdin, stdin))
+        completed = False
+        try:
+            if chunk_size:
+                while True:
+                    chunk = await proc.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            else:
+                async for line in proc.stdout:
+                    yield line
+            await proc.wait()
+            completed = True
+        finally:
+            if not completed:
+                kill_tree(proc.pid)
+                await proc.wait()
+            stderr = await stderr
+        
+    if proc.returncode != 0:
+        if proc.returncode != -2:  # SIGINT sent when ctrl-c is pressed.
+            message = f'"{cmd}" returned non-zero exit status {proc.returncode}'
+            if stderr:
+                message += f'\n{stderr.decode("utf8", "replace")}'
+            log.error(message)
+        if raise_error:
+            raise CalledProcessError(proc.returncode, cmd, None, stderr)
+        
+        
+@contextmanager
+def _timed_subprocess(cmd):
+    """ Учесть процесс в метриках subprocess_seconds и subprocesses_running. """
+    name = command_name(cmd)
+    metrics.level('subprocesses_running', 1)
+    try:
+        with metrics.timer('subprocess_seconds', command=name):
+            yield
+    finally:
+        metrics.level('subprocesses_running', -1)
+        
+        
+async def _read_tail(stream, limit):
+    """ Читать поток до конца, сохраняя последние limit байт. """
+    tail = b''
+    while True:
+        chunk = await stream.read(2**16)
+        if not chunk:
+            return tail
+        tail = (tail + chunk)[-limit:]
+        
+        
+async def _write_stdin(stream, data):
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+        
+        
+def kill_tree(pid):
+    """ Убить процесс и всех его потомков. """
+    import psutil
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True) + [parent]
+    except psutil.NoSuchProcess:
+        return
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    state._num_terminated = getattr(state, '_num_terminated', 0) + 1
+
+
 def sum_gaplength(gapreport):
     """ Суммарная длительность разрывов в репорте """
     if 'invalid_file' in gapreport:
@@ -135,4 +255,163 @@ def sum_gaplength(gapreport):
     duration_gap = gapreport.get('duration_error', 0) 
     diff_gaps = sum(x['len'] for x in gapreport.get('maxdiff_errors', []))
     return diff_gaps + duration_gap
-    
+
+
+def dump_json(obj, file, sync=True):
+    """ 
+    Атомарно записать json: во временный файл рядом, fsync, rename. 
+    sync=False - без fsync, для производных файлов, которые можно построить заново.
+    """
+    tmp = dump_json_tmp(obj, file, sync)
+    try:
+        os.replace(tmp, file)
+    except:
+        os.unlink(tmp)
+        raise
+        
+        
+def dump_json_tmp(obj, file, sync=True):
+    """ 
+    Записать json во временный файл рядом с file (с fsync, если sync) и вернуть его путь.
+    Переименовать его в file - дело вызывающего, см. dump_json.
+    """
+    file = Path(file)
+    fd, tmp = tempfile.mkstemp(dir=file.parent, prefix=f'.{file.name}.', suffix='.tmp')
+    try:
+        with open(fd, 'w') as f:
+            json.dump(obj, f, indent=2)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    except:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def gapsummary_entry(gapreport, max_retries):
+    """ Запись сводки разрывов камеры для одного сегмента. """
+    localtime = datetime.fromisoformat(gapreport['localtime'])
+    gaps = sum_gaplength(gapreport)
+    attempts = gapreport.get('attempts', 0)
+    return {
+        'localtime': gapreport['localtime'],
+        'slot': f'{localtime.hour:02}:{localtime.minute:02}',
+        'gaps': gaps,
+        'attempts': attempts,
+        'incomplete': bool(gaps) and attempts < max_retries,
+    }
+
+
+def load_gapsummary(camdir):
+    """ Прочитать сводку разрывов камеры {camdir}/gapsummary.json или вернуть None. """
+    try:
+        with open(Path(camdir) / 'gapsummary.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.get().error(f'Malformed gap summary in {camdir}')
+        return None
+
+
+@contextmanager
+def gapsummary_lock(camdir):
+    """
+    Блокировка сводки разрывов камеры на время чтения-изменения-записи (flock на
+    {camdir}/.gapsummary.lock). Исключает потерю обновлений, когда сегменты камеры
+    пишут сводку одновременно из потоков или процессов (узлов taskloop --node-id).
+    Узлы на разных машинах должны работать с ФС, поддерживающей flock.
+    """
+    with open(Path(camdir) / '.gapsummary.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+
+
+def build_gapsummary(camdir, max_retries):
+    """ Построить сводку разрывов камеры по всем gapreport-файлам и сохранить. """
+    if not Path(camdir).is_dir():
+        return {}
+    with gapsummary_lock(camdir):
+        summary = _build_gapsummary(camdir, max_retries)
+        dump_json(summary, Path(camdir) / 'gapsummary.json', sync=False)
+    return summary
+
+
+def _build_gapsummary(camdir, max_retries):
+    summary = {}
+    for gapfile in sorted(Path(camdir).glob('*.gapreport.json')):
+        try:
+            with open(gapfile) as f:
+                summary[gapfile.name[:-len('.gapreport.json')]] = gapsummary_entry(json.load(f), max_retries)
+        except (ValueError, KeyError):
+            logger.get().error(f'Malformed gapreport file {gapfile}')
+    return summary
+
+
+def camera_day_stats(gapreports, duration=900):
+    """
+    Статистика разрывов камеры за день по gapreport'ам её сегментов (нужен numpy):
+    кол-во сегментов, нечитаемых и без разрывов, кол-во, сумма, максимум и 
+    перцентили длин разрывов внутри сегментов, секунды недокачанных концов 
+    сегментов, доля покрытия дня и секунды разрывов по часам.
+    """
+    import numpy
+    lengths, hours, tails = [], [], []
+    invalid = clean = 0
+    for report in gapreports:
+        if 'invalid_file' in report:
+            invalid += 1
+            continue
+        localtime = datetime.fromisoformat(report['localtime'])
+        gaps = report.get('maxdiff_errors', [])
+        for gap in gaps:
+            lengths.append(gap['len'])
+            hours.append((localtime + timedelta(seconds=gap['start'])).hour)
+        tail = duration - report['duration_error'] if 'duration_error' in report else 0
+        tails.append(tail)
+        clean += not gaps and not tail
+        
+    segments = len(tails) + invalid
+    lengths = numpy.array(lengths, dtype=numpy.float64)
+    missing = lengths.sum() + numpy.sum(tails) + invalid * duration
+    percentiles = numpy.percentile(lengths, [50, 95]) if len(lengths) else [0, 0]
+    return {
+        'segments': segments,
+        'invalid': invalid,
+        'clean': clean,
+        'gaps': len(lengths),
+        'gap_seconds': float(lengths.sum()),
+        'max_gap': float(lengths.max()) if len(lengths) else 0,
+        'gap_p50': float(percentiles[0]),
+        'gap_p95': float(percentiles[1]),
+        'tail_seconds': float(numpy.sum(tails)),
+        'coverage': float(1 - missing / (segments * duration)) if segments else 0,
+        'gap_seconds_by_hour': numpy.bincount(
+            numpy.array(hours, dtype=numpy.int64), weights=lengths, minlength=24).astype(float).tolist(),
+    }
+
+
+def load_gapreports(camdir):
+    """ Все gapreport'ы сегментов камеры. """
+    for gapfile in sorted(Path(camdir).glob('*.gapreport.json')):
+        try:
+            with open(gapfile) as f:
+                yield json.load(f)
+        except ValueError:
+            logger.get().error(f'Malformed gapreport file {gapfile}')
+
+
+def update_gapsummary(segment, gapreport, max_retries):
+    """ 
+    Обновить запись сегмента в сводке разрывов камеры. Сводка производная (строится
+    по gapreport-файлам), поэтому пишется без fsync. Блокирующий вызов: из event loop
+    вызывать в executor.
+    """
+    camdir = Path(segment).parent
+    with gapsummary_lock(camdir):
+        summary = load_gapsummary(camdir)
+        if summary is None:
+            summary = _build_gapsummary(camdir, max_retries)
+        summary[Path(segment).name] = gapsummary_entry(gapreport, max_retries)
+        dump_json(summary, camdir / 'gapsummary.json', sync=False)
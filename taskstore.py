@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+
+import statuswriter
+import tasks.tools
+
+
+def default_path(tasks_dir):
+    """ Файл индекса лежит рядом с директорией тасков: ./sample/ -> ./sample.sqlite """
+    tasks_dir = Path(tasks_dir).resolve()
+    return tasks_dir.parent / f'{tasks_dir.name}.sqlite'
+
+
+class TaskStore:
+    """
+    Индекс json-файлов тасков в SQLite (WAL).
+    
+    Json-файлы остаются основным хранилищем. Индекс строится по ним и обновляется
+    методом sync(): перечитываются только файлы с изменившимися mtime или размером.
+    Выборка тасков по типу и статусу идет по индексу без чтения json-файлов.
+    
+    Несколько процессов (узлов) могут выполнять таски одного индекса, захватывая их 
+    в аренду (lease): claim, heartbeat, put_fenced. Аренда узла, который перестал 
+    продлевать ее (упал), истекает, и таски захватывает другой узел. Каждый захват 
+    выдает новый fencing-токен, и статус записывается только с токеном последнего 
+    захвата, поэтому опоздавший узел не перезапишет статус, записанный новым.
+    Сроки аренды сравниваются по часам узлов, часы должны быть синхронизированы.
+    """
+    def __init__(self, tasks_dir, path=None, timeout=30):
+        self.tasks_dir = Path(tasks_dir)
+        self.path = Path(path or default_path(tasks_dir))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None,
+                                  timeout=timeout)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                type TEXT,
+                status TEXT,
+                mtime_ns INTEGER,
+                size INTEGER,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_type_status ON tasks (type, status);
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+            CREATE TABLE IF NOT EXISTS leases (
+                id TEXT PRIMARY KEY,
+                owner TEXT,
+                lease_until REAL,
+                fence INTEGER NOT NULL,
+                claimed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS leases_owner ON leases (owner);
+        ''')
+        
+    def close(self):
+        self.db.close()
+        
+    def sync(self):
+        """ Обновить индекс по json-файлам. Вернуть кол-во обновленных и удаленных тасков. """
+        with self.lock:
+            known = {id: (mtime, size) for id, mtime, size in 
+                     self.db.execute('SELECT id, mtime_ns, size FROM tasks')}
+        seen = set()
+        changed = []
+        with os.scandir(self.tasks_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                id = entry.name[:-len('.json')]
+                stat = entry.stat()
+                seen.add(id)
+                if known.get(id) != (stat.st_mtime_ns, stat.st_size):
+                    try:
+                        changed.append((id, statuswriter.load(entry.path), stat))
+                    except ValueError:
+                        logger.error(f'Malformed task file {entry.path}')
+        removed = set(known) - seen
+        
+        self.put_many(changed)
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM tasks WHERE id = ?', [(x,) for x in removed])
+        if changed or removed:
+            logger.debug(f'Task index: {len(changed)} updated, {len(removed)} removed.')
+        return len(changed), len(removed)
+    
+    def put_many(self, items):
+        """ Записать в индекс таски [(id, taskinfo, os.stat_result или None), ...]. """
+        rows = [(
+            id, taskinfo.get('type'), taskinfo.get('status'), 
+            stat.st_mtime_ns if stat else None, stat.st_size if stat else None,
+            json.dumps(taskinfo)
+        ) for id, taskinfo, stat in items]
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)', rows)
+    
+    def pending(self, type, exclude=('running', 'finished', 'failed')):
+        """ Таски типа type, статус которых не входит в exclude. """
+        query = 'SELECT id, data FROM tasks WHERE type = ?'
+        if exclude:
+            query += ' AND (status IS NULL OR status NOT IN (%s))' % ','.join('?' * len(exclude))
+        query += ' ORDER BY id'
+        return self._select(query, (type, *exclude))
+        
+    def running(self, type=None):
+        """ Таски со статусом running, всех типов или заданного типа. """
+        if type is None:
+            return self._select("SELECT id, data FROM tasks WHERE status = 'running'")
+        return self._select("SELECT id, data FROM tasks WHERE type = ? AND status = 'running'", (type,))
+    
+    def claim(self, type, owner, limit, ttl, exclude=('finished', 'failed'), since=None):
+        """
+        Захватить до limit тасков типа type на ttl секунд для узла owner.
+        Захватываются таски со статусом не из exclude, которые никем не арендованы 
+        или аренда которых истекла (в т.ч. running, оставшиеся от упавшего узла).
+        Если задан since, завершенные (finished/failed) таски, захваченные после since,
+        повторно не захватываются: перезапуск таска - один раз за запуск.
+        Вернуть [(id, taskinfo, fencing-токен), ...], статус в индексе - running.
+        """
+        now = time.time()
+        query = '''
+            SELECT t.id, t.data, l.fence FROM tasks t LEFT JOIN leases l ON l.id = t.id
+            WHERE t.type = ? AND (l.owner IS NULL OR l.lease_until < ?)'''
+        params = [type, now]
+        if exclude:
+            query += ' AND (t.status IS NULL OR t.status NOT IN (%s))' % ','.join('?' * len(exclude))
+            params += exclude
+        if since is not None:
+            query += ''' AND NOT (coalesce(t.status IN ('finished', 'failed'), 0) 
+                              AND coalesce(l.claimed_at >= ?, 0))'''
+            params.append(since)
+        query += ' ORDER BY t.id LIMIT ?'
+        params.append(limit)
+        claimed = []
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            for id, data, fence in self.db.execute(query, params).fetchall():
+                fence = (fence or 0) + 1
+                taskinfo = dict(json.loads(data), status='running')
+                self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, ?)', 
+                                (id, owner, now + ttl, fence, now))
+                self.db.execute('UPDATE tasks SET status = ?, data = ? WHERE id = ?', 
+                                ('running', json.dumps(taskinfo), id))
+                claimed.append((id, taskinfo, fence))
+        return claimed
+    
+    def heartbeat(self, owner, leases, ttl):
+        """ 
+        Продлить аренду [(id, fence), ...] узла owner на ttl секунд. 
+        Вернуть id тасков, аренда которых потеряна (таск захвачен другим узлом).
+        """
+        lost = []
+        until = time.time() + ttl
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            for id, fence in leases:
+                updated = self.db.execute(
+                    'UPDATE leases SET lease_until = ? WHERE id = ? AND owner = ? AND fence = ?',
+                    (until, id, owner, fence)).rowcount
+                if not updated:
+                    lost.append(id)
+        return lost
+    
+    def put_fenced(self, items, write=None):
+        """
+        Записать в индекс статусы [(id, taskinfo, fence), ...], если fence - токен 
+        последнего захвата таска. Завершенный таск (не running) освобождает аренду.
+        Вернуть id принятых статусов.
+        
+        write(id) вызывается для каждого принятого статуса в той же транзакции и 
+        записывает json-файл таска, возвращая его os.stat_result (mtime и size идут в 
+        индекс). Пока транзакция не завершена, другой узел не может захватить таск, 
+        поэтому json пишется только с действительным токеном.
+        """
+        accepted = []
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            for id, taskinfo, fence in items:
+                row = self.db.execute('SELECT fence FROM leases WHERE id = ?', (id,)).fetchone()
+                if not row or row[0] != fence:
+                    continue
+                if write:
+                    stat = write(id)
+                    self.db.execute('UPDATE tasks SET status = ?, data = ?, mtime_ns = ?, size = ? WHERE id = ?',
+                                    (taskinfo.get('status'), json.dumps(taskinfo), 
+                                     stat.st_mtime_ns, stat.st_size, id))
+                else:
+                    # mtime и size не меняются: sync не должен перечитать еще не записанный json.
+                    self.db.execute('UPDATE tasks SET status = ?, data = ? WHERE id = ?',
+                                    (taskinfo.get('status'), json.dumps(taskinfo), id))
+                if taskinfo.get('status') != 'running':
+                    self.db.execute('UPDATE leases SET owner = NULL, lease_until = NULL WHERE id = ?', (id,))
+                accepted.append(id)
+        return accepted
+    
+    def leased(self, type, exclude_owner=None):
+        """ Кол-во тасков типа type в действующей аренде (кроме аренды узла exclude_owner). """
+        query = '''SELECT count(*) FROM tasks t JOIN leases l ON l.id = t.id 
+                   WHERE t.type = ? AND l.owner IS NOT NULL AND l.lease_until >= ?'''
+        params = [type, time.time()]
+        if exclude_owner is not None:
+            query += ' AND l.owner != ?'
+            params.append(exclude_owner)
+        with self.lock:
+            return self.db.execute(query, params).fetchone()[0]
+    
+    def export(self, dir):
+        """ Выгрузить все таски в json-файлы {id}.json в директорию dir. """
+        n = 0
+        for id, taskinfo in self._select('SELECT id, data FROM tasks ORDER BY id'):
+            tasks.tools.dump_json(taskinfo, Path(dir) / f'{id}.json')
+            n += 1
+        return n
+        
+    def _select(self, query, params=()):
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [(id, json.loads(data)) for id, data in rows]
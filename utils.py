@@ -2,7 +2,7 @@ import asyncio
 import json
 import os
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from os.path import exists, isdir, join, dirname
 from pathlib import Path
 from app_state import state
@@ -29,18 +29,136 @@ def stations():
     return _stations
 
 
-async def as_completed(tasks):
-    n = 0
-    pending = list(tasks)
-    while pending:
-        done, pending = await asyncio.wait(pending, timeout=10, return_when=asyncio.FIRST_COMPLETED)
-        #logger.info(f'{len(done)} done, {len(pending)} pending')
-        for x in done:
-            x.exception()  # Consume exception to prevent loging flood
-            
-        for x in done:
-            n += 1
-            yield n, x
+_stations_index = None
+
+def stations_index():
+    """ Индекс stations.json (stationsindex.StationsIndex), строится при первом обращении. """
+    global _stations_index
+    if not _stations_index:
+        import stationsindex
+        _stations_index = stationsindex.StationsIndex(Path(__file__).parent / 'stations.json')
+    else:
+        _stations_index.refresh()
+    return _stations_index
+
+
+def run(main):
+    """ asyncio.run на uvloop. uvloop импортируется только командами, которым нужен event loop. """
+    import uvloop
+    uvloop.install()
+    return asyncio.run(main)
+
+
+def roundrobin(iterables):
+    """ Чередовать элементы итераторов: a1, b1, c1, a2, b2, ... """
+    iterators = deque(iter(x) for x in iterables)
+    while iterators:
+        try:
+            yield next(iterators[0])
+        except StopIteration:
+            iterators.popleft()
+            continue
+        iterators.rotate(-1)
+
+
+def when_done(jobs, total, callback):
+    """
+    Yield задания jobs (корутины или пары (корутина, дедлайн)) так, что по 
+    завершении всех заданий (успешном или нет) один раз вызывается callback().
+    total - ожидаемое кол-во заданий: callback вызывается сразу по завершении 
+    total-го, не дожидаясь, пока jobs запросят еще раз. Если заданий меньше (или 0),
+    callback вызывается, когда jobs исчерпаны и завершены все выданные.
+    """
+    yielded = running = 0
+    exhausted = called = False
+    
+    def check():
+        nonlocal called
+        if not called and not running and (exhausted or yielded >= total):
+            called = True
+            callback()
+    
+    async def counted(coro):
+        nonlocal running
+        try:
+            return await coro
+        finally:
+            running -= 1
+            check()
+                
+    for job in jobs:
+        yielded += 1
+        running += 1
+        if isinstance(job, tuple):
+            yield (counted(job[0]),) + job[1:]
+        else:
+            yield counted(job)
+    exhausted = True
+    check()
+
+
+class CompletionStream:
+    """
+    Поток завершенных задач.
+    
+    Каждая задача по завершении сама кладет себя в очередь, поэтому стоимость 
+    одного завершения O(1) и не зависит от кол-ва ожидающих задач. Счетчики 
+    обновляются по мере завершения. Если за heartbeat секунд ничего не завершилось,
+    в лог пишется текущий прогресс.
+    """
+    def __init__(self, tasks=(), heartbeat=10):
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.heartbeat = heartbeat
+        self.total = 0
+        self.completed = 0
+        self.succeeded = 0
+        self.failed = 0
+        for task in tasks:
+            self.add(task)
+        
+    @property
+    def pending(self):
+        return self.total - self.completed
+    
+    def add(self, task):
+        task = asyncio.ensure_future(task)
+        task.add_done_callback(self._done)
+        self.total += 1
+        return task
+        
+    def _done(self, task):
+        self.completed += 1
+        # Consume exception to prevent loging flood
+        if task.cancelled() or task.exception() is not None or task.result() is False:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        self.queue.append(task)
+        self.ready.set()
+        
+    def progress(self):
+        return (f'{self.completed} of {self.total} completed.'
+                f' ({self.succeeded} ok, {self.failed} failed.)')
+    
+    async def __aiter__(self):
+        n = 0
+        while n < self.total:
+            if not self.queue:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    logger.info(self.progress())
+                    continue
+            while self.queue:
+                n += 1
+                yield n, self.queue.popleft()
+
+
+async def as_completed(tasks, heartbeat=10):
+    async for n, task in CompletionStream(tasks, heartbeat):
+        yield n, task
 
 
 def sigint_handler(*a):